@@ -0,0 +1,301 @@
+"""
+Market statistics over the listing history.
+
+`MarketStats` reads the whole houses table once, in a single query, into
+columns of compact `array`s per city, room type and contract type:
+
+- the prices per m² of all listings, kept sorted for percentiles and ranks,
+- the hours it took listings to be occupied, kept sorted as well,
+- the number of listings per hour of the day (UTC) they appeared in.
+
+After that it follows the `house_events` feed, so every `refresh()` only reads
+the listings, price changes and occupations since the previous one. The price
+per m² each active listing contributed is remembered, since only those can
+still change, so that a change replaces exactly that value. Lookups such
+as `cheaper_than` never touch the database, which keeps them off the latency of
+the notifications that use them.
+"""
+
+import bisect
+import heapq
+import logging
+import sqlite3
+import threading
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from h2s_scrapper.db import market_changes_since, market_snapshot
+from h2s_scrapper.models import EVENT_CHANGED, EVENT_LISTED, EVENT_OCCUPIED, House
+
+# Listings of the same kind needed before a price is compared with them
+MIN_COMPARABLES = 10
+DEFAULT_QUANTILES = (25.0, 50.0, 75.0)
+
+# City, room type and contract type
+Key = Tuple[str, str, str]
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """
+    Returns the q-th percentile of sorted values, interpolating linearly.
+
+    Args:
+        values (Sequence[float]): The values, in ascending order.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        Optional[float]: The percentile, or None without values.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class _Columns:
+    __slots__ = ("prices", "occupancy", "releases")
+
+    def __init__(self):
+        self.prices = array("d")
+        self.occupancy = array("d")
+        self.releases = array("l", [0] * 24)
+
+
+class MarketStats:
+    def __init__(self):
+        """
+        Initializes empty statistics, loaded by the first `refresh`.
+        """
+        self._columns: Dict[Key, _Columns] = {}
+        # url_key of every active listing -> its house ID, and the key and
+        # price per m² it is counted with
+        self._active: Dict[str, Tuple[int, Key, float]] = {}
+        self._cursor: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        """Whether the history was loaded."""
+        return self._cursor is not None
+
+    def _get(self, key: Key) -> _Columns:
+        columns = self._columns.get(key)
+        if columns is None:
+            columns = self._columns[key] = _Columns()
+        return columns
+
+    def _set_price(
+        self, house_id: int, url_key: str, key: Key, price: Optional[float]
+    ) -> None:
+        # Replaces the price per m² an active listing is counted with
+        current = self._active.get(url_key)
+        if current is not None and current[0] == house_id:
+            del self._active[url_key]
+            _, old_key, old_price = current
+            prices = self._get(old_key).prices
+            index = bisect.bisect_left(prices, old_price)
+            if index < len(prices) and prices[index] == old_price:
+                del prices[index]
+        if price is not None:
+            bisect.insort(self._get(key).prices, price)
+            self._active[url_key] = (house_id, key, price)
+
+    def refresh(self) -> None:
+        """
+        Loads the history on the first call, afterwards applies the changes since.
+        """
+        try:
+            if self._cursor is None:
+                self._load()
+            else:
+                self._apply(market_changes_since(self._cursor))
+        except sqlite3.Error as e:
+            logging.error(f"Error refreshing market statistics: {e}")
+
+    def _load(self) -> None:
+        cursor, rows = market_snapshot()
+        with self._lock:
+            self._columns = {}
+            self._active = {}
+            for (
+                house_id,
+                url_key,
+                city,
+                rooms,
+                contract_type,
+                price,
+                hour,
+                occupied_after,
+            ) in rows:
+                key = (city, rooms, contract_type)
+                columns = self._get(key)
+                if price is not None:
+                    columns.prices.append(price)
+                    if occupied_after is None:
+                        self._active[url_key] = (house_id, key, price)
+                if hour is not None:
+                    columns.releases[hour] += 1
+                if occupied_after is not None:
+                    columns.occupancy.append(occupied_after)
+            # Sorted once instead of inserting every value in order
+            for columns in self._columns.values():
+                columns.prices = array("d", sorted(columns.prices))
+                columns.occupancy = array("d", sorted(columns.occupancy))
+            self._cursor = cursor
+        logging.info(f"Loaded market statistics of {len(rows)} listings")
+
+    def _apply(self, changes: List[tuple]) -> None:
+        with self._lock:
+            for (
+                event_id,
+                event,
+                house_id,
+                url_key,
+                city,
+                rooms,
+                contract_type,
+                price,
+                hour,
+                hours,
+            ) in changes:
+                key = (city, rooms, contract_type)
+                if event == EVENT_LISTED:
+                    # An older listing of the url_key keeps its price as history
+                    self._active.pop(url_key, None)
+                    self._set_price(house_id, url_key, key, price)
+                    if hour is not None:
+                        self._get(key).releases[hour] += 1
+                elif event == EVENT_CHANGED:
+                    self._set_price(house_id, url_key, key, price)
+                elif event == EVENT_OCCUPIED:
+                    # Its price stays in the history, but can no longer change
+                    current = self._active.get(url_key)
+                    if current is not None and current[0] == house_id:
+                        del self._active[url_key]
+                    if hours is not None:
+                        bisect.insort(self._get(key).occupancy, hours)
+                self._cursor = event_id
+
+    def _select(
+        self, city: str, rooms: Optional[str], contract_type: Optional[str]
+    ) -> List[_Columns]:
+        return [
+            columns
+            for (c, r, t), columns in self._columns.items()
+            if c == city
+            and (rooms is None or r == rooms)
+            and (contract_type is None or t == contract_type)
+        ]
+
+    def price_percentiles(
+        self,
+        city: str,
+        rooms: Optional[str] = None,
+        contract_type: Optional[str] = None,
+        quantiles: Sequence[float] = DEFAULT_QUANTILES,
+    ) -> Dict[float, Optional[float]]:
+        """
+        Returns percentiles of the price per m² of all listings of a city.
+
+        Args:
+            city (str): The city ID.
+            rooms (Optional[str]): Only listings with this room type.
+            contract_type (Optional[str]): Only listings with this contract type.
+            quantiles (Sequence[float]): The percentiles to compute.
+
+        Returns:
+            Dict[float, Optional[float]]: The percentiles mapped to their value.
+        """
+        with self._lock:
+            values = list(
+                heapq.merge(
+                    *(c.prices for c in self._select(city, rooms, contract_type))
+                )
+            )
+        return {q: percentile(values, q) for q in quantiles}
+
+    def occupancy_percentiles(
+        self,
+        city: str,
+        rooms: Optional[str] = None,
+        contract_type: Optional[str] = None,
+        quantiles: Sequence[float] = DEFAULT_QUANTILES,
+    ) -> Dict[float, Optional[float]]:
+        """
+        Returns percentiles of the hours it took listings of a city to be occupied.
+
+        Args:
+            city (str): The city ID.
+            rooms (Optional[str]): Only listings with this room type.
+            contract_type (Optional[str]): Only listings with this contract type.
+            quantiles (Sequence[float]): The percentiles to compute.
+
+        Returns:
+            Dict[float, Optional[float]]: The percentiles mapped to their value.
+        """
+        with self._lock:
+            values = list(
+                heapq.merge(
+                    *(c.occupancy for c in self._select(city, rooms, contract_type))
+                )
+            )
+        return {q: percentile(values, q) for q in quantiles}
+
+    def release_histogram(
+        self,
+        city: str,
+        rooms: Optional[str] = None,
+        contract_type: Optional[str] = None,
+    ) -> List[int]:
+        """
+        Counts the listings of a city per hour of the day (UTC) they appeared in.
+
+        Args:
+            city (str): The city ID.
+            rooms (Optional[str]): Only listings with this room type.
+            contract_type (Optional[str]): Only listings with this contract type.
+
+        Returns:
+            List[int]: 24 counts, starting at midnight.
+        """
+        histogram = [0] * 24
+        with self._lock:
+            for columns in self._select(city, rooms, contract_type):
+                for hour, count in enumerate(columns.releases):
+                    histogram[hour] += count
+        return histogram
+
+    def cheaper_than(self, house: House) -> Optional[float]:
+        """
+        Tells how many comparable listings (same city, room type and contract
+        type) were more expensive per m² than a house, without a query.
+
+        Args:
+            house (House): The house to compare.
+
+        Returns:
+            Optional[float]: The share in percent, or None if the price per m² is
+            unknown or there are fewer than `MIN_COMPARABLES` comparable listings.
+        """
+        price = house.price_per_m2
+        if price is None:
+            return None
+        with self._lock:
+            key = (house.city, house.rooms, house.contract_type)
+            columns = self._columns.get(key)
+            if columns is None:
+                return None
+            prices = columns.prices
+            count = len(prices)
+            more_expensive = count - bisect.bisect_right(prices, price)
+            # The house itself is usually among them already, don't compare with it
+            own = self._active.get(house.url_key)
+            if own is not None and own[1] == key:
+                count -= 1
+                if own[2] > price:
+                    more_expensive -= 1
+        if count < MIN_COMPARABLES:
+            return None
+        return 100 * more_expensive / count
@@ -0,0 +1,437 @@
+"""
+Read-only HTTP API over the houses table.
+
+Answers questions like "what is available under 1000€ in Utrecht" without
+touching the production database by hand::
+
+    GET /houses?city=Utrecht&max_price=1000&rooms=Studio
+    GET /houses?city=25&min_area=30&limit=20&cursor=1234
+    GET /stats?city=Utrecht
+
+`/houses` lists active listings, newest first, filtered by `city` (ID or name),
+`min_price`/`max_price` (incl. service costs), `min_area`/`max_area` and
+`rooms` (repeatable). Pages are continued with the `next_cursor` of the
+previous one. `/stats` aggregates the active listings per city.
+
+The database is opened read-only and, being in WAL mode, never blocks the
+scraper's writes. Responses are cached in memory until `PRAGMA data_version`
+reports a commit by another connection, e.g. `sync_houses`.
+
+Run it next to the scraper with ``h2s_api --port 8080`` or ``h2s_scrapper
+--daemon --api-port 8080``.
+"""
+
+import argparse
+import json
+import logging
+import math
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import parse_qs, quote, urlsplit
+
+from h2s_scrapper.db import BUSY_TIMEOUT, DB_PATH
+from h2s_scrapper.scrape import city_id_to_city, city_to_city_id, url_key_to_link
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+# Read connections kept open for the request threads
+MAX_CONNECTIONS = 4
+# Responses kept per database version
+MAX_CACHE_ENTRIES = 256
+# Largest value SQLite stores as an integer
+MAX_SQLITE_INTEGER = 2**63 - 1
+
+HOUSE_FIELDS = [
+    "id",
+    "url_key",
+    "city",
+    "area",
+    "price_exc",
+    "price_inc",
+    "available_from",
+    "max_register",
+    "contract_type",
+    "rooms",
+    "created_at",
+]
+
+
+class BadRequest(ValueError):
+    """
+    Raised for invalid query parameters, answered with a 400.
+    """
+
+
+class HouseQueries:
+    def __init__(self, path: str = DB_PATH, max_connections: int = MAX_CONNECTIONS):
+        """
+        Initializes the queries over a database, opened read-only on first use.
+
+        Args:
+            path (str): Path of the database file.
+            max_connections (int): Read connections kept open between requests.
+        """
+        self.path = path
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(
+            max_connections
+        )
+        self._version_conn: Optional[sqlite3.Connection] = None
+        self._cache: Dict[str, bytes] = {}
+        self._cache_version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"file:{quote(self.path)}?mode=ro",
+            uri=True,
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _data_version(self) -> int:
+        # Only comparable on the same connection, so one is kept for it
+        if self._version_conn is None:
+            self._version_conn = self._connect()
+        return self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def cached(self, key: str, build: Callable[[], bytes]) -> bytes:
+        """
+        Returns the cached response for a key, building it if the database
+        changed since it was cached.
+
+        Args:
+            key (str): The request path and query.
+            build (Callable[[], bytes]): Builds the response body when it is
+                not cached.
+
+        Returns:
+            bytes: The response body.
+        """
+        with self._lock:
+            version = self._data_version()
+            if version != self._cache_version:
+                self._cache.clear()
+                self._cache_version = version
+            body = self._cache.get(key)
+        if body is not None:
+            return body
+
+        body = build()
+        with self._lock:
+            if self._cache_version == version:
+                if len(self._cache) >= MAX_CACHE_ENTRIES:
+                    del self._cache[next(iter(self._cache))]
+                self._cache[key] = body
+        return body
+
+    def houses(self, params: Dict[str, List[str]]) -> Dict[str, Any]:
+        """
+        Lists active houses matching the query parameters, newest first.
+
+        Args:
+            params (Dict[str, List[str]]): The parsed query string.
+
+        Returns:
+            Dict[str, Any]: The page of houses and the cursor of the next page,
+            None on the last one.
+
+        Raises:
+            BadRequest: If a parameter is invalid.
+        """
+        conditions = ["occupied_at IS NULL"]
+        values: List[Any] = []
+        city = _param(params, "city")
+        if city is not None:
+            conditions.append("city = ?")
+            values.append(_city_id(city))
+        for name, condition in (
+            ("min_price", "price_inc >= ?"),
+            ("max_price", "price_inc <= ?"),
+            ("min_area", "area >= ?"),
+            ("max_area", "area <= ?"),
+        ):
+            value = _param(params, name)
+            if value is not None:
+                conditions.append(condition)
+                values.append(_number(name, value))
+        rooms = params.get("rooms")
+        if rooms:
+            conditions.append(f"rooms IN ({','.join(['?'] * len(rooms))})")
+            values.extend(rooms)
+        cursor = _param(params, "cursor")
+        if cursor is not None:
+            conditions.append("id < ?")
+            values.append(_integer("cursor", cursor))
+        limit = _integer("limit", _param(params, "limit") or DEFAULT_LIMIT)
+        if not 1 <= limit <= MAX_LIMIT:
+            raise BadRequest(f"limit must be between 1 and {MAX_LIMIT}")
+
+        with self._connection() as conn:
+            rows = conn.execute(
+                f"""SELECT {", ".join(HOUSE_FIELDS)}
+                    FROM houses
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY id DESC
+                    LIMIT ?""",
+                (*values, limit),
+            ).fetchall()
+
+        houses = []
+        for row in rows:
+            house = dict(zip(HOUSE_FIELDS, row))
+            house["city_name"] = city_id_to_city(house["city"])
+            house["link"] = url_key_to_link(house["url_key"])
+            houses.append(house)
+        next_cursor = str(rows[-1][0]) if len(rows) == limit else None
+        return {"houses": houses, "next_cursor": next_cursor}
+
+    def stats(self, params: Dict[str, List[str]]) -> Dict[str, Any]:
+        """
+        Aggregates the active houses per city.
+
+        Args:
+            params (Dict[str, List[str]]): The parsed query string, optionally
+                with a `city`.
+
+        Returns:
+            Dict[str, Any]: Per city the number of active houses, their price
+            and area ranges, the houses per room type and the houses occupied in
+            the last seven days.
+
+        Raises:
+            BadRequest: If a parameter is invalid.
+        """
+        city = _param(params, "city")
+        city_filter = ""
+        values: Tuple[Any, ...] = ()
+        if city is not None:
+            city_filter = "AND city = ?"
+            values = (_city_id(city),)
+
+        with self._connection() as conn:
+            # Read in one transaction, so the numbers add up
+            conn.execute("BEGIN")
+            try:
+                totals = conn.execute(
+                    f"""SELECT city, COUNT(*), MIN(price_inc), AVG(price_inc),
+                               MAX(price_inc), MIN(area), AVG(area), MAX(area),
+                               AVG(price_inc / NULLIF(area, 0))
+                        FROM houses
+                        WHERE occupied_at IS NULL {city_filter}
+                        GROUP BY city""",
+                    values,
+                ).fetchall()
+                rooms = conn.execute(
+                    f"""SELECT city, rooms, COUNT(*)
+                        FROM houses
+                        WHERE occupied_at IS NULL {city_filter}
+                        GROUP BY city, rooms""",
+                    values,
+                ).fetchall()
+                occupied = conn.execute(
+                    f"""SELECT city, COUNT(*)
+                        FROM houses
+                        WHERE occupied_at >= datetime('now', '-7 days') {city_filter}
+                        GROUP BY city""",
+                    values,
+                ).fetchall()
+            finally:
+                conn.execute("COMMIT")
+
+        cities: Dict[str, Dict[str, Any]] = {}
+        for row in totals:
+            city_id, count, *ranges = row
+            cities[city_id] = {
+                "city_name": city_id_to_city(city_id),
+                "active": count,
+                "price": dict(zip(("min", "avg", "max"), ranges[0:3])),
+                "area": dict(zip(("min", "avg", "max"), ranges[3:6])),
+                "avg_price_per_m2": ranges[6],
+                "rooms": {},
+                "occupied_last_7_days": 0,
+            }
+        for city_id, room, count in rooms:
+            cities[city_id]["rooms"][room] = count
+        for city_id, count in occupied:
+            if city_id in cities:
+                cities[city_id]["occupied_last_7_days"] = count
+        return {"cities": cities}
+
+    def close(self) -> None:
+        """
+        Closes the pooled connections.
+        """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        if self._version_conn is not None:
+            self._version_conn.close()
+            self._version_conn = None
+
+
+def _param(params: Dict[str, List[str]], name: str) -> Optional[str]:
+    values = params.get(name)
+    return values[-1] if values else None
+
+
+def _number(name: str, value: Any) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError) as e:
+        raise BadRequest(f"{name} must be a number") from e
+    if not math.isfinite(number):
+        raise BadRequest(f"{name} must be a finite number")
+    return number
+
+
+def _integer(name: str, value: Any) -> int:
+    try:
+        number = int(value)
+    except (TypeError, ValueError) as e:
+        raise BadRequest(f"{name} must be an integer") from e
+    # Larger values cannot be bound as SQLite integers
+    if not 0 <= number <= MAX_SQLITE_INTEGER:
+        raise BadRequest(f"{name} is out of range")
+    return number
+
+
+def _city_id(city: str) -> str:
+    city_id = city_to_city_id(city)
+    if city_id is None:
+        raise BadRequest(f"Unknown city {city!r}")
+    return city_id
+
+
+def create_server(
+    port: int, host: str = "127.0.0.1", path: str = DB_PATH
+) -> "ThreadingHTTPServer":
+    """
+    Creates the API server, not started yet.
+
+    Args:
+        port (int): The port to listen on.
+        host (str): The address to bind, local only by default.
+        path (str): Path of the database file.
+
+    Returns:
+        ThreadingHTTPServer: The server, run with `serve_forever()`.
+    """
+    # Imported here, the HTTP server modules are only needed to serve the API
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    queries = HouseQueries(path)
+    routes = {"/houses": queries.houses, "/stats": queries.stats}
+
+    class _ApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            url = urlsplit(self.path)
+            route = routes.get(url.path.rstrip("/"))
+            if route is None:
+                self._send(404, {"error": "Not found"})
+                return
+            params = parse_qs(url.query)
+            key = f"{url.path}?{url.query}"
+            try:
+                body = queries.cached(
+                    key, lambda: json.dumps(route(params)).encode("utf-8")
+                )
+            except BadRequest as e:
+                self._send(400, {"error": str(e)})
+                return
+            except sqlite3.Error as e:
+                logging.error(f"Error answering {self.path}: {e}")
+                self._send(503, {"error": "Database unavailable"})
+                return
+            self._send(200, body)
+
+        def _send(self, status: int, body: Any) -> None:
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+            logging.debug("API %s", format % args)
+
+    server = ThreadingHTTPServer((host, port), _ApiHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(
+    port: int, host: str = "127.0.0.1", path: str = DB_PATH
+) -> "ThreadingHTTPServer":
+    """
+    Serves the API from a background thread, see `create_server`.
+
+    Returns:
+        ThreadingHTTPServer: The running server, stopped with `shutdown()`.
+    """
+    server = create_server(port, host, path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info("Serving the API on http://%s:%s/houses", host, port)
+    return server
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Runs the API in the foreground.
+    """
+    parser = argparse.ArgumentParser(description="Holland2Stay listings API")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind")
+    parser.add_argument("--db", default=DB_PATH, help="path of houses.db")
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+
+    server = create_server(args.port, args.host, args.db)
+    logging.info("Serving the API on http://%s:%s/houses", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopped")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+The application context.
+
+Settings from the environment and config.json, and the Telegram clients built
+from them, live in an `AppContext` instead of being set up when a module is
+imported. `main()` creates one with `AppContext.from_env()` and installs it
+with `set_context()`; library code reaches the debug chat through `debug()`,
+which does nothing while no context is installed, e.g. in tests and tooling.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    from h2s_scrapper.analytics import MarketStats
+    from h2s_scrapper.subscriptions import SubscriptionIndex
+    from h2s_scrapper.telegram import TelegramBot, TelegramDispatcher
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
+
+# Seconds between two reports to the debug chat, everything in between is bundled
+REPORT_INTERVAL = 60.0
+# Telegram's limit on the length of a message
+MAX_MESSAGE_LENGTH = 4096
+
+
+class DebugReporter:
+    def __init__(self, send: Callable[[str], Any], interval: float = REPORT_INTERVAL):
+        """
+        Initializes a reporter that bundles error messages for the debug chat.
+
+        The first message goes out right away, later ones are collected and sent
+        together at most every `interval` seconds, with repeated messages
+        counted instead of repeated. Sending happens on a background thread, so
+        reporting never blocks the caller.
+
+        Args:
+            send (Callable[[str], Any]): Sends a text to the debug chat.
+            interval (float): Minimum seconds between two sends.
+        """
+        self.send = send
+        self.interval = interval
+        self._pending: Dict[str, int] = {}
+        self._timer: Optional[threading.Timer] = None
+        self._last_sent = -interval
+        self._lock = threading.Lock()
+
+    def report(self, msg: str) -> None:
+        """
+        Queues a message for the next report.
+        """
+        with self._lock:
+            self._pending[msg] = self._pending.get(msg, 0) + 1
+            if self._timer is None:
+                delay = max(0.0, self._last_sent + self.interval - time.monotonic())
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """
+        Sends the queued messages now, as one message.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not pending:
+                return
+            self._last_sent = time.monotonic()
+
+        lines = [
+            f"{msg} (x{count})" if count > 1 else msg for msg, count in pending.items()
+        ]
+        text = "\n".join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = (
+                text[: MAX_MESSAGE_LENGTH - 20].rsplit("\n", 1)[0] + "\n[...truncated]"
+            )
+        try:
+            self.send(text)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error(f"Error sending debug report: {e}")
+
+
+class AppContext:
+    def __init__(self, apikey: str, debug_chat_id: str, config_path: str = CONFIG_PATH):
+        """
+        Initializes the context. The Telegram clients are built on first use.
+
+        Args:
+            apikey (str): The API key of the Telegram bot.
+            debug_chat_id (str): The chat that receives error reports.
+            config_path (str): Path to the configuration file.
+        """
+        self.apikey = apikey
+        self.debug_chat_id = debug_chat_id
+        self.config_path = config_path
+        self._debug_bot: Optional["TelegramBot"] = None
+        self._dispatcher: Optional["TelegramDispatcher"] = None
+        self._market: Optional["MarketStats"] = None
+        self._subscriptions: Optional["SubscriptionIndex"] = None
+        self.reporter = DebugReporter(lambda text: self.debug_bot.send_simple_msg(text))
+
+    @classmethod
+    def from_env(cls) -> "AppContext":
+        """
+        Builds the context from the `TELEGRAM_API_KEY` and `DEBUGGING_CHAT_ID`
+        environment variables.
+
+        Raises:
+            ValueError: If one of the variables is not set.
+        """
+        apikey = os.getenv("TELEGRAM_API_KEY")
+        debug_chat_id = os.getenv("DEBUGGING_CHAT_ID")
+        if apikey is None:
+            raise ValueError("TELEGRAM_API_KEY environment variable is not set")
+        if debug_chat_id is None:
+            raise ValueError("DEBUGGING_CHAT_ID environment variable is not set")
+        return cls(apikey=apikey, debug_chat_id=debug_chat_id)
+
+    @property
+    def debug_bot(self) -> "TelegramBot":
+        """The bot reporting errors to the debug chat."""
+        if self._debug_bot is None:
+            self._debug_bot = self.bot(self.debug_chat_id)
+        return self._debug_bot
+
+    @property
+    def dispatcher(self) -> "TelegramDispatcher":
+        """The dispatcher sending the notifications of all groups concurrently."""
+        if self._dispatcher is None:
+            from h2s_scrapper.telegram import TelegramDispatcher
+
+            self._dispatcher = TelegramDispatcher(apikey=self.apikey)
+        return self._dispatcher
+
+    @property
+    def market(self) -> "MarketStats":
+        """The market statistics, loaded by their first `refresh()`."""
+        if self._market is None:
+            from h2s_scrapper.analytics import MarketStats
+
+            self._market = MarketStats()
+        return self._market
+
+    @property
+    def subscriptions(self) -> "SubscriptionIndex":
+        """The chats subscribed per city with /subscribe, loaded by the first `refresh()`."""
+        if self._subscriptions is None:
+            from h2s_scrapper.subscriptions import SubscriptionIndex
+
+            self._subscriptions = SubscriptionIndex()
+        return self._subscriptions
+
+    def bot(self, chat_id: str) -> "TelegramBot":
+        """
+        Returns a bot sending to the given chat.
+        """
+        from h2s_scrapper.telegram import TelegramBot
+
+        return TelegramBot(apikey=self.apikey, chat_id=chat_id)
+
+    def read_config(self) -> Dict[str, Any]:
+        """
+        Reads the configuration from the JSON file.
+
+        Returns:
+            Dict[str, Any]: Configuration data as a dictionary.
+        """
+        try:
+            with open(self.config_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError as e:
+            logging.error("Configuration file not found: %s", e)
+            self.debug_bot.send_simple_msg(f"Configuration file not found: {e}")
+            raise
+        except json.JSONDecodeError as e:
+            logging.error("Error decoding JSON from config file: %s", e)
+            self.debug_bot.send_simple_msg(f"Error decoding JSON from config file: {e}")
+            raise
+
+    def close(self) -> None:
+        """
+        Sends the pending debug reports and releases the pooled connections of
+        the dispatcher, if it was used.
+        """
+        self.reporter.flush()
+        if self._dispatcher is not None:
+            self._dispatcher.close()
+            self._dispatcher = None
+
+
+_context: Optional[AppContext] = None
+
+
+def set_context(context: Optional[AppContext]) -> None:
+    """
+    Installs the context used by `get_context` and `debug`, or removes it.
+    """
+    global _context
+    _context = context
+
+
+def get_context() -> AppContext:
+    """
+    Returns the installed context.
+
+    Raises:
+        RuntimeError: If no context was installed with `set_context`.
+    """
+    if _context is None:
+        raise RuntimeError("No application context, call set_context() first")
+    return _context
+
+
+def debug(msg: str) -> None:
+    """
+    Reports a message to the debug chat, if a context is installed. Reports
+    are bundled and rate limited, see `DebugReporter`.
+
+    Args:
+        msg (str): The message text to send.
+    """
+    if _context is not None:
+        _context.reporter.report(msg)
@@ -1,7 +1,31 @@
+import json
 import logging
 import sqlite3
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from h2s_scrapper import metrics
+from h2s_scrapper.models import (
+    EVENT_CHANGED,
+    EVENT_LISTED,
+    EVENT_OCCUPIED,
+    OUTBOX_FAILED,
+    OUTBOX_PENDING,
+    OUTBOX_SENT,
+    House,
+    HouseEvent,
+    Notification,
+)
+
+DB_PATH = "houses.db"
+
+# Seconds a writer waits for a concurrent transaction before giving up
+BUSY_TIMEOUT = 10.0
+# Page cache per connection, in KiB
+CACHE_SIZE_KIB = 16384
+# Bound parameters per statement, SQLite's historical default limit
+MAX_BOUND_PARAMETERS = 999
 
 # Define column names for the houses table
 house_columns = [
@@ -16,25 +40,38 @@ house_columns = [
     "rooms",
 ]
 
-# Non-mass assignables: 'created_at', 'occupied_at'
+# Non-mass assignables: 'created_at', 'occupied_at', 'content_hash', 'updated_at'
 
-# Configure logging
-logging.basicConfig(
-    filename="house_sync.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+# One long-lived connection per thread, see get_connection()
+_local = threading.local()
 
 
-def create_connection() -> Optional[sqlite3.Connection]:
+def create_connection(path: str = DB_PATH) -> Optional[sqlite3.Connection]:
     """
     Create a connection to the SQLite database.
 
+    The database is put in WAL mode so readers in other processes (stats, API)
+    never block the scraper and vice versa. The connection is in autocommit
+    mode; writes are grouped explicitly with `transaction()`.
+
+    Args:
+        path (str): Path of the database file.
+
     Returns:
         Optional[sqlite3.Connection]: SQLite connection object if successful, None otherwise.
     """
     try:
-        conn = sqlite3.connect("houses.db")
+        conn = sqlite3.connect(
+            path,
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Durable across application crashes; only an OS crash may lose the last commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
         logging.info("Database connection created")
         return conn
     except sqlite3.Error as e:
@@ -42,106 +79,1070 @@ def create_connection() -> Optional[sqlite3.Connection]:
         return None
 
 
-def create_table() -> None:
+def get_connection() -> Optional[sqlite3.Connection]:
     """
-    Create the 'houses' table and necessary indexes if they don't exist.
+    Get the long-lived connection of the calling thread, creating it on first use.
+
+    Returns:
+        Optional[sqlite3.Connection]: SQLite connection object if successful, None otherwise.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = create_connection()
+        _local.conn = conn
+    return conn
+
+
+def close_connection() -> None:
     """
-    conn = create_connection()
+    Close the connection of the calling thread, if any.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """
+    Run a block of statements atomically on the thread's connection.
+
+    The outermost block takes the write lock up front (`BEGIN IMMEDIATE`) and
+    commits on exit. Nested blocks become savepoints, so a failing inner block
+    only rolls back its own changes.
+
+    Yields:
+        sqlite3.Connection: The connection to run the statements on.
+
+    Raises:
+        sqlite3.Error: If there is no connection or a statement fails.
+    """
+    conn = get_connection()
     if conn is None:
+        raise sqlite3.OperationalError("No database connection")
+
+    if conn.in_transaction:
+        conn.execute("SAVEPOINT nested")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK TO nested")
+            conn.execute("RELEASE nested")
+            raise
+        conn.execute("RELEASE nested")
         return
 
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        c = conn.cursor()
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS houses
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      url_key TEXT,
-                      area TEXT,
-                      city TEXT,
-                      price_exc TEXT,
-                      price_inc TEXT,
-                      available_from TEXT,
-                      max_register TEXT,
-                      contract_type TEXT,
-                      created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                      occupied_at TEXT DEFAULT NULL,
-                      rooms TEXT)"""
-        )
-        c.execute("CREATE INDEX IF NOT EXISTS idx_url_key ON houses (url_key)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_occupied_at ON houses (occupied_at)")
-        conn.commit()
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def _dedupe_active_houses(c: sqlite3.Cursor) -> None:
+    # Overlapping runs could insert the same listing twice, keep the oldest row
+    c.execute(
+        """DELETE FROM houses
+           WHERE occupied_at IS NULL
+             AND id NOT IN (SELECT MIN(id) FROM houses
+                            WHERE occupied_at IS NULL
+                            GROUP BY url_key)"""
+    )
+    c.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_active_url_key
+           ON houses (url_key) WHERE occupied_at IS NULL"""
+    )
+
+
+def _typed_columns(c: sqlite3.Cursor) -> None:
+    # SQLite cannot change column types in place, so rebuild the table. Numbers
+    # become REAL, dates ISO-8601 and timestamps "YYYY-MM-DD HH:MM:SS" (UTC).
+    # created_at always was CURRENT_TIMESTAMP, but occupied_at was written as
+    # datetime.now().isoformat(), the local time of the scraper; it is taken to
+    # be the time zone the migration runs in.
+    c.execute(
+        """CREATE TABLE houses_typed
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  url_key TEXT NOT NULL,
+                  area REAL,
+                  city TEXT,
+                  price_exc REAL,
+                  price_inc REAL,
+                  available_from TEXT,
+                  max_register TEXT,
+                  contract_type TEXT,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  occupied_at TEXT DEFAULT NULL,
+                  rooms TEXT)"""
+    )
+    c.execute(
+        """INSERT INTO houses_typed
+           SELECT id,
+                  url_key,
+                  CAST(NULLIF(REPLACE(area, ',', '.'), '') AS REAL),
+                  city,
+                  CAST(NULLIF(REPLACE(price_exc, ',', '.'), '') AS REAL),
+                  CAST(NULLIF(REPLACE(price_inc, ',', '.'), '') AS REAL),
+                  date(available_from),
+                  max_register,
+                  contract_type,
+                  COALESCE(datetime(created_at), created_at),
+                  COALESCE(datetime(occupied_at, 'utc'), occupied_at),
+                  rooms
+           FROM houses"""
+    )
+    c.execute("DROP TABLE houses")
+    c.execute("ALTER TABLE houses_typed RENAME TO houses")
+    c.execute("CREATE INDEX idx_url_key ON houses (url_key)")
+    c.execute("CREATE INDEX idx_occupied_at ON houses (occupied_at)")
+    c.execute(
+        """CREATE UNIQUE INDEX idx_active_url_key
+           ON houses (url_key) WHERE occupied_at IS NULL"""
+    )
+    # Range queries over the active listings, e.g. "price < 900 in Delft"
+    c.execute(
+        """CREATE INDEX idx_active_city_price
+           ON houses (city, price_inc) WHERE occupied_at IS NULL"""
+    )
+
+
+def _house_events(c: sqlite3.Cursor) -> None:
+    # Append-only change feed, filled by triggers so it is written in the same
+    # transaction as the change itself. content_hash lets sync_houses skip
+    # rows whose listing did not change, so an idle poll writes nothing.
+    c.execute("ALTER TABLE houses ADD COLUMN content_hash INTEGER")
+    c.execute("ALTER TABLE houses ADD COLUMN updated_at TEXT DEFAULT NULL")
+    c.execute(
+        """CREATE TABLE house_events
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  house_id INTEGER NOT NULL,
+                  url_key TEXT NOT NULL,
+                  city TEXT,
+                  event TEXT NOT NULL,
+                  price_inc REAL,
+                  prev_price_inc REAL,
+                  available_from TEXT,
+                  prev_available_from TEXT,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP)"""
+    )
+    c.execute(
+        f"""CREATE TRIGGER house_listed AFTER INSERT ON houses
+            BEGIN
+              INSERT INTO house_events
+                (house_id, url_key, city, event, price_inc, available_from)
+              VALUES
+                (NEW.id, NEW.url_key, NEW.city, '{EVENT_LISTED}',
+                 NEW.price_inc, NEW.available_from);
+            END"""
+    )
+    # Rows from before this migration have no hash yet, their first one is no change
+    c.execute(
+        f"""CREATE TRIGGER house_changed AFTER UPDATE OF content_hash ON houses
+            WHEN OLD.content_hash IS NOT NULL
+             AND OLD.content_hash IS NOT NEW.content_hash
+            BEGIN
+              INSERT INTO house_events
+                (house_id, url_key, city, event, price_inc, prev_price_inc,
+                 available_from, prev_available_from)
+              VALUES
+                (NEW.id, NEW.url_key, NEW.city, '{EVENT_CHANGED}',
+                 NEW.price_inc, OLD.price_inc,
+                 NEW.available_from, OLD.available_from);
+            END"""
+    )
+    c.execute(
+        f"""CREATE TRIGGER house_occupied AFTER UPDATE OF occupied_at ON houses
+            WHEN OLD.occupied_at IS NULL AND NEW.occupied_at IS NOT NULL
+            BEGIN
+              INSERT INTO house_events
+                (house_id, url_key, city, event, price_inc, available_from)
+              VALUES
+                (NEW.id, NEW.url_key, NEW.city, '{EVENT_OCCUPIED}',
+                 NEW.price_inc, NEW.available_from);
+            END"""
+    )
+
+
+def _telegram_files(c: sqlite3.Cursor) -> None:
+    # file_ids of uploaded photos, so every further chat can reference them
+    c.execute(
+        """CREATE TABLE telegram_files
+                 (url TEXT PRIMARY KEY,
+                  file_id TEXT NOT NULL,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP)"""
+    )
+
+
+def _city_fingerprints(c: sqlite3.Cursor) -> None:
+    # Fingerprint of the last synced API response per city, see scrape.city_fingerprint
+    c.execute(
+        """CREATE TABLE city_fingerprints
+                 (city TEXT PRIMARY KEY,
+                  fingerprint TEXT NOT NULL,
+                  updated_at TEXT DEFAULT CURRENT_TIMESTAMP)"""
+    )
+
+
+def _notification_outbox(c: sqlite3.Cursor) -> None:
+    # Notifications are queued in the transaction that inserts their house and
+    # only leave the queue once Telegram accepted them, so a crash or an outage
+    # between the sync and the sends cannot lose them. The unique pair makes
+    # queueing idempotent.
+    c.execute(
+        f"""CREATE TABLE notification_outbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  house_id INTEGER NOT NULL,
+                  chat_id TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT '{OUTBOX_PENDING}',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  claimed_until TEXT DEFAULT NULL,
+                  last_error TEXT DEFAULT NULL,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  sent_at TEXT DEFAULT NULL,
+                  UNIQUE (house_id, chat_id))"""
+    )
+    c.execute(
+        f"""CREATE INDEX idx_outbox_pending
+           ON notification_outbox (next_attempt_at) WHERE status = '{OUTBOX_PENDING}'"""
+    )
+
+
+def _city_leases(c: sqlite3.Cursor) -> None:
+    # Workers sharing the database lease the cities they poll, see sharding.py.
+    # The token grows whenever a lease changes hands and fences off writes of
+    # workers that lost it.
+    c.execute(
+        """CREATE TABLE city_leases
+                 (city TEXT PRIMARY KEY,
+                  worker TEXT NOT NULL,
+                  token INTEGER NOT NULL,
+                  expires_at TEXT NOT NULL)"""
+    )
+    c.execute(
+        """CREATE TABLE lease_workers
+                 (worker TEXT PRIMARY KEY,
+                  expires_at TEXT NOT NULL)"""
+    )
+
+
+def _api_indexes(c: sqlite3.Cursor) -> None:
+    # Covers the aggregates of /stats in the read-only API (api.py) over the
+    # active listings, so they are answered from the index alone; occupied_at
+    # is included because SQLite does not infer it from the partial index
+    c.execute("DROP INDEX IF EXISTS idx_active_city_price")
+    c.execute(
+        """CREATE INDEX idx_active_city_filters
+           ON houses (city, price_inc, area, rooms, occupied_at)
+           WHERE occupied_at IS NULL"""
+    )
+
+
+def _subscriptions(c: sqlite3.Cursor) -> None:
+    # Chats subscribed to a city with /subscribe, see subscriptions.py. Like
+    # house_events, the change feed is filled by triggers, so the in-memory
+    # index of every process can follow it incrementally.
+    c.execute(
+        """CREATE TABLE subscriptions
+                 (chat_id TEXT NOT NULL,
+                  city TEXT NOT NULL,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (chat_id, city))"""
+    )
+    c.execute(
+        """CREATE TABLE subscription_events
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  chat_id TEXT NOT NULL,
+                  city TEXT NOT NULL,
+                  subscribed INTEGER NOT NULL,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP)"""
+    )
+    c.execute(
+        """CREATE TRIGGER subscription_added AFTER INSERT ON subscriptions
+            BEGIN
+              INSERT INTO subscription_events (chat_id, city, subscribed)
+              VALUES (NEW.chat_id, NEW.city, 1);
+            END"""
+    )
+    c.execute(
+        """CREATE TRIGGER subscription_removed AFTER DELETE ON subscriptions
+            BEGIN
+              INSERT INTO subscription_events (chat_id, city, subscribed)
+              VALUES (OLD.chat_id, OLD.city, 0);
+            END"""
+    )
+
+
+def _api_keyset_index(c: sqlite3.Cursor) -> None:
+    # Pages of /houses in the read-only API are the active listings of a city
+    # in descending id order, continued below a cursor; this index yields them
+    # in that order, so a page stops after `limit` matches instead of sorting
+    # all of them
+    c.execute(
+        """CREATE INDEX idx_active_city_id
+           ON houses (city, id) WHERE occupied_at IS NULL"""
+    )
+
+
+# Schema migrations in the order they were introduced; `PRAGMA user_version`
+# stores how many of them have been applied. Only ever append to this list.
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _dedupe_active_houses,
+    _typed_columns,
+    _house_events,
+    _telegram_files,
+    _city_fingerprints,
+    _notification_outbox,
+    _city_leases,
+    _api_indexes,
+    _subscriptions,
+    _api_keyset_index,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """
+    Apply the schema migrations the database has not seen yet.
+
+    Must run inside a `transaction()`, so a failing migration leaves the schema
+    and its version untouched.
+
+    Args:
+        conn (sqlite3.Connection): The connection to migrate.
+    """
+    c = conn.cursor()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(c)
+        c.execute(f"PRAGMA user_version = {number}")
+        logging.info(f"Applied database migration {number}: {migration.__name__}")
+
+
+def create_table() -> None:
+    """
+    Create the 'houses' table and necessary indexes if they don't exist.
+    """
+    try:
+        with transaction() as conn:
+            c = conn.cursor()
+            c.execute(
+                """CREATE TABLE IF NOT EXISTS houses
+                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          url_key TEXT,
+                          area TEXT,
+                          city TEXT,
+                          price_exc TEXT,
+                          price_inc TEXT,
+                          available_from TEXT,
+                          max_register TEXT,
+                          contract_type TEXT,
+                          created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                          occupied_at TEXT DEFAULT NULL,
+                          rooms TEXT)"""
+            )
+            c.execute("CREATE INDEX IF NOT EXISTS idx_url_key ON houses (url_key)")
+            c.execute(
+                "CREATE INDEX IF NOT EXISTS idx_occupied_at ON houses (occupied_at)"
+            )
+            migrate(conn)
         logging.info("Table 'houses' created if not exists")
     except sqlite3.Error as e:
         logging.error(f"Error creating table: {e}")
-    finally:
-        conn.close()
 
 
-def sync_houses(city_id: str, houses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def sync_houses(
+    city_id: str, houses: List[House], fingerprint: Optional[str] = None
+) -> List[House]:
     """
     Sync houses data with the database. Updates `occupied_at` for houses not present in the new data
     and inserts new houses into the database.
 
+    New houses are told apart by the database itself: the unique index on active
+    `url_key`s turns duplicates into updates and `RETURNING` reports the rows that
+    were actually inserted, which keeps overlapping runs from announcing a house
+    twice. Active houses are only rewritten when their `content_hash` changed,
+    which is what records them in the `house_events` feed.
+
+    Runs in its own transaction, or as a savepoint of the caller's `transaction()`
+    so that all cities of a cycle can be committed at once.
+
     Args:
         city_id (str): The city identifier to filter houses by.
-        houses (List[Dict[str, Any]]): A list of house data dictionaries to sync.
+        houses (List[House]): A list of houses to sync.
+        fingerprint (Optional[str]): Fingerprint of the API response the houses were
+            parsed from, stored together with them, see `load_city_fingerprints`.
 
     Returns:
-        List[Dict[str, Any]]: A list of new houses inserted into the database.
+        List[House]: A list of new houses inserted into the database.
     """
-    conn = create_connection()
-    if conn is None:
+    inserted = set()
+    try:
+        with metrics.span("sync_houses"), transaction() as conn:
+            c = conn.cursor()
+
+            # Houses of the city that are no longer listed have been taken
+            c.execute(
+                """UPDATE houses
+                   SET occupied_at = CURRENT_TIMESTAMP
+                   WHERE city = ? AND occupied_at IS NULL
+                     AND url_key NOT IN (SELECT value FROM json_each(?))""",
+                (city_id, json.dumps([house.url_key for house in houses])),
+            )
+
+            # Insert new houses into the database, updating active ones that changed
+            columns = house_columns + ["content_hash"]
+            row_placeholders = f"({','.join(['?'] * len(columns))})"
+            updates = ",".join(
+                f"{column} = excluded.{column}"
+                for column in columns
+                if column not in ("url_key", "city")
+            )
+            batch_size = MAX_BOUND_PARAMETERS // len(columns)
+            for start in range(0, len(houses), batch_size):
+                batch = houses[start : start + batch_size]
+                upsert_query = f"""
+                INSERT INTO houses ({','.join(columns)})
+                VALUES {','.join([row_placeholders] * len(batch))}
+                ON CONFLICT (url_key) WHERE occupied_at IS NULL DO UPDATE
+                SET {updates}, updated_at = CURRENT_TIMESTAMP
+                WHERE houses.content_hash IS NOT excluded.content_hash
+                RETURNING url_key, updated_at IS NULL
+                """
+                params = [
+                    getattr(house, column) for house in batch for column in columns
+                ]
+                inserted.update(
+                    url_key
+                    for url_key, is_insert in c.execute(upsert_query, params)
+                    if is_insert
+                )
+
+            if fingerprint is not None:
+                c.execute(
+                    """INSERT OR REPLACE INTO city_fingerprints (city, fingerprint)
+                       VALUES (?, ?)""",
+                    (city_id, fingerprint),
+                )
+
+    except sqlite3.Error as e:
+        metrics.inc("sync_failures_total", city=city_id)
+        logging.error(f"Error syncing houses: {e}")
         return []
 
     new_houses = []
+    for house in houses:
+        if house.url_key in inserted:
+            inserted.discard(house.url_key)
+            new_houses.append(house)
+
+    metrics.inc("houses_seen_total", len(houses), city=city_id)
+    metrics.inc("houses_new_total", len(new_houses), city=city_id)
+    if new_houses:
+        logging.info(f"{len(new_houses)} new houses inserted into the database")
+    return new_houses
+
+
+def enqueue_notifications(
+    entries: List[Tuple[str, str]], windows: Optional[Dict[str, float]] = None
+) -> None:
+    """
+    Queue notifications of active houses in the notification outbox.
+
+    Meant to run inside the caller's `transaction()` that synced the houses, so
+    that they are committed, or lost, together. Pairs already queued are ignored.
+
+    A chat with a digest window gets its notifications once the window is over:
+    the first one queued opens it, and those queued until it closes become due
+    together, so they can be sent as one digest.
+
+    Args:
+        entries (List[Tuple[str, str]]): `(url_key, chat_id)` pairs to announce.
+        windows (Optional[Dict[str, float]]): Chat IDs mapped to their digest
+            window in seconds; other chats get their notifications right away.
+
+    Raises:
+        sqlite3.Error: If the notifications could not be queued.
+    """
+    if not entries:
+        return
+    windows = windows or {}
+    rows = [
+        (url_key, chat_id, windows.get(chat_id, 0.0)) for url_key, chat_id in entries
+    ]
+    with transaction() as conn:
+        conn.execute(
+            f"""INSERT OR IGNORE INTO notification_outbox
+                  (house_id, chat_id, next_attempt_at)
+               SELECT houses.id, entry.chat_id,
+                      CASE WHEN entry.digest_window > 0 THEN COALESCE(
+                        (SELECT MIN(o.next_attempt_at) FROM notification_outbox AS o
+                         WHERE o.chat_id = entry.chat_id
+                           AND o.status = '{OUTBOX_PENDING}' AND o.attempts = 0
+                           AND o.next_attempt_at > CURRENT_TIMESTAMP),
+                        datetime('now', '+' || entry.digest_window || ' seconds'))
+                      ELSE CURRENT_TIMESTAMP END
+               FROM (SELECT json_extract(value, '$[0]') AS url_key,
+                            json_extract(value, '$[1]') AS chat_id,
+                            json_extract(value, '$[2]') AS digest_window
+                     FROM json_each(?)) AS entry
+               JOIN houses ON houses.url_key = entry.url_key
+                          AND houses.occupied_at IS NULL""",
+            (json.dumps(rows),),
+        )
+
+
+def claim_notifications(limit: int, lease_seconds: float) -> List[Notification]:
+    """
+    Claim the oldest notifications that are due for delivery.
+
+    Claimed notifications are skipped by other claims for `lease_seconds`. If
+    they are not finished with `finish_notifications` by then, e.g. because the
+    process died, they become due again; delivery is thus at least once.
+
+    Args:
+        limit (int): Maximum number of notifications to claim.
+        lease_seconds (float): How long the claim lasts.
+
+    Returns:
+        List[Notification]: The claimed notifications, oldest first. Notifications
+        of the same house share its `House` object.
+    """
     try:
-        c = conn.cursor()
+        with transaction() as conn:
+            rows = conn.execute(
+                f"""SELECT o.id, o.chat_id, o.attempts, h.id, h.url_key, h.city,
+                           h.area, h.price_exc, h.price_inc, h.available_from,
+                           h.max_register, h.contract_type, h.rooms
+                    FROM notification_outbox AS o
+                    JOIN houses AS h ON h.id = o.house_id
+                    WHERE o.status = '{OUTBOX_PENDING}'
+                      AND o.next_attempt_at <= CURRENT_TIMESTAMP
+                      AND (o.claimed_until IS NULL
+                           OR o.claimed_until <= CURRENT_TIMESTAMP)
+                    ORDER BY o.id
+                    LIMIT ?""",
+                (limit,),
+            ).fetchall()
+            conn.execute(
+                """UPDATE notification_outbox
+                   SET claimed_until = datetime('now', ?)
+                   WHERE id IN (SELECT value FROM json_each(?))""",
+                (f"+{lease_seconds:.0f} seconds", json.dumps([row[0] for row in rows])),
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Error claiming notifications: {e}")
+        return []
 
-        # Get the existing houses in the database for the given city_id
-        c.execute(
-            "SELECT url_key FROM houses WHERE city = ? AND occupied_at IS NULL",
-            (city_id,),
+    houses: Dict[int, House] = {}
+    notifications = []
+    for notification_id, chat_id, attempts, house_id, *house in rows:
+        if house_id not in houses:
+            houses[house_id] = House(*house)
+        notifications.append(
+            Notification(notification_id, chat_id, attempts, houses[house_id])
         )
-        existing_houses = {row[0] for row in c.fetchall()}
-
-        # Extract the url_keys from the new houses
-        new_houses_url_keys = {house["url_key"] for house in houses}
-
-        # Houses to be updated (those in the database but not in the new houses)
-        to_be_updated = existing_houses - new_houses_url_keys
-        if to_be_updated:
-            update_query = f"""
-            UPDATE houses
-            SET occupied_at = ?
-            WHERE occupied_at IS NULL AND url_key IN ({','.join(['?'] * len(to_be_updated))})
-            """
-            c.execute(
-                update_query, (datetime.now().isoformat(),) + tuple(to_be_updated)
+    return notifications
+
+
+def finish_notifications(
+    sent: List[int], failed: List[Tuple[int, str, Optional[float]]]
+) -> None:
+    """
+    Record the outcome of claimed notifications and release their claims.
+
+    Args:
+        sent (List[int]): IDs of the notifications Telegram accepted.
+        failed (List[Tuple[int, str, Optional[float]]]): `(id, error, retry_in)`
+            of the failed ones, retried after `retry_in` seconds, or given up
+            on when it is None.
+    """
+    try:
+        with transaction() as conn:
+            conn.execute(
+                f"""UPDATE notification_outbox
+                   SET status = '{OUTBOX_SENT}', sent_at = CURRENT_TIMESTAMP,
+                       attempts = attempts + 1, claimed_until = NULL
+                   WHERE id IN (SELECT value FROM json_each(?))""",
+                (json.dumps(sent),),
+            )
+            conn.executemany(
+                f"""UPDATE notification_outbox
+                   SET status = CASE WHEN ?3 IS NULL THEN '{OUTBOX_FAILED}'
+                                     ELSE status END,
+                       next_attempt_at = datetime('now', '+' || COALESCE(?3, 0) || ' seconds'),
+                       attempts = attempts + 1, last_error = ?2, claimed_until = NULL
+                   WHERE id = ?1""",
+                failed,
             )
+    except sqlite3.Error as e:
+        logging.error(f"Error recording notification deliveries: {e}")
+
+
+def acquire_leases(worker: str, cities: List[str], ttl: float) -> Dict[str, int]:
+    """
+    Renew the city leases of a worker and rebalance them with the other workers.
+
+    The worker announces itself as alive for `ttl` seconds and renews the leases
+    it holds. Every live worker is entitled to an equal share of `cities`: leases
+    beyond the share are released for the others, and free or expired leases are
+    taken up to it. Taking a lease increases its fencing token.
+
+    Args:
+        worker (str): The ID of the calling worker.
+        cities (List[str]): All cities to share among the workers.
+        ttl (float): Seconds the worker and its leases stay valid without renewal.
+
+    Returns:
+        Dict[str, int]: The cities leased to the worker mapped to their tokens.
+    """
+    expires = f"+{ttl:.0f} seconds"
+    try:
+        with transaction() as conn:
+            conn.execute(
+                """INSERT OR REPLACE INTO lease_workers (worker, expires_at)
+                   VALUES (?, datetime('now', ?))""",
+                (worker, expires),
+            )
+            conn.execute(
+                "DELETE FROM lease_workers WHERE expires_at <= CURRENT_TIMESTAMP"
+            )
+            workers = conn.execute("SELECT COUNT(*) FROM lease_workers").fetchone()[0]
+            share = -(-len(cities) // workers)
+
+            conn.execute(
+                """UPDATE city_leases SET expires_at = datetime('now', ?)
+                   WHERE worker = ? AND expires_at > CURRENT_TIMESTAMP""",
+                (expires, worker),
+            )
+            held = dict(
+                conn.execute(
+                    """SELECT city, token FROM city_leases
+                       WHERE worker = ? AND expires_at > CURRENT_TIMESTAMP
+                       ORDER BY city""",
+                    (worker,),
+                )
+            )
+
+            kept = [city for city in held if city in cities][:share]
+            surplus = [city for city in held if city not in kept]
+            if surplus:
+                # Expired rather than deleted, the token must keep growing
+                conn.execute(
+                    """UPDATE city_leases SET expires_at = CURRENT_TIMESTAMP
+                       WHERE worker = ? AND city IN (SELECT value FROM json_each(?))""",
+                    (worker, json.dumps(surplus)),
+                )
+            held = {city: held[city] for city in kept}
+
+            if len(held) < share:
+                free = [
+                    city
+                    for (city,) in conn.execute(
+                        """SELECT value FROM json_each(?)
+                           WHERE value NOT IN (SELECT city FROM city_leases
+                                               WHERE expires_at > CURRENT_TIMESTAMP)""",
+                        (json.dumps(cities),),
+                    )
+                ]
+                for city in free[: share - len(held)]:
+                    held[city] = conn.execute(
+                        """INSERT INTO city_leases (city, worker, token, expires_at)
+                           VALUES (?, ?, 1, datetime('now', ?))
+                           ON CONFLICT (city) DO UPDATE
+                           SET worker = excluded.worker,
+                               token = city_leases.token + 1,
+                               expires_at = excluded.expires_at
+                           RETURNING token""",
+                        (city, worker, expires),
+                    ).fetchone()[0]
+    except sqlite3.Error as e:
+        logging.error(f"Error acquiring city leases: {e}")
+        return {}
+    return held
+
+
+def fenced_cities(worker: str, tokens: Dict[str, int]) -> List[str]:
+    """
+    Check which leases a worker still holds with the given fencing tokens.
+
+    Meant to run inside the `transaction()` that writes the data of the cities,
+    whose write lock keeps other workers from taking the leases meanwhile.
 
-        # Insert new houses into the database
-        to_be_inserted = [
-            tuple(house[column] for column in house_columns)
-            for house in houses
-            if house["url_key"] not in existing_houses
+    Args:
+        worker (str): The ID of the worker.
+        tokens (Dict[str, int]): Cities mapped to the tokens they were leased with.
+
+    Returns:
+        List[str]: The cities whose lease neither expired nor changed hands since.
+
+    Raises:
+        sqlite3.Error: If the leases could not be read.
+    """
+    with transaction() as conn:
+        return [
+            city
+            for (city,) in conn.execute(
+                """SELECT city FROM city_leases
+                   JOIN json_each(?) AS held
+                     ON city = json_extract(held.value, '$[0]')
+                    AND token = json_extract(held.value, '$[1]')
+                   WHERE worker = ? AND expires_at > CURRENT_TIMESTAMP""",
+                (json.dumps(list(tokens.items())), worker),
+            )
         ]
 
-        if to_be_inserted:
-            insert_query = f"""
-            INSERT INTO houses ({','.join(house_columns)})
-            VALUES ({','.join(['?'] * len(house_columns))})
-            """
-            c.executemany(insert_query, to_be_inserted)
-            conn.commit()
 
-            new_houses = [
-                house for house in houses if house["url_key"] not in existing_houses
-            ]
-            logging.info(f"{len(new_houses)} new houses inserted into the database")
+def release_leases(worker: str) -> None:
+    """
+    Give up all leases of a worker, so others can take them over right away.
 
+    Args:
+        worker (str): The ID of the worker.
+    """
+    try:
+        with transaction() as conn:
+            conn.execute(
+                """UPDATE city_leases SET expires_at = CURRENT_TIMESTAMP
+                   WHERE worker = ? AND expires_at > CURRENT_TIMESTAMP""",
+                (worker,),
+            )
+            conn.execute("DELETE FROM lease_workers WHERE worker = ?", (worker,))
     except sqlite3.Error as e:
-        logging.error(f"Error syncing houses: {e}")
+        logging.error(f"Error releasing city leases: {e}")
+
+
+def events_since(
+    cursor: int = 0, kinds: Optional[List[str]] = None, batch_size: int = 500
+) -> Iterator[HouseEvent]:
+    """
+    Yield the `house_events` recorded after the given cursor, oldest first.
+
+    Reads in keyset-paginated batches over the primary key, so the cost only
+    depends on the number of new events. Persist the `id` of the last event
+    handled and pass it back as `cursor` to resume.
+
+    Args:
+        cursor (int): The `id` of the last event already consumed, 0 for all.
+        kinds (Optional[List[str]]): Only yield these kinds, e.g. `[EVENT_CHANGED]`.
+        batch_size (int): Number of events fetched per query.
+
+    Yields:
+        HouseEvent: The events in the order they were recorded.
+    """
+    conn = get_connection()
+    if conn is None:
+        return
+
+    kind_filter = ""
+    if kinds:
+        kind_filter = f"AND event IN ({','.join(['?'] * len(kinds))})"
+    query = f"""
+    SELECT id, house_id, url_key, city, event, price_inc, prev_price_inc,
+           available_from, prev_available_from, created_at
+    FROM house_events
+    WHERE id > ? {kind_filter}
+    ORDER BY id
+    LIMIT ?
+    """
+    while True:
+        rows = conn.execute(query, (cursor, *(kinds or []), batch_size)).fetchall()
+        for row in rows:
+            yield HouseEvent(*row)
+        if len(rows) < batch_size:
+            return
+        cursor = rows[-1][0]
+
+
+def market_snapshot() -> Tuple[int, List[tuple]]:
+    """
+    Read every house ever stored for the market statistics, in one query.
+
+    Returns:
+        Tuple[int, List[tuple]]: The `id` of the last `house_events` row the
+        snapshot includes, to continue with `market_changes_since`, and per
+        house its `id`, url_key, city, rooms, contract type, price per m², hour
+        of the day it was listed and the hours it took to be occupied, if it was.
+
+    Raises:
+        sqlite3.Error: If the houses could not be read.
+    """
+    conn = get_connection()
+    if conn is None:
+        raise sqlite3.OperationalError("No database connection")
+
+    # A read transaction, so that the cursor matches the houses read
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM house_events")
+        last_event = cursor.fetchone()[0]
+        rows = conn.execute(
+            """SELECT id, url_key, city, rooms, contract_type,
+                      price_inc / NULLIF(area, 0),
+                      CAST(strftime('%H', created_at) AS INTEGER),
+                      (julianday(occupied_at) - julianday(created_at)) * 24
+               FROM houses"""
+        ).fetchall()
     finally:
-        conn.close()
+        if own_transaction:
+            conn.execute("COMMIT")
+    return last_event, rows
 
-    return new_houses
+
+def market_changes_since(cursor: int) -> List[tuple]:
+    """
+    Read the house events after a cursor for the market statistics.
+
+    Args:
+        cursor (int): The `id` of the last event already applied.
+
+    Returns:
+        List[tuple]: Per event, oldest first, its `id`, kind and the columns
+        of `market_snapshot` for the house, with the price as of the event and
+        the hours to occupancy as of the event.
+
+    Raises:
+        sqlite3.Error: If the events could not be read.
+    """
+    conn = get_connection()
+    if conn is None:
+        raise sqlite3.OperationalError("No database connection")
+
+    return conn.execute(
+        """SELECT e.id, e.event, h.id, h.url_key, h.city, h.rooms, h.contract_type,
+                  e.price_inc / NULLIF(h.area, 0),
+                  CAST(strftime('%H', h.created_at) AS INTEGER),
+                  (julianday(e.created_at) - julianday(h.created_at)) * 24
+           FROM house_events AS e
+           JOIN houses AS h ON h.id = e.house_id
+           WHERE e.id > ?
+           ORDER BY e.id""",
+        (cursor,),
+    ).fetchall()
+
+
+def add_subscription(chat_id: str, city: str) -> bool:
+    """
+    Subscribe a chat to the new listings of a city.
+
+    Args:
+        chat_id (str): The chat to notify.
+        city (str): The city ID.
+
+    Returns:
+        bool: True if the chat was not subscribed to the city yet.
+
+    Raises:
+        sqlite3.Error: If the subscription could not be stored.
+    """
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO subscriptions (chat_id, city) VALUES (?, ?)",
+            (chat_id, city),
+        )
+        return cursor.rowcount > 0
+
+
+def remove_subscriptions(chat_id: str, city: Optional[str] = None) -> List[str]:
+    """
+    Unsubscribe a chat from a city, or from all cities.
+
+    Args:
+        chat_id (str): The chat to stop notifying.
+        city (Optional[str]): The city ID, None for all cities of the chat.
+
+    Returns:
+        List[str]: The IDs of the cities the chat was unsubscribed from.
+
+    Raises:
+        sqlite3.Error: If the subscriptions could not be removed.
+    """
+    with transaction() as conn:
+        if city is None:
+            rows = conn.execute(
+                "DELETE FROM subscriptions WHERE chat_id = ? RETURNING city",
+                (chat_id,),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "DELETE FROM subscriptions WHERE chat_id = ? AND city = ? RETURNING city",
+                (chat_id, city),
+            ).fetchall()
+    return sorted(row[0] for row in rows)
+
+
+def subscriptions_snapshot() -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Read all subscriptions for the in-memory index.
+
+    Returns:
+        Tuple[int, List[Tuple[str, str]]]: The `id` of the last
+        `subscription_events` row the snapshot includes, to continue with
+        `subscription_changes_since`, and the `(chat_id, city)` pairs.
+
+    Raises:
+        sqlite3.Error: If the subscriptions could not be read.
+    """
+    conn = get_connection()
+    if conn is None:
+        raise sqlite3.OperationalError("No database connection")
+
+    # A read transaction, so that the cursor matches the subscriptions read
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM subscription_events")
+        last_event = cursor.fetchone()[0]
+        rows = conn.execute("SELECT chat_id, city FROM subscriptions").fetchall()
+    finally:
+        if own_transaction:
+            conn.execute("COMMIT")
+    return last_event, rows
+
+
+def subscription_changes_since(cursor: int) -> List[Tuple[int, str, str, bool]]:
+    """
+    Read the subscription changes after a cursor, oldest first.
+
+    Args:
+        cursor (int): The `id` of the last event already applied.
+
+    Returns:
+        List[Tuple[int, str, str, bool]]: Per change its `id`, the chat ID, the
+        city ID and whether the chat subscribed or unsubscribed.
+
+    Raises:
+        sqlite3.Error: If the changes could not be read.
+    """
+    conn = get_connection()
+    if conn is None:
+        raise sqlite3.OperationalError("No database connection")
+
+    return [
+        (id_, chat_id, city, bool(subscribed))
+        for id_, chat_id, city, subscribed in conn.execute(
+            """SELECT id, chat_id, city, subscribed FROM subscription_events
+               WHERE id > ? ORDER BY id""",
+            (cursor,),
+        )
+    ]
+
+
+def load_city_fingerprints() -> Dict[str, str]:
+    """
+    Load the fingerprint of the last synced API response of every city.
+
+    Returns:
+        Dict[str, str]: City IDs mapped to their fingerprint.
+    """
+    conn = get_connection()
+    if conn is None:
+        return {}
+
+    try:
+        return dict(conn.execute("SELECT city, fingerprint FROM city_fingerprints"))
+    except sqlite3.Error as e:
+        logging.error(f"Error loading city fingerprints: {e}")
+        return {}
+
+
+def release_history(slot_minutes: int, days: int) -> Dict[str, Dict[int, int]]:
+    """
+    Count on how many days new houses were first seen in every time-of-day slot.
+
+    Args:
+        slot_minutes (int): Length of a slot; the day (in UTC) is split into
+            `24 * 60 // slot_minutes` slots.
+        days (int): How many days of history to look at.
+
+    Returns:
+        Dict[str, Dict[int, int]]: City IDs mapped to slot numbers and the number
+        of days with at least one new house in that slot.
+    """
+    conn = get_connection()
+    if conn is None:
+        return {}
+
+    history: Dict[str, Dict[int, int]] = {}
+    try:
+        rows = conn.execute(
+            """SELECT city,
+                      (CAST(strftime('%H', created_at) AS INTEGER) * 60
+                       + CAST(strftime('%M', created_at) AS INTEGER)) / ? AS slot,
+                      COUNT(DISTINCT date(created_at))
+               FROM houses
+               WHERE created_at >= datetime('now', ?)
+               GROUP BY city, slot""",
+            (slot_minutes, f"-{days} days"),
+        )
+        for city, slot, release_days in rows:
+            history.setdefault(city, {})[slot] = release_days
+    except sqlite3.Error as e:
+        logging.error(f"Error loading release history: {e}")
+    return history
+
+
+def get_file_ids(urls: List[str]) -> Dict[str, str]:
+    """
+    Look up the Telegram file_ids of already uploaded photos.
+
+    Args:
+        urls (List[str]): The cleaned image URLs.
+
+    Returns:
+        Dict[str, str]: The known URLs mapped to their file_id.
+    """
+    conn = get_connection()
+    if conn is None or not urls:
+        return {}
+
+    try:
+        rows = conn.execute(
+            "SELECT url, file_id FROM telegram_files WHERE url IN (SELECT value FROM json_each(?))",
+            (json.dumps(urls),),
+        ).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Error reading file ids: {e}")
+        return {}
+    return dict(rows)
+
+
+def save_file_ids(file_ids: Dict[str, str]) -> None:
+    """
+    Remember the Telegram file_ids of freshly uploaded photos.
+
+    Args:
+        file_ids (Dict[str, str]): Cleaned image URLs mapped to their file_id.
+    """
+    if not file_ids:
+        return
+    try:
+        with transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO telegram_files (url, file_id) VALUES (?, ?)",
+                file_ids.items(),
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Error saving file ids: {e}")
+
+
+def forget_file_ids(urls: List[str]) -> None:
+    """
+    Drop file_ids Telegram no longer accepts, so the photos get uploaded again.
+
+    Args:
+        urls (List[str]): The cleaned image URLs.
+    """
+    try:
+        with transaction() as conn:
+            conn.execute(
+                "DELETE FROM telegram_files WHERE url IN (SELECT value FROM json_each(?))",
+                (json.dumps(urls),),
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Error forgetting file ids: {e}")
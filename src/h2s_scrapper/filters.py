@@ -0,0 +1,206 @@
+"""
+Per-group listing filters.
+
+Groups can narrow down what they are notified about with a `filters` section in
+config.json, for example::
+
+    "filters": {
+      "contract_type": ["Indefinite", "2 years"],
+      "max_price": 1000,
+      "min_area": 20,
+      "rooms": ["Studio", "1"]
+    }
+
+Values are the labels used in the notifications (see the maps in `scrape`).
+The rules of all groups are compiled once into a `FilterIndex`, which buckets
+them by city and room type and orders every bucket by maximum price, so that
+matching a house only looks at the groups that could possibly want it.
+"""
+
+import bisect
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from h2s_scrapper.models import House
+from h2s_scrapper.scrape import CONTRACT_TYPES, MAX_REGISTER_TYPES, ROOM_TYPES
+
+# Set-valued filters: config key -> (House attribute, GraphQL attribute, id -> label)
+CHOICE_FILTERS = {
+    "rooms": ("rooms", "no_of_rooms", ROOM_TYPES),
+    "contract_type": ("contract_type", "type_of_contract", CONTRACT_TYPES),
+    "max_register": ("max_register", "maximum_number_of_persons", MAX_REGISTER_TYPES),
+}
+
+RANGE_FILTERS = ("min_price", "max_price", "min_area", "max_area")
+
+
+@dataclass(frozen=True, slots=True)
+class GroupFilter:
+    """
+    The compiled filter rules of one group.
+    """
+
+    chat_id: str
+    cities: FrozenSet[str]
+    min_price: float = 0.0
+    max_price: float = math.inf
+    min_area: float = 0.0
+    max_area: float = math.inf
+    rooms: Optional[FrozenSet[str]] = None
+    contract_type: Optional[FrozenSet[str]] = None
+    max_register: Optional[FrozenSet[str]] = None
+
+    @classmethod
+    def from_group(cls, group: Dict[str, Any]) -> "GroupFilter":
+        """
+        Compiles the `filters` section of a group from config.json.
+
+        Args:
+            group (Dict[str, Any]): A group of the `telegram.groups` config section.
+
+        Returns:
+            GroupFilter: The compiled filter.
+
+        Raises:
+            ValueError: If a filter is unknown or uses an unknown value.
+        """
+        rules = dict(group.get("filters") or {})
+        kwargs: Dict[str, Any] = {}
+        for key in RANGE_FILTERS:
+            if key in rules:
+                kwargs[key] = float(rules.pop(key))
+        for key, (_, _, labels) in CHOICE_FILTERS.items():
+            if key in rules:
+                values = frozenset(str(value) for value in rules.pop(key))
+                unknown = values - set(labels.values())
+                if unknown:
+                    raise ValueError(f"Unknown {key} filter values: {sorted(unknown)}")
+                kwargs[key] = values
+        if rules:
+            raise ValueError(f"Unknown filters: {sorted(rules)}")
+
+        cities = frozenset(str(city_id) for city_id in group["cities"])
+        return cls(chat_id=str(group["chat_id"]), cities=cities, **kwargs)
+
+    def matches(self, house: House) -> bool:
+        """
+        Checks a house against all rules of the group.
+
+        Args:
+            house (House): The house to check.
+
+        Returns:
+            bool: Whether the group wants to be notified about the house.
+        """
+        if house.city not in self.cities:
+            return False
+        if not self._in_range(house.price_inc, self.min_price, self.max_price):
+            return False
+        if not self._in_range(house.area, self.min_area, self.max_area):
+            return False
+        return self._matches_choices(house)
+
+    def _matches_choices(self, house: House) -> bool:
+        return (
+            (self.rooms is None or house.rooms in self.rooms)
+            and (
+                self.contract_type is None or house.contract_type in self.contract_type
+            )
+            and (self.max_register is None or house.max_register in self.max_register)
+        )
+
+    @staticmethod
+    def _in_range(value: Optional[float], low: float, high: float) -> bool:
+        # An unknown value only passes when the range is not restricted
+        if value is None:
+            return low == 0.0 and high == math.inf
+        return low <= value <= high
+
+
+class FilterIndex:
+    def __init__(self, group_filters: List[GroupFilter]):
+        """
+        Indexes compiled group filters for fast matching.
+
+        Filters are bucketed by (city, room type), with a `None` room type for
+        groups accepting any, and every bucket is sorted by maximum price so the
+        groups a house is too expensive for are skipped with a binary search.
+
+        Args:
+            group_filters (List[GroupFilter]): The compiled filters of all groups.
+        """
+        self.group_filters = group_filters
+        buckets: Dict[Tuple[str, Optional[str]], List[GroupFilter]] = {}
+        for group_filter in group_filters:
+            for city_id in group_filter.cities:
+                for rooms in group_filter.rooms or (None,):
+                    buckets.setdefault((city_id, rooms), []).append(group_filter)
+
+        self._buckets: Dict[
+            Tuple[str, Optional[str]], Tuple[List[float], List[GroupFilter]]
+        ] = {}
+        for key, bucket in buckets.items():
+            bucket.sort(key=lambda group_filter: group_filter.max_price)
+            self._buckets[key] = ([f.max_price for f in bucket], bucket)
+
+    @classmethod
+    def from_groups(cls, groups: List[Dict[str, Any]]) -> "FilterIndex":
+        """
+        Compiles the filters of all groups from config.json.
+
+        Args:
+            groups (List[Dict[str, Any]]): The `telegram.groups` section of the config.
+
+        Returns:
+            FilterIndex: The index over all groups.
+        """
+        return cls([GroupFilter.from_group(group) for group in groups])
+
+    def match(self, house: House) -> List[str]:
+        """
+        Finds the chats that want to be notified about a house.
+
+        Args:
+            house (House): The house to match.
+
+        Returns:
+            List[str]: The matching chat IDs, without duplicates.
+        """
+        chat_ids: List[str] = []
+        for rooms in (house.rooms, None):
+            bucket = self._buckets.get((house.city, rooms))
+            if bucket is None:
+                continue
+            max_prices, group_filters = bucket
+            start = 0
+            if house.price_inc is not None:
+                start = bisect.bisect_left(max_prices, house.price_inc)
+            for group_filter in group_filters[start:]:
+                if group_filter.chat_id not in chat_ids and group_filter.matches(house):
+                    chat_ids.append(group_filter.chat_id)
+        return chat_ids
+
+    def pushdown_filters(self) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Builds GraphQL `filters` for the set-valued rules shared by every group.
+
+        A rule can only be sent to the API when all groups restrict that field,
+        and then as the union of their allowed values; otherwise some group would
+        miss houses. Price and area ranges are always evaluated locally.
+
+        Returns:
+            Dict[str, Dict[str, List[str]]]: Extra GraphQL filters, possibly empty.
+        """
+        if not self.group_filters:
+            return {}
+
+        pushdown = {}
+        for attribute, graphql_attribute, labels in CHOICE_FILTERS.values():
+            allowed = [getattr(f, attribute) for f in self.group_filters]
+            if any(values is None for values in allowed):
+                continue
+            union = frozenset().union(*allowed)
+            ids = sorted(id_ for id_, label in labels.items() if label in union)
+            pushdown[graphql_attribute] = {"in": ids}
+        return pushdown
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import TYPE_CHECKING, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Processed photos, content-addressed by their (cleaned) URL
+IMAGE_CACHE_DIR = "image_cache"
+
+MAX_DOWNLOAD_WORKERS = 8
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Telegram's limits for photos: 10 MB, width + height <= 10000, ratio <= 20
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_PHOTO_DIMENSIONS = 10000
+MAX_PHOTO_RATIO = 20
+JPEG_QUALITY = 85
+# Downscales tried when an encoded photo is still over MAX_PHOTO_BYTES
+MAX_ENCODE_ATTEMPTS = 4
+
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=MAX_DOWNLOAD_WORKERS),
+)
+
+
+def cache_path(url: str) -> str:
+    """
+    Returns where the processed photo of a URL is cached.
+
+    Args:
+        url (str): The image URL, already cleaned with `scrape.clean_img` so that
+            the same picture always maps to the same file.
+
+    Returns:
+        str: Path of the cached file.
+    """
+    digest = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, digest[:2], f"{digest}.jpg")
+
+
+def prepare_photo(data: bytes) -> bytes:
+    """
+    Makes image bytes acceptable as a Telegram photo with as little work as possible.
+
+    JPEGs within Telegram's limits are passed through untouched. Anything else
+    is cropped to the maximum aspect ratio and downscaled to fit the limits, if
+    needed, and encoded as JPEG, downscaled further until it fits in bytes.
+
+    Args:
+        data (bytes): The downloaded image.
+
+    Returns:
+        bytes: The JPEG to upload.
+
+    Raises:
+        ValueError: If the photo cannot be made small enough.
+    """
+    # Imported on first use, most photos are served from the cache or by file_id
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as img:
+        width, height = img.size
+        fits_dimensions = width + height <= MAX_PHOTO_DIMENSIONS
+        fits_ratio = max(width, height) <= MAX_PHOTO_RATIO * min(width, height)
+        if (
+            img.format == "JPEG"
+            and fits_dimensions
+            and fits_ratio
+            and len(data) <= MAX_PHOTO_BYTES
+        ):
+            return data
+
+        photo = _crop_to_ratio(img.convert("RGB"))
+        if not fits_dimensions:
+            photo = _scale(photo, MAX_PHOTO_DIMENSIONS / (width + height))
+        for _ in range(MAX_ENCODE_ATTEMPTS):
+            with BytesIO() as output:
+                photo.save(output, format="JPEG", quality=JPEG_QUALITY)
+                encoded = output.getvalue()
+            if len(encoded) <= MAX_PHOTO_BYTES:
+                return encoded
+            # The size shrinks about with the area, leave some margin
+            photo = _scale(photo, 0.9 * (MAX_PHOTO_BYTES / len(encoded)) ** 0.5)
+        raise ValueError(f"Photo is still over {MAX_PHOTO_BYTES} bytes")
+
+
+def _crop_to_ratio(img: "Image.Image") -> "Image.Image":
+    # Keeps the middle of panoramas and strips that are too long for Telegram
+    width, height = img.size
+    if width > MAX_PHOTO_RATIO * height:
+        left = (width - MAX_PHOTO_RATIO * height) // 2
+        return img.crop((left, 0, left + MAX_PHOTO_RATIO * height, height))
+    if height > MAX_PHOTO_RATIO * width:
+        top = (height - MAX_PHOTO_RATIO * width) // 2
+        return img.crop((0, top, width, top + MAX_PHOTO_RATIO * width))
+    return img
+
+
+def _scale(img: "Image.Image", scale: float) -> "Image.Image":
+    width, height = img.size
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    # Rounding can push the aspect ratio over the limit again
+    return _crop_to_ratio(img.resize(size))
+
+
+def fetch_image(url: str) -> Optional[bytes]:
+    """
+    Returns the photo of a URL, from the cache or downloaded and prepared.
+
+    Args:
+        url (str): The cleaned image URL.
+
+    Returns:
+        Optional[bytes]: The JPEG to upload, or None if it could not be fetched.
+    """
+    path = cache_path(url)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    try:
+        response = session.get(url, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        photo = prepare_photo(response.content)
+    except Exception as e:
+        logging.error(f"Error processing image: {url}, Error: {e}")
+        return None
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temporary name so readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(photo)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"Error caching image {url}: {e}")
+    return photo
+
+
+def fetch_images(urls: List[str]) -> List[Optional[bytes]]:
+    """
+    Fetches several photos concurrently over a pooled connection.
+
+    Args:
+        urls (List[str]): The cleaned image URLs.
+
+    Returns:
+        List[Optional[bytes]]: The photos in the order of `urls`, None for failures.
+    """
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_WORKERS, len(urls))) as pool:
+        return list(pool.map(fetch_image, urls))
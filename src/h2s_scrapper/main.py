@@ -5,126 +5,596 @@ This script scrapes house data, syncs it with the database, and sends notificati
 to configured Telegram groups.
 """
 
-import json
+import argparse
 import logging
-import os
-from typing import Any, Dict, List, Optional
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple
 
-import requests
+from h2s_scrapper import app, metrics
+from h2s_scrapper.app import AppContext
+from h2s_scrapper.db import (
+    close_connection,
+    create_table,
+    enqueue_notifications,
+    load_city_fingerprints,
+    sync_houses,
+    transaction,
+)
+from h2s_scrapper.filters import FilterIndex
+from h2s_scrapper.outbox import DIGEST_ORDERS, OutboxWorker, drain_outbox
+from h2s_scrapper.scheduler import DAY_SECONDS, PollScheduler
+from h2s_scrapper.scrape import (
+    city_fingerprint,
+    fetch_city_products,
+    parse_houses,
+)
+from h2s_scrapper.sharding import CityLeases
+from h2s_scrapper.subscriptions import CommandListener, SubscriptionIndex
 
-from h2s_scrapper.db import create_table, sync_houses
-from h2s_scrapper.scrape import house_to_msg, scrape
-from h2s_scrapper.telegram import TelegramBot
+LOG_FILE = "house_sync.log"
 
-# Load environment variables using os and ensure they are not None
-TELEGRAM_API_KEY = os.getenv("TELEGRAM_API_KEY")
-DEBUGGING_CHAT_ID = os.getenv("DEBUGGING_CHAT_ID")
+# Daemon defaults, overridable from the "daemon" section of config.json or the CLI
+DEFAULT_POLL_INTERVAL = 60.0
+DEFAULT_POLL_JITTER = 10.0
+# Bounds of the adaptive schedule, see `PollScheduler`
+DEFAULT_MIN_INTERVAL = 5.0
+DEFAULT_MAX_INTERVAL = 300.0
 
-if TELEGRAM_API_KEY is None:
-    raise ValueError("TELEGRAM_API_KEY environment variable is not set")
-if DEBUGGING_CHAT_ID is None:
-    raise ValueError("DEBUGGING_CHAT_ID environment variable is not set")
 
-# Initialize the debug Telegram bot
-debug_telegram = TelegramBot(apikey=TELEGRAM_API_KEY, chat_id=DEBUGGING_CHAT_ID)
+def plan_subscriptions(
+    groups: List[Dict[str, Any]], subscribers: Optional[SubscriptionIndex] = None
+) -> Dict[str, List[str]]:
+    """
+    Builds the fetch plan for one cycle: every distinct city watched by any group
+    or subscriber, mapped to the chat IDs subscribed to it.
+
+    Args:
+        groups (List[Dict[str, Any]]): The `telegram.groups` section of the config.
+        subscribers (Optional[SubscriptionIndex]): The chats that subscribed
+            with /subscribe.
+
+    Returns:
+        Dict[str, List[str]]: City IDs mapped to the chat IDs that watch them.
+    """
+    subscriptions: Dict[str, List[str]] = {}
+    for group in groups:
+        if group["chat_id"] is None:
+            raise ValueError("Chat ID is not set for one of the groups in the config")
+        # Numbers in the config are stored and looked up as the TEXT chat_id
+        chat_id = str(group["chat_id"])
+
+        for city_id in group["cities"]:
+            chat_ids = subscriptions.setdefault(str(city_id), [])
+            if chat_id not in chat_ids:
+                chat_ids.append(chat_id)
+
+    if subscribers is not None:
+        for city_id in subscribers.cities():
+            chat_ids = subscriptions.setdefault(city_id, [])
+            chat_ids.extend(sorted(subscribers.chats(city_id).difference(chat_ids)))
+    return subscriptions
+
+
+def check_chat_ids(groups: List[Dict[str, Any]]) -> None:
+    """
+    Checks that every group has a usable chat ID: a number, negative for groups
+    and channels, or the @username of a public channel.
+
+    Args:
+        groups (List[Dict[str, Any]]): The `telegram.groups` section of the config.
+
+    Raises:
+        ValueError: If a chat ID is missing or a placeholder such as
+            "<Your chat number>", which Telegram would reject for good.
+    """
+    for group in groups:
+        chat_id = str(group.get("chat_id") or "")
+        if not (chat_id.lstrip("-").isdigit() or chat_id.startswith("@")):
+            raise ValueError(
+                f"Invalid chat_id {chat_id!r} of group {group.get('name', '?')!r} "
+                "in the config, set it to the ID of the Telegram chat"
+            )
+
+
+def image_chats(groups: List[Dict[str, Any]]) -> FrozenSet[str]:
+    """
+    Returns the chats of the groups that get photos, see `send_images` in the config.
+    """
+    return frozenset(
+        str(group["chat_id"]) for group in groups if group.get("send_images")
+    )
+
+
+def digest_windows(groups: List[Dict[str, Any]]) -> Dict[str, float]:
+    """
+    Returns the chats of the groups with a `digest_window`, mapped to its seconds.
+    """
+    return {
+        str(group["chat_id"]): float(group["digest_window"])
+        for group in groups
+        if group.get("digest_window")
+    }
 
 
-def read_config() -> Dict[str, Any]:
+def digest_orders(groups: List[Dict[str, Any]]) -> Dict[str, str]:
     """
-    Reads the configuration from the specified JSON file.
+    Returns the chats of the groups with a `digest_order`, mapped to it.
+
+    Raises:
+        ValueError: If a group asks for an unknown order.
+    """
+    orders = {}
+    for group in groups:
+        order = group.get("digest_order")
+        if order is None:
+            continue
+        if order not in DIGEST_ORDERS:
+            raise ValueError(
+                f"Unknown digest_order {order!r}, use one of {', '.join(DIGEST_ORDERS)}"
+            )
+        orders[str(group["chat_id"])] = order
+    return orders
+
+
+def load_market() -> None:
+    """
+    Loads the market statistics, so that the notifications of the following
+    cycles compare prices with the history.
+    """
+    with metrics.span("market_load"):
+        app.get_context().market.refresh()
+
+
+def sync_cycle(
+    config: Dict[str, Any],
+    filter_index: Optional[FilterIndex] = None,
+    fingerprints: Optional[Dict[str, str]] = None,
+    cities: Optional[List[str]] = None,
+    leases: Optional[CityLeases] = None,
+) -> int:
+    """
+    Scrapes and syncs all configured cities and queues the notifications of the
+    new houses in the outbox, without sending them.
+
+    Every city is fetched and synced once per cycle, no matter how many groups
+    watch it; its new houses are then queued for each group whose filters they
+    match and each chat subscribed to the city with /subscribe, in the same
+    transaction that inserts them. Cities whose response has
+    the same fingerprint as the last synced one are skipped right after the fetch.
 
     Args:
-        config_path (str): Path to the configuration file.
+        config (Dict[str, Any]): Configuration data as returned by `AppContext.read_config`.
+        filter_index (Optional[FilterIndex]): The compiled group filters, compiled
+            from the config when not given.
+        fingerprints (Optional[Dict[str, str]]): In-memory copy of the stored city
+            fingerprints, loaded from the database when not given. Updated in
+            place once the cycle is committed.
+        cities (Optional[List[str]]): Only poll these of the subscribed cities,
+            as chosen by the `PollScheduler`; all of them when not given.
+        leases (Optional[CityLeases]): The leases of this worker when the cities
+            are sharded; cities whose lease was lost since are not synced.
 
     Returns:
-        Dict[str, Any]: Configuration data as a dictionary.
+        int: The number of notifications queued.
+    """
+    groups = config["telegram"]["groups"]
+    # Picks up the /subscribe and /unsubscribe commands since the last cycle
+    subscribers = app.get_context().subscriptions
+    subscribers.refresh()
+    subscriptions = plan_subscriptions(groups, subscribers)
+    if cities is not None:
+        subscriptions = {
+            city_id: chat_ids
+            for city_id, chat_ids in subscriptions.items()
+            if city_id in cities
+        }
+    if not subscriptions:
+        logging.warning("No cities configured or subscribed, nothing to scrape")
+        return 0
+
+    if filter_index is None:
+        filter_index = FilterIndex.from_groups(groups)
+    # Opt-in, as the houses table then only tracks listings some group wants.
+    # Subscribers want every listing of their cities, and the filters apply to
+    # all cities of the request, so they are only pushed down without any.
+    extra_filters = None
+    if config.get("filter_pushdown") and not any(
+        subscribers.chats(city_id) for city_id in subscriptions
+    ):
+        extra_filters = filter_index.pushdown_filters()
+
+    if fingerprints is None:
+        fingerprints = load_city_fingerprints()
+
+    # Scrape house data for the union of all subscribed cities
+    products_in_cities = fetch_city_products(
+        cities=list(subscriptions), extra_filters=extra_filters
+    )
+    if products_in_cities is None:
+        return 0
+
+    changed_fingerprints = {}
+    for city_id, products in products_in_cities.items():
+        fingerprint = city_fingerprint(products)
+        if fingerprints.get(city_id) != fingerprint:
+            changed_fingerprints[city_id] = fingerprint
+    if not changed_fingerprints:
+        return 0
+
+    # All cities of the cycle are committed together in a single transaction,
+    # along with the notifications of their new houses
+    notifications: List[Tuple[str, str]] = []
+    with metrics.span("sync"), transaction():
+        if leases is not None:
+            # Checked under the write lock, so no other worker can take them meanwhile
+            changed_fingerprints = {
+                city_id: changed_fingerprints[city_id]
+                for city_id in leases.fenced(list(changed_fingerprints))
+            }
+        for city_id, fingerprint in changed_fingerprints.items():
+            # Synchronize houses with the database and get new houses
+            new_houses = sync_houses(
+                city_id=city_id,
+                houses=parse_houses(products_in_cities[city_id]),
+                fingerprint=fingerprint,
+            )
+            for house in new_houses:
+                chat_ids = filter_index.match(house)
+                # Subscribers get every listing of their city, unfiltered
+                chat_ids.extend(subscribers.chats(house.city).difference(chat_ids))
+                for chat_id in chat_ids:
+                    notifications.append((house.url_key, chat_id))
+        enqueue_notifications(notifications, digest_windows(groups))
+    fingerprints.update(load_city_fingerprints())
+    # Before the notifications are sent, so that they are compared with the latest
+    # data. Only the daemons load the statistics, see `load_market`; a one-shot
+    # run would have to read the whole history first.
+    market = app.get_context().market
+    if market.is_loaded:
+        market.refresh()
+    return len(notifications)
+
+
+def run_cycle(
+    config: Dict[str, Any],
+    filter_index: Optional[FilterIndex] = None,
+    fingerprints: Optional[Dict[str, str]] = None,
+    cities: Optional[List[str]] = None,
+    worker: Optional[OutboxWorker] = None,
+    leases: Optional[CityLeases] = None,
+) -> None:
+    """
+    Runs a single scrape, sync and notify pass over all configured groups.
+
+    See `sync_cycle`; the queued notifications, and those left over from
+    earlier cycles, are then sent by `worker`, or right away without one.
+
+    Args:
+        config (Dict[str, Any]): Configuration data as returned by `AppContext.read_config`.
+        filter_index (Optional[FilterIndex]): Passed on to `sync_cycle`.
+        fingerprints (Optional[Dict[str, str]]): Passed on to `sync_cycle`.
+        cities (Optional[List[str]]): Passed on to `sync_cycle`.
+        worker (Optional[OutboxWorker]): The running worker that sends the
+            notifications in the background.
+        leases (Optional[CityLeases]): Passed on to `sync_cycle`.
+    """
+    queued = sync_cycle(config, filter_index, fingerprints, cities, leases)
+    if worker is not None:
+        if queued:
+            worker.wake()
+        return
+    groups = config["telegram"]["groups"]
+    drain_outbox(
+        app.get_context().dispatcher, image_chats(groups), digest_orders(groups)
+    )
+
+
+def timed_cycle(
+    config: Dict[str, Any],
+    filter_index: Optional[FilterIndex] = None,
+    fingerprints: Optional[Dict[str, str]] = None,
+    metrics_file: Optional[str] = None,
+    cities: Optional[List[str]] = None,
+    worker: Optional[OutboxWorker] = None,
+    leases: Optional[CityLeases] = None,
+) -> None:
+    """
+    Runs `run_cycle` as the "cycle" stage and counts it.
+
+    Args:
+        config (Dict[str, Any]): Configuration data as returned by `AppContext.read_config`.
+        filter_index (Optional[FilterIndex]): Passed on to `run_cycle`.
+        fingerprints (Optional[Dict[str, str]]): Passed on to `run_cycle`.
+        metrics_file (Optional[str]): File the metrics are written to afterwards.
+        cities (Optional[List[str]]): Passed on to `run_cycle`.
+        worker (Optional[OutboxWorker]): Passed on to `run_cycle`.
+        leases (Optional[CityLeases]): Passed on to `run_cycle`.
     """
     try:
-        script_dir = os.path.dirname(__file__)  # Directory of the script being run
-        config_path = os.path.join(script_dir, "config.json")
-        with open(config_path, encoding="utf-8") as f:
-            config = json.load(f)
-            config["telegram"]["groups"][0]["chat_id"] = DEBUGGING_CHAT_ID
-            return config
-    except FileNotFoundError as e:
-        logging.error("Configuration file not found: %s", e)
-        debug_telegram.send_simple_msg(f"Configuration file not found: {e}")
-        raise
-    except json.JSONDecodeError as e:
-        logging.error("Error decoding JSON from config file: %s", e)
-        debug_telegram.send_simple_msg(f"Error decoding JSON from config file: {e}")
+        with metrics.span("cycle"):
+            run_cycle(config, filter_index, fingerprints, cities, worker, leases)
+    except Exception:
+        metrics.inc("cycles_failed_total")
         raise
+    finally:
+        metrics.inc("cycles_total")
+        if metrics_file:
+            metrics.write_file(metrics_file)
 
 
-def process_house_notifications(
-    telegram: TelegramBot, houses: List[Dict[str, Any]]
-) -> None:
+@contextmanager
+def daemon_cycles(
+    config: Dict[str, Any],
+    metrics_file: Optional[str] = None,
+    leases: Optional[CityLeases] = None,
+) -> Iterator[Callable[[Optional[List[str]]], None]]:
     """
-    Processes and sends notifications for new houses.
+    Sets up what every daemon needs, and tears it down once it stops.
+
+    Loads the market statistics and starts the outbox worker, which sends the
+    notifications in the background while the polls go on.
 
     Args:
-        telegram (TelegramBot): The Telegram bot instance used to send notifications.
-        houses (List[Dict[str, Any]]): A list of dictionaries containing house data.
+        config (Dict[str, Any]): Configuration data as returned by `AppContext.read_config`.
+        metrics_file (Optional[str]): File the metrics are written to after
+            every cycle.
+        leases (Optional[CityLeases]): The leases of this worker, released on exit.
+
+    Yields:
+        Callable[[Optional[List[str]]], None]: Runs a cycle over the given
+        cities, or all of them for None; a failing cycle is logged, not raised.
     """
-    for h in houses:
+    groups = config["telegram"]["groups"]
+    filter_index = FilterIndex.from_groups(groups)
+    fingerprints = load_city_fingerprints()
+    load_market()
+    worker = OutboxWorker(
+        app.get_context().dispatcher, image_chats(groups), digest_orders(groups)
+    ).start()
+
+    def cycle(cities: Optional[List[str]]) -> None:
         try:
-            # Send house details as a simple message
-            res: Optional[requests.Response] = telegram.send_simple_msg(house_to_msg(h))
-            logging.info(
-                "Sent Telegram notification for %s", h.get("url_key", "unknown")
+            timed_cycle(
+                config, filter_index, fingerprints, metrics_file, cities, worker, leases
             )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            # A failing cycle must not take the daemon down, the next one may succeed
+            logging.exception("Polling cycle failed: %s", error)
+            app.debug(f"Polling cycle failed: {error}")
 
-            # Check for unsuccessful send attempts
-            if res and res.status_code != 200:
-                error_msg = (
-                    "Failed to send Telegram notification for %s: %s",
-                    h.get("url_key", "unknown"),
-                    res.json(),
-                )
-                debug_telegram.send_simple_msg(
-                    f"""Failed to send Telegram notification for
-                    {h.get('url_key', 'unknown')}: {res.json()}"""
-                )
-                logging.error(*error_msg)
+    try:
+        yield cycle
+    finally:
+        worker.stop()
+        if leases is not None:
+            leases.release()
 
-        except requests.RequestException as error:
-            error_msg = (
-                "Error sending notification for house %s: %s",
-                h.get("url_key", "unknown"),
-                error,
-            )
-            debug_telegram.send_simple_msg(
-                f"Error sending notification for house {h.get('url_key', 'unknown')}: {error}"
-            )
-            logging.error(*error_msg)
 
+def run_daemon(
+    config: Dict[str, Any],
+    interval: float,
+    jitter: float,
+    metrics_file: Optional[str] = None,
+    leases: Optional[CityLeases] = None,
+) -> None:
+    """
+    Keeps polling in the same process so the Cloudflare-cleared session is reused.
+
+    With `leases`, only the cities leased to this worker are polled, and the
+    leases are renewed before every cycle, over the cities subscribed by then.
 
-def main() -> None:
+    Args:
+        config (Dict[str, Any]): Configuration data as returned by `AppContext.read_config`.
+        interval (float): Seconds between the start of two consecutive cycles.
+        jitter (float): Upper bound of the random delay added to every sleep.
+        metrics_file (Optional[str]): File the metrics are written to after
+            every cycle.
+        leases (Optional[CityLeases]): The leases of this worker when the
+            cities are sharded across several workers.
     """
-    Main function to scrape house data and send notifications via Telegram.
+    logging.info("Starting daemon with interval %ss and jitter %ss", interval, jitter)
+    groups = config["telegram"]["groups"]
+    subscribers = app.get_context().subscriptions
+    with daemon_cycles(config, metrics_file, leases) as cycle:
+        while True:
+            started = time.monotonic()
+            if leases is None:
+                cycle(None)
+            else:
+                subscribers.refresh()
+                leases.cities = list(plan_subscriptions(groups, subscribers))
+                cities = leases.renew()
+                if cities:
+                    cycle(cities)
+
+            elapsed = time.monotonic() - started
+            time.sleep(max(0.0, interval - elapsed) + random.uniform(0, jitter))
+
+
+def run_adaptive_daemon(
+    config: Dict[str, Any],
+    scheduler: PollScheduler,
+    metrics_file: Optional[str] = None,
+) -> None:
     """
-    create_table()
-    config = read_config()
+    Keeps polling in the same process, each city whenever the scheduler says so.
 
-    for group in config["telegram"]["groups"]:
-        cities = group["cities"]
-        chat_id = group["chat_id"]
-        if chat_id is None:
-            raise ValueError("Chat ID is not set for one of the groups in the config")
+    Args:
+        config (Dict[str, Any]): Configuration data as returned by `AppContext.read_config`.
+        scheduler (PollScheduler): Decides when to poll which cities.
+        metrics_file (Optional[str]): File the metrics are written to after
+            every cycle.
+    """
+    logging.info(
+        "Starting adaptive daemon with a budget of %s requests per day",
+        scheduler.requests_per_day,
+    )
+    groups = config["telegram"]["groups"]
+    subscribers = app.get_context().subscriptions
+    with daemon_cycles(config, metrics_file) as cycle:
+        while True:
+            subscribers.refresh()
+            scheduler.update_subscriptions(plan_subscriptions(groups, subscribers))
+            scheduler.refresh()
+            cities, wait = scheduler.due()
+            if not cities:
+                time.sleep(wait)
+                continue
 
-        if TELEGRAM_API_KEY is None:
-            raise ValueError("Telegram API key is not set in environment variables")
+            scheduler.polled(cities)
+            cycle(cities)
 
-        telegram = TelegramBot(apikey=TELEGRAM_API_KEY, chat_id=chat_id)
-        # Scrape house data for the specified cities
-        houses_in_cities = scrape(cities=cities)
 
-        for city_id, houses in houses_in_cities.items():
-            # Synchronize houses with the database and get new houses
-            new_houses = sync_houses(city_id=city_id, houses=houses)
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments.
+
+    Args:
+        argv (Optional[List[str]]): Arguments to parse, defaults to `sys.argv`.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Holland2Stay Telegram notifier")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and poll periodically instead of exiting after one cycle",
+    )
+    parser.add_argument(
+        "--interval", type=float, help="seconds between polls in daemon mode"
+    )
+    parser.add_argument(
+        "--jitter", type=float, help="maximum random delay added to every poll"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="in daemon mode, poll often when listings usually appear and rarely otherwise",
+    )
+    parser.add_argument(
+        "--shard",
+        action="store_true",
+        help="in daemon mode, share the cities with other workers using the same database",
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="ID of this worker when sharding, defaults to the host name and PID",
+    )
+    parser.add_argument(
+        "--commands",
+        action="store_true",
+        help="in daemon mode, let chats /subscribe to cities by messaging the bot",
+    )
+    parser.add_argument(
+        "--api-port",
+        type=int,
+        help="serve the read-only listings API on this local port",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on this local port",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="write Prometheus metrics to this file after every cycle",
+    )
+    return parser.parse_args(argv)
 
-            # Process and send notifications for new houses
-            process_house_notifications(telegram, new_houses)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Main function to scrape house data and send notifications via Telegram.
+    """
+    args = parse_args(argv)
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    context = AppContext.from_env()
+    app.set_context(context)
+    create_table()
+    config = context.read_config()
+    check_chat_ids(config["telegram"]["groups"])
+
+    daemon_config = config.get("daemon", {})
+    interval = (
+        args.interval
+        if args.interval is not None
+        else daemon_config.get("interval", DEFAULT_POLL_INTERVAL)
+    )
+    jitter = (
+        args.jitter
+        if args.jitter is not None
+        else daemon_config.get("jitter", DEFAULT_POLL_JITTER)
+    )
+    adaptive = args.adaptive or daemon_config.get("adaptive")
+    shard = args.shard or daemon_config.get("shard")
+    if args.daemon and adaptive and shard:
+        # The adaptive schedule polls every subscribed city, leases or not
+        raise ValueError(
+            "Sharding does not support the adaptive schedule, "
+            "enable only one of adaptive and shard"
+        )
+    if args.metrics_port is not None or args.metrics_file:
+        metrics.enable()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    if args.api_port is not None:
+        # Imported here, only needed with --api-port
+        from h2s_scrapper import api
+
+        api.serve(args.api_port)
+    subscribers = context.subscriptions
+    subscribers.refresh()
+    listener = None
+    if args.daemon and (args.commands or daemon_config.get("commands")):
+        listener = CommandListener(context.debug_bot, subscribers).start()
+    try:
+        if args.daemon and adaptive:
+            subscriptions = plan_subscriptions(
+                config["telegram"]["groups"], subscribers
+            )
+            scheduler = PollScheduler(
+                subscriptions,
+                # Defaults to the load of polling every city at the fixed interval
+                requests_per_day=daemon_config.get(
+                    "requests_per_day", int(len(subscriptions) * DAY_SECONDS / interval)
+                ),
+                min_interval=daemon_config.get("min_interval", DEFAULT_MIN_INTERVAL),
+                max_interval=daemon_config.get("max_interval", DEFAULT_MAX_INTERVAL),
+            )
+            run_adaptive_daemon(config, scheduler, metrics_file=args.metrics_file)
+        elif args.daemon:
+            leases = None
+            if shard:
+                leases = CityLeases(
+                    list(plan_subscriptions(config["telegram"]["groups"], subscribers)),
+                    # Survives a couple of slow cycles before others take over
+                    ttl=daemon_config.get("lease_ttl", 3 * (interval + jitter)),
+                    worker_id=args.worker_id,
+                )
+            run_daemon(
+                config,
+                interval=interval,
+                jitter=jitter,
+                metrics_file=args.metrics_file,
+                leases=leases,
+            )
+        else:
+            timed_cycle(config, metrics_file=args.metrics_file)
+    except KeyboardInterrupt:
+        logging.info("Stopped")
+    finally:
+        if listener is not None:
+            # A daemon thread, no need to wait for its long poll to return
+            listener.stop(timeout=0)
+        context.close()
+        close_connection()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+"""
+Optional runtime metrics.
+
+Stages of a cycle are timed with `span()` and events are counted with `inc()`,
+for example::
+
+    with metrics.span("sync_houses"):
+        ...
+    metrics.inc("houses_new_total", len(new_houses), city=city_id)
+
+Both are no-ops until `enable()` is called, so the instrumentation costs next to
+nothing when metrics are turned off. The collected values are rendered in the
+Prometheus text format, served over HTTP by `serve()` or written to a file by
+`write_file()`.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING, Dict, Iterator, List, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+PREFIX = "h2s_"
+
+# Upper bounds, in seconds, of the buckets of the stage duration histogram
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_enabled = False
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = {}
+# Stage -> per-bucket counts (the last one for +Inf), sum and count
+_spans: Dict[str, Tuple[List[int], List[float]]] = {}
+
+_NOOP = nullcontext()
+
+
+def enable() -> None:
+    """
+    Starts collecting metrics.
+    """
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    """Whether metrics are being collected."""
+    return _enabled
+
+
+def reset() -> None:
+    """
+    Drops all values collected so far.
+    """
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+
+
+def inc(name: str, value: float = 1.0, **labels: str) -> None:
+    """
+    Increases a counter.
+
+    Args:
+        name (str): The counter name without prefix, ending in `_total`.
+        value (float): The amount to add.
+        **labels (str): Label values of the series to increase.
+    """
+    if not _enabled:
+        return
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def observe(stage: str, seconds: float) -> None:
+    """
+    Records the duration of a stage.
+
+    Args:
+        stage (str): The stage name.
+        seconds (float): How long it took.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        buckets, totals = _spans.setdefault(
+            stage, ([0] * (len(SPAN_BUCKETS) + 1), [0.0, 0.0])
+        )
+        buckets[bisect.bisect_left(SPAN_BUCKETS, seconds)] += 1
+        totals[0] += seconds
+        totals[1] += 1
+
+
+def span(stage: str):
+    """
+    Times the enclosed block as a stage, see `observe`.
+
+    Args:
+        stage (str): The stage name.
+
+    Returns:
+        A context manager, shared and doing nothing while metrics are disabled.
+    """
+    if not _enabled:
+        return _NOOP
+    return _timed(stage)
+
+
+@contextmanager
+def _timed(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def render() -> str:
+    """
+    Renders all collected values in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics page.
+    """
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        spans = sorted(
+            (stage, list(buckets), list(totals))
+            for stage, (buckets, totals) in _spans.items()
+        )
+
+    previous = None
+    for (name, labels), value in counters:
+        if name != previous:
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            previous = name
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value:g}")
+
+    if spans:
+        name = f"{PREFIX}stage_seconds"
+        lines.append(f"# TYPE {name} histogram")
+    for stage, buckets, (total, count) in spans:
+        cumulative = 0
+        for bound, bucket in zip(SPAN_BUCKETS + (float("inf"),), buckets):
+            cumulative += bucket
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            labels = _format_labels((("stage", stage), ("le", le)))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels((("stage", stage),))
+        lines.append(f"{name}_sum{labels} {total:.6f}")
+        lines.append(f"{name}_count{labels} {count:g}")
+    return "\n".join(lines) + "\n"
+
+
+def write_file(path: str) -> None:
+    """
+    Writes the metrics page to a file, e.g. for node_exporter's textfile collector.
+
+    Args:
+        path (str): The file to (atomically) replace.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"Error writing metrics to {path}: {e}")
+
+
+def serve(port: int, host: str = "127.0.0.1") -> "ThreadingHTTPServer":
+    """
+    Serves the metrics page on `/metrics` from a background thread.
+
+    Args:
+        port (int): The port to listen on.
+        host (str): The address to bind, local only by default.
+
+    Returns:
+        ThreadingHTTPServer: The running server, stopped with `shutdown()`.
+    """
+    # Imported here, the HTTP server modules are only needed with --metrics-port
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+            # Scrapes every few seconds would otherwise flood stderr
+            pass
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
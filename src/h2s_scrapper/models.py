@@ -0,0 +1,134 @@
+import hashlib
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, List, Optional
+
+# Kinds of rows in the house_events table
+EVENT_LISTED = "listed"
+EVENT_CHANGED = "changed"
+EVENT_OCCUPIED = "occupied"
+
+# Delivery states of rows in the notification_outbox table
+OUTBOX_PENDING = "pending"
+OUTBOX_SENT = "sent"
+OUTBOX_FAILED = "failed"
+
+
+def to_float(value: Any) -> Optional[float]:
+    """
+    Converts an API number, possibly a string with a decimal comma, to a float.
+
+    Args:
+        value (Any): The raw value.
+
+    Returns:
+        Optional[float]: The number, or None if the value is missing or invalid.
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return float(str(value).replace(",", "."))
+    except ValueError:
+        return None
+
+
+def to_iso_date(value: Any) -> Optional[str]:
+    """
+    Converts an API date or datetime string to an ISO date (YYYY-MM-DD).
+
+    Args:
+        value (Any): The raw value, e.g. "2024-10-01 00:00:00".
+
+    Returns:
+        Optional[str]: The ISO date, or None if the value is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(str(value)[:10]).isoformat()
+    except ValueError:
+        return None
+
+
+@dataclass(slots=True)
+class House:
+    """
+    A listing as parsed once from the GraphQL API and stored in the houses table.
+    """
+
+    url_key: str
+    city: str
+    area: Optional[float]
+    price_exc: Optional[float]
+    price_inc: Optional[float]
+    available_from: Optional[str]
+    max_register: str
+    contract_type: str
+    rooms: str
+    images: List[str] = field(default_factory=list)
+
+    @property
+    def price_per_m2(self) -> Optional[float]:
+        """The price including service costs per square meter, if known."""
+        if not self.area or self.price_inc is None:
+            return None
+        return self.price_inc / self.area
+
+    @property
+    def content_hash(self) -> int:
+        """
+        A compact 64-bit fingerprint of the fields that can change between polls.
+
+        Stored as a signed integer so that it fits an SQLite INTEGER column.
+        """
+        content = (
+            self.area,
+            self.price_exc,
+            self.price_inc,
+            self.available_from,
+            self.max_register,
+            self.contract_type,
+            self.rooms,
+        )
+        digest = hashlib.blake2b(repr(content).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+
+@dataclass(slots=True)
+class HouseEvent:
+    """
+    A row of the house_events change feed, see `db.events_since`.
+    """
+
+    id: int
+    house_id: int
+    url_key: str
+    city: str
+    event: str
+    price_inc: Optional[float]
+    prev_price_inc: Optional[float]
+    available_from: Optional[str]
+    prev_available_from: Optional[str]
+    created_at: str
+
+    @property
+    def is_price_drop(self) -> bool:
+        """Whether this event lowered the price of a listing."""
+        return (
+            self.event == EVENT_CHANGED
+            and self.price_inc is not None
+            and self.prev_price_inc is not None
+            and self.price_inc < self.prev_price_inc
+        )
+
+
+@dataclass(slots=True)
+class Notification:
+    """
+    A claimed row of the notification outbox, see `db.claim_notifications`.
+    """
+
+    id: int
+    chat_id: str
+    attempts: int
+    house: House
@@ -0,0 +1,351 @@
+"""
+Delivery of the notification outbox.
+
+`main.run_cycle` queues the notifications of new houses in the
+`notification_outbox` table, in the same transaction that inserts the houses.
+`drain_outbox` claims them in batches, sends them and records per notification
+whether Telegram accepted it. Failed sends are retried with exponential backoff
+and given up on when Telegram rejects them for good, e.g. because the bot was
+removed from the chat. A notification whose outcome was not recorded, because
+the process died while sending it, is sent again once its claim expires.
+
+Text notifications of the same chat that are sent together are coalesced into
+digests: as few messages as fit Telegram's length limit, ordered by price or
+availability. With a digest window (see `db.enqueue_notifications`) a whole
+burst of releases thus costs a handful of API calls per chat instead of one per
+listing.
+
+In daemon mode an `OutboxWorker` drains the outbox on a background thread, so
+the next poll does not wait for the Telegram rate limits.
+"""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from h2s_scrapper import app, metrics
+from h2s_scrapper.analytics import MarketStats
+from h2s_scrapper.db import (
+    claim_notifications,
+    close_connection,
+    finish_notifications,
+)
+from h2s_scrapper.models import House, Notification
+from h2s_scrapper.resilience import RETRY_STATUS_CODES
+from h2s_scrapper.scrape import fetch_house_details, house_to_msg
+from h2s_scrapper.telegram import TelegramDispatcher
+
+# Notifications claimed and sent at once
+BATCH_SIZE = 100
+# Seconds a claim lasts, long enough to send a batch within the rate limits
+CLAIM_LEASE = 600.0
+# Retry policy of failed sends: base * 2**attempts seconds, at most `cap`
+MAX_ATTEMPTS = 8
+RETRY_BASE = 30.0
+RETRY_CAP = 3600.0
+# Seconds between two drains of the worker when nothing wakes it up, which is
+# when retries and notifications queued by other processes get picked up
+DRAIN_INTERVAL = 30.0
+
+# Orders of the listings in a digest, selected per group with "digest_order"
+DIGEST_ORDERS: Dict[str, Callable[[House], Any]] = {
+    "price": lambda house: (house.price_inc is None, house.price_inc or 0.0),
+    "available_from": lambda house: (
+        house.available_from is None,
+        house.available_from or "",
+    ),
+}
+DEFAULT_DIGEST_ORDER = "price"
+
+
+def notification_text(house: House, market: Optional[MarketStats] = None) -> str:
+    """
+    Formats a house, compared with the market when the statistics are loaded.
+    """
+    if market is None or not market.is_loaded:
+        return house_to_msg(house)
+    return house_to_msg(house, market.cheaper_than(house))
+
+
+def render_digests(
+    notifications: List[Notification],
+    order: str = DEFAULT_DIGEST_ORDER,
+    market: Optional[MarketStats] = None,
+) -> List[Tuple[str, List[Notification]]]:
+    """
+    Renders the notifications of one chat into as few messages as possible.
+
+    Args:
+        notifications (List[Notification]): The notifications to render.
+        order (str): How to sort the listings, a key of `DIGEST_ORDERS`.
+        market (Optional[MarketStats]): Compares the prices with the history.
+
+    Returns:
+        List[Tuple[str, List[Notification]]]: The message texts, each with the
+        notifications it contains.
+    """
+    key = DIGEST_ORDERS[order]
+    digests: List[Tuple[str, List[Notification]]] = []
+    texts: List[str] = []
+    members: List[Notification] = []
+    length = 0
+    for n in sorted(notifications, key=lambda n: key(n.house)):
+        text = notification_text(n.house, market)
+        # Listings are separated by a newline, which counts as well
+        if members and length + 1 + len(text) > app.MAX_MESSAGE_LENGTH:
+            digests.append(("\n".join(texts), members))
+            texts, members, length = [], [], 0
+        length += len(text) + (1 if members else 0)
+        texts.append(text)
+        members.append(n)
+    if members:
+        digests.append(("\n".join(texts), members))
+    return digests
+
+
+def process_house_notifications(
+    dispatcher: TelegramDispatcher,
+    notifications: List[Notification],
+    image_chat_ids: FrozenSet[str] = frozenset(),
+    digest_orders: Optional[Dict[str, str]] = None,
+) -> List[Tuple[Notification, Optional[Any]]]:
+    """
+    Sends notifications for new houses, the text ones of a chat as digests.
+
+    Args:
+        dispatcher (TelegramDispatcher): The dispatcher used to send notifications.
+        notifications (List[Notification]): The notifications to send.
+        image_chat_ids (FrozenSet[str]): Chats that get the photos of a house
+            with the details as caption, instead of a text message.
+        digest_orders (Optional[Dict[str, str]]): Chat IDs mapped to the order
+            of their digests, `DEFAULT_DIGEST_ORDER` for the others.
+
+    Returns:
+        List[Tuple[Notification, Optional[Any]]]: Every notification with the
+        final API response, or None when it could not be sent.
+    """
+    digest_orders = digest_orders or {}
+    market = app.get_context().market
+    per_chat: Dict[str, List[Notification]] = {}
+    media_notifications = []
+    for n in notifications:
+        if n.chat_id in image_chat_ids and n.house.images:
+            media_notifications.append(n)
+        else:
+            per_chat.setdefault(n.chat_id, []).append(n)
+
+    digests = [
+        (chat_id, digest)
+        for chat_id, chat_notifications in per_chat.items()
+        for digest in render_digests(
+            chat_notifications,
+            digest_orders.get(chat_id, DEFAULT_DIGEST_ORDER),
+            market,
+        )
+    ]
+    responses = dispatcher.send_messages(
+        [(chat_id, text) for chat_id, (text, _) in digests]
+    )
+    # Every notification shares the outcome of the message it was part of
+    results: List[Tuple[Notification, Optional[Any]]] = [
+        (n, res) for (_, (_, members)), res in zip(digests, responses) for n in members
+    ]
+
+    # One after another, so the first chat uploads the photos and the others
+    # reference the file_ids Telegram returned for them
+    for n in media_notifications:
+        results.append(
+            (
+                n,
+                dispatcher.send_media_group(
+                    n.chat_id, n.house.images, notification_text(n.house, market)
+                ),
+            )
+        )
+
+    for n, res in results:
+        url_key = n.house.url_key
+        if res is None or res.status_code != 200:
+            metrics.inc("notifications_failed_total")
+        else:
+            metrics.inc("notifications_sent_total")
+
+        if res is None:
+            logging.error(
+                "Error sending notification for house %s to %s", url_key, n.chat_id
+            )
+            app.debug(f"Error sending notification for house {url_key} to {n.chat_id}")
+        elif res.status_code != 200:
+            # Check for unsuccessful send attempts
+            logging.error(
+                "Failed to send Telegram notification for %s: %s", url_key, res.text
+            )
+            app.debug(f"Failed to send Telegram notification for {url_key}: {res.text}")
+        else:
+            logging.info("Sent Telegram notification for %s to %s", url_key, n.chat_id)
+    return results
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    Returns the seconds to wait before retrying a send that failed `attempts + 1` times.
+    """
+    return min(RETRY_CAP, RETRY_BASE * 2**attempts)
+
+
+def drain_outbox(
+    dispatcher: TelegramDispatcher,
+    image_chat_ids: FrozenSet[str] = frozenset(),
+    digest_orders: Optional[Dict[str, str]] = None,
+    batch_size: int = BATCH_SIZE,
+) -> int:
+    """
+    Sends all notifications of the outbox that are due, batch by batch.
+
+    Args:
+        dispatcher (TelegramDispatcher): The dispatcher used to send notifications.
+        image_chat_ids (FrozenSet[str]): Chats that get photos, see
+            `process_house_notifications`.
+        digest_orders (Optional[Dict[str, str]]): Orders of the digests, see
+            `process_house_notifications`.
+        batch_size (int): Notifications claimed at once.
+
+    Returns:
+        int: The number of notifications delivered.
+    """
+    delivered = 0
+    while True:
+        notifications = claim_notifications(batch_size, CLAIM_LEASE)
+        if not notifications:
+            return delivered
+
+        try:
+            # The outbox only stores the listing, fetch the photos where they are sent
+            with metrics.span("house_details"):
+                fetch_house_details(
+                    list(
+                        {
+                            n.house.url_key: n.house
+                            for n in notifications
+                            if n.chat_id in image_chat_ids
+                        }.values()
+                    )
+                )
+
+            with metrics.span("notify"):
+                results = process_house_notifications(
+                    dispatcher, notifications, image_chat_ids, digest_orders
+                )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            # Counted as a failed attempt of the whole batch, so that a
+            # notification that keeps breaking the drain is given up on instead
+            # of being claimed again whenever its lease expires
+            logging.exception("Sending a batch of the outbox failed: %s", error)
+            app.debug(f"Sending a batch of the outbox failed: {error}")
+            metrics.inc("notifications_failed_total", len(notifications))
+            finish_notifications(
+                [],
+                [
+                    (
+                        n.id,
+                        f"error: {error}",
+                        retry_delay(n.attempts)
+                        if n.attempts + 1 < MAX_ATTEMPTS
+                        else None,
+                    )
+                    for n in notifications
+                ],
+            )
+            continue
+
+        sent = []
+        failed = []
+        for n, res in results:
+            if res is not None and res.status_code == 200:
+                sent.append(n.id)
+                continue
+            error = "no response" if res is None else f"{res.status_code}: {res.text}"
+            retryable = res is None or res.status_code in RETRY_STATUS_CODES
+            if retryable and n.attempts + 1 < MAX_ATTEMPTS:
+                failed.append((n.id, error, retry_delay(n.attempts)))
+                metrics.inc("notifications_retried_total")
+            else:
+                failed.append((n.id, error, None))
+        finish_notifications(sent, failed)
+        delivered += len(sent)
+
+
+class OutboxWorker:
+    def __init__(
+        self,
+        dispatcher: TelegramDispatcher,
+        image_chat_ids: FrozenSet[str] = frozenset(),
+        digest_orders: Optional[Dict[str, str]] = None,
+        interval: float = DRAIN_INTERVAL,
+    ):
+        """
+        Initializes a worker that drains the outbox on a background thread.
+
+        It drains whenever `wake` is called and at least every `interval` seconds.
+
+        Args:
+            dispatcher (TelegramDispatcher): The dispatcher used to send
+                notifications; only the worker may use it while it runs.
+            image_chat_ids (FrozenSet[str]): Chats that get photos, see
+                `process_house_notifications`.
+            digest_orders (Optional[Dict[str, str]]): Orders of the digests, see
+                `process_house_notifications`.
+            interval (float): Seconds between two drains without a wake-up.
+        """
+        self.dispatcher = dispatcher
+        self.image_chat_ids = image_chat_ids
+        self.digest_orders = digest_orders
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="outbox-worker", daemon=True
+        )
+
+    def start(self) -> "OutboxWorker":
+        """
+        Starts the background thread, which drains right away.
+        """
+        self._wake.set()
+        self._thread.start()
+        return self
+
+    def wake(self) -> None:
+        """
+        Makes the worker drain the outbox now, e.g. after new notifications were queued.
+        """
+        self._wake.set()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stops the worker once the drain in progress, if any, is done.
+
+        Args:
+            timeout (Optional[float]): Seconds to wait for the thread to end.
+        """
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                if self._stopped.is_set():
+                    break
+                try:
+                    drain_outbox(
+                        self.dispatcher, self.image_chat_ids, self.digest_orders
+                    )
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    # The notifications stay queued, the next drain retries them
+                    logging.exception("Draining the outbox failed: %s", error)
+                    app.debug(f"Draining the outbox failed: {error}")
+        finally:
+            close_connection()
@@ -0,0 +1,166 @@
+"""
+Retry and circuit breaking for the calls to the Holland2Stay API.
+
+Transient failures (timeouts, dropped connections, 5xx answers) are retried
+with jittered exponential backoff, see `backoff_delays`. Being blocked by
+Cloudflare is not transient: every retry would solve yet another challenge and
+make the block last longer, so a `CircuitBreaker` stops all requests for a
+while once challenges keep failing.
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Iterator, Optional
+
+import requests
+
+from h2s_scrapper import metrics
+
+# HTTP statuses worth retrying, Cloudflare's 403/503 are handled separately
+RETRY_STATUS_CODES = {429, 500, 502, 504}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    """
+
+
+def backoff_delays(
+    retries: int, base: float = 1.0, cap: float = 30.0
+) -> Iterator[float]:
+    """
+    Yields the waits before each retry: exponential backoff with full jitter.
+
+    Args:
+        retries (int): Number of retries, i.e. delays yielded.
+        base (float): Upper bound of the first delay, in seconds.
+        cap (float): Upper bound of any delay, in seconds.
+    """
+    for attempt in range(retries):
+        yield random.uniform(0, min(cap, base * 2**attempt))
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Tells whether a failed request is worth retrying.
+
+    Args:
+        error (Exception): The error the request failed with.
+
+    Returns:
+        bool: True for timeouts, connection errors and retryable HTTP statuses.
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = error.response
+        return response is not None and response.status_code in RETRY_STATUS_CODES
+    return isinstance(
+        error,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 300.0,
+        max_reset_timeout: float = 3600.0,
+    ):
+        """
+        Initializes a closed circuit breaker.
+
+        After `failure_threshold` failures in a row the breaker opens and
+        rejects every call for `reset_timeout` seconds. Then a single trial
+        call is let through: a success closes the breaker, a failure opens it
+        again for twice as long, up to `max_reset_timeout`.
+
+        Args:
+            name (str): Name used in logs and metrics.
+            failure_threshold (int): Consecutive failures that open the breaker.
+            reset_timeout (float): Seconds the breaker first stays open.
+            max_reset_timeout (float): Upper bound of the open time.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls are currently rejected."""
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_call(self) -> None:
+        """
+        Lets a call through, or rejects it.
+
+        Raises:
+            CircuitOpenError: While the breaker is open, or a trial call of a
+                half-open breaker is still running.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self._timeout - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise CircuitOpenError(
+                    f"{self.name} circuit is open, retrying in {max(0, remaining):.0f}s"
+                )
+            self._trial_running = True
+
+    def record_success(self) -> None:
+        """
+        Closes the breaker after a successful call.
+        """
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("%s circuit closed", self.name)
+            self._failures = 0
+            self._timeout = self.reset_timeout
+            self._opened_at = None
+            self._trial_running = False
+
+    def release(self) -> None:
+        """
+        Ends a call that failed for a reason unrelated to what the breaker
+        guards, so a pending trial does not keep the breaker open for good.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        """
+        Counts a failed call, opening the breaker once there were enough.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._trial_running:
+                # The trial failed, stay away for longer
+                self._timeout = min(self.max_reset_timeout, self._timeout * 2)
+            elif self._opened_at is not None or self._failures < self.failure_threshold:
+                return
+            self._opened_at = time.monotonic()
+            self._trial_running = False
+            logging.warning(
+                "%s circuit opened for %.0fs after %s failures",
+                self.name,
+                self._timeout,
+                self._failures,
+            )
+        metrics.inc("circuit_opened_total", circuit=self.name)
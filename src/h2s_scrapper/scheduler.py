@@ -0,0 +1,238 @@
+"""
+Adaptive polling schedule.
+
+Holland2Stay releases units in bursts at recurring times of day. `PollScheduler`
+learns these windows from when houses were first seen (`created_at` in the
+houses table) and spreads a daily request budget accordingly: cities are polled
+every few seconds in the slots where new listings usually appear and back off
+to `max_interval` elsewhere.
+
+The budget is split with the square-root rule, which minimises the expected
+detection latency: a city is polled in a slot at a rate proportional to
+``sqrt(subscribers * release probability)``, clamped between `max_interval`
+and `min_interval`. Cities due at the same time are fetched together.
+"""
+
+import logging
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from h2s_scrapper.db import release_history
+
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOT_SECONDS = SLOT_MINUTES * 60
+DAY_SECONDS = 24 * 60 * 60
+
+# Days of created_at history the windows are learned from
+HISTORY_DAYS = 28
+# Seconds between two reloads of the history
+REFRESH_INTERVAL = 3600.0
+# A slot next to a release window gets this share of the window's probability,
+# so polling already speeds up shortly before and stays fast shortly after
+NEIGHBOUR_SHARE = 0.5
+# Release probability assumed for every slot, so that quiet slots keep a share
+# of the budget and an empty history spreads it evenly over the day
+BASE_PROBABILITY = 0.01
+
+
+class PollScheduler:
+    def __init__(
+        self,
+        subscriptions: Dict[str, List[str]],
+        requests_per_day: int,
+        min_interval: float = 5.0,
+        max_interval: float = 300.0,
+    ):
+        """
+        Initializes the scheduler; it polls every city at `max_interval` until
+        `learn` or `refresh` spread the budget.
+
+        Args:
+            subscriptions (Dict[str, List[str]]): City IDs mapped to the chat IDs
+                that watch them, see `main.plan_subscriptions`. The number of
+                chats is the priority of the city.
+            requests_per_day (int): Upper bound on the city polls per day; polls
+                of several cities in one request count once per city.
+            min_interval (float): Shortest time between two polls of a city.
+            max_interval (float): Longest time between two polls of a city.
+        """
+        self.priorities = {city: len(chats) for city, chats in subscriptions.items()}
+        self.requests_per_day = requests_per_day
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # City -> seconds between polls in every slot of the day
+        self.intervals: Dict[str, List[float]] = {
+            city: [max_interval] * SLOTS_PER_DAY for city in self.priorities
+        }
+        self._last_polled: Dict[str, float] = {}
+        self._recent_polls: Deque[float] = deque()
+        self._refreshed_at: Optional[float] = None
+
+    def update_subscriptions(self, subscriptions: Dict[str, List[str]]) -> None:
+        """
+        Follows changes of the subscriptions. New cities are polled at
+        `max_interval` until the windows are relearned by the next `refresh`.
+
+        Args:
+            subscriptions (Dict[str, List[str]]): City IDs mapped to the chat IDs
+                that watch them, see `main.plan_subscriptions`.
+        """
+        priorities = {city: len(chats) for city, chats in subscriptions.items()}
+        if priorities == self.priorities:
+            return
+        self.priorities = priorities
+        self.intervals = {
+            city: self.intervals.get(city, [self.max_interval] * SLOTS_PER_DAY)
+            for city in priorities
+        }
+        self._refreshed_at = None
+
+    def refresh(self, now: Optional[float] = None) -> None:
+        """
+        Relearns the release windows from the database, at most every
+        `REFRESH_INTERVAL` seconds.
+        """
+        now = time.time() if now is None else now
+        if (
+            self._refreshed_at is not None
+            and now - self._refreshed_at < REFRESH_INTERVAL
+        ):
+            return
+        self._refreshed_at = now
+        self.learn(release_history(SLOT_MINUTES, HISTORY_DAYS), HISTORY_DAYS)
+
+    def learn(self, history: Dict[str, Dict[int, int]], days: int) -> None:
+        """
+        Computes the polling interval of every city in every slot.
+
+        Args:
+            history (Dict[str, Dict[int, int]]): City IDs mapped to slot numbers
+                and the number of days with new houses in them, see
+                `db.release_history`.
+            days (int): The number of days the history covers.
+        """
+        demand: Dict[str, List[float]] = {}
+        for city, priority in self.priorities.items():
+            release_days = history.get(city, {})
+            probability = [
+                min(1.0, release_days.get(slot, 0) / days)
+                for slot in range(SLOTS_PER_DAY)
+            ]
+            smoothed = [
+                max(
+                    probability[slot],
+                    NEIGHBOUR_SHARE * probability[slot - 1],
+                    NEIGHBOUR_SHARE * probability[(slot + 1) % SLOTS_PER_DAY],
+                )
+                for slot in range(SLOTS_PER_DAY)
+            ]
+            demand[city] = [
+                math.sqrt(priority * (BASE_PROBABILITY + p)) for p in smoothed
+            ]
+
+        scale = self._budget_scale(demand)
+        self.intervals = {
+            city: [1 / self._rate(scale * d) for d in city_demand]
+            for city, city_demand in demand.items()
+        }
+        fastest = min(
+            (min(intervals) for intervals in self.intervals.values()),
+            default=self.max_interval,
+        )
+        logging.info(
+            "Learned polling windows, fastest interval %.1fs, %.0f polls per day",
+            fastest,
+            self._polls_per_day(demand, scale),
+        )
+
+    def _rate(self, rate: float) -> float:
+        return min(1 / self.min_interval, max(1 / self.max_interval, rate))
+
+    def _polls_per_day(self, demand: Dict[str, List[float]], scale: float) -> float:
+        return sum(
+            SLOT_SECONDS * self._rate(scale * d)
+            for city_demand in demand.values()
+            for d in city_demand
+        )
+
+    def _budget_scale(self, demand: Dict[str, List[float]]) -> float:
+        # The largest scale of the square-root rule that fits the budget
+        positive = [d for city_demand in demand.values() for d in city_demand if d > 0]
+        if not positive:
+            return 0.0
+        if self._polls_per_day(demand, 0.0) > self.requests_per_day:
+            logging.warning(
+                "A budget of %s requests per day cannot even poll every %ss",
+                self.requests_per_day,
+                self.max_interval,
+            )
+            return 0.0
+
+        low, high = 0.0, (1 / self.min_interval) / min(positive)
+        if self._polls_per_day(demand, high) <= self.requests_per_day:
+            return high
+        for _ in range(50):
+            middle = (low + high) / 2
+            if self._polls_per_day(demand, middle) <= self.requests_per_day:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    @staticmethod
+    def slot(now: float) -> int:
+        """The slot of the day (in UTC) a UNIX time falls into."""
+        return int(now % DAY_SECONDS) // SLOT_SECONDS
+
+    def due(self, now: Optional[float] = None) -> Tuple[List[str], float]:
+        """
+        Decides which cities to poll now.
+
+        A city is due once its interval in the current slot has passed since
+        its last poll, never earlier; all cities due at that time share the
+        request.
+
+        Args:
+            now (Optional[float]): The current UNIX time.
+
+        Returns:
+            Tuple[List[str], float]: The cities to poll now, possibly none, and the
+            seconds to wait before asking again.
+        """
+        now = time.time() if now is None else now
+        while self._recent_polls and now - self._recent_polls[0] >= DAY_SECONDS:
+            self._recent_polls.popleft()
+        if len(self._recent_polls) >= self.requests_per_day:
+            # Spent the budget of the last 24 hours, wait for the oldest poll to expire
+            return [], self._recent_polls[0] + DAY_SECONDS - now
+
+        slot = self.slot(now)
+        next_due = {
+            city: self._last_polled.get(city, -math.inf) + intervals[slot]
+            for city, intervals in self.intervals.items()
+        }
+        cities = sorted(
+            (city for city, due_at in next_due.items() if due_at <= now),
+            key=lambda city: -self.priorities[city],
+        )
+        budget_left = self.requests_per_day - len(self._recent_polls)
+        cities = cities[:budget_left]
+        if cities:
+            return cities, 0.0
+
+        wait = min(next_due.values(), default=now + self.max_interval) - now
+        # Wake up at the latest when the next slot starts, it may be a faster one
+        next_slot = (now // SLOT_SECONDS + 1) * SLOT_SECONDS
+        return [], max(0.0, min(wait, next_slot - now))
+
+    def polled(self, cities: List[str], now: Optional[float] = None) -> None:
+        """
+        Records that the given cities were just polled.
+        """
+        now = time.time() if now is None else now
+        for city in cities:
+            self._last_polled[city] = now
+            self._recent_polls.append(now)
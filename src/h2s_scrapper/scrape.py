@@ -1,39 +1,122 @@
+import codecs
+import hashlib
+import json
 import logging
-import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
 
-import cloudscraper
 import requests
 
-from h2s_scrapper.telegram import TelegramBot
+from h2s_scrapper import app, metrics
+from h2s_scrapper.models import House, to_float, to_iso_date
+from h2s_scrapper.resilience import CircuitBreaker, backoff_delays, is_transient
 from h2s_scrapper.utils import setup_logger
 
-# Load environment variables using os and ensure they are not None
-TELEGRAM_API_KEY = os.getenv("TELEGRAM_API_KEY")
-DEBUGGING_CHAT_ID = os.getenv("DEBUGGING_CHAT_ID")
+if TYPE_CHECKING:
+    import cloudscraper
 
-if TELEGRAM_API_KEY is None:
-    raise ValueError("TELEGRAM_API_KEY environment variable is not set")
-if DEBUGGING_CHAT_ID is None:
-    raise ValueError("DEBUGGING_CHAT_ID environment variable is not set")
 logger = setup_logger("h2s_scrapper")
-debug_telegram = TelegramBot(apikey=TELEGRAM_API_KEY, chat_id=DEBUGGING_CHAT_ID)
 
-
-def generate_payload(cities, page_size):
-    payload = {
-        "operationName": "GetCategories",
-        "variables": {
-            "currentPage": 1,
-            "id": "Nw==",
-            "filters": {
-                "available_to_book": {"in": ["179", "336"]},
-                "city": {"in": cities},
-                "category_uid": {"eq": "Nw=="},
-            },
-            "pageSize": page_size,
-            "sort": {"available_startdate": "ASC"},
-        },
-        "query": """
+GRAPHQL_URL = "https://api.holland2stay.com/graphql/"
+
+# Status codes Cloudflare answers with once the clearance cookies stop being accepted
+CHALLENGE_STATUS_CODES = {403, 503}
+
+# Upper bound on the pages requested concurrently after the first one
+MAX_PAGE_WORKERS = 4
+
+# Seconds to connect and between two reads of the body
+FETCH_TIMEOUT = (5, 30)
+# Retries of a page after a transient failure, see `resilience.backoff_delays`
+MAX_FETCH_RETRIES = 3
+# Refetches of all pages when they add up to fewer products than `total_count`
+MAX_INCOMPLETE_RETRIES = 2
+
+
+class CloudflareChallengeError(requests.exceptions.RequestException):
+    """
+    Raised when cloudscraper cannot solve the Cloudflare challenge. Wraps its
+    own exception, so callers need not import cloudscraper to catch it.
+    """
+
+
+class IncompleteResultError(ValueError):
+    """
+    Raised when the pages of a listing do not add up to its `total_count`, e.g.
+    because listings moved between pages while they were fetched.
+    """
+
+
+# Bytes read from the socket at a time while a response is parsed
+STREAM_CHUNK_SIZE = 64 * 1024
+# Where the product array starts in a response, see `ProductStream`
+PRODUCTS_PATTERN = re.compile(r'"products"\s*:\s*\{')
+ITEMS_PATTERN = re.compile(r'"items"\s*:\s*\[')
+
+
+class ScraperSession:
+    """
+    Holds one cloudscraper session, and with it the Cloudflare clearance cookies,
+    so that consecutive polls skip the TLS handshake and the challenge solve.
+    """
+
+    def __init__(self, browser: str = "chrome"):
+        self.browser = browser
+        self._scraper: Optional["cloudscraper.CloudScraper"] = None
+        self._fresh = False
+        self._lock = threading.Lock()
+
+    def get(self) -> "cloudscraper.CloudScraper":
+        """Returns the current session, creating it on first use."""
+        with self._lock:
+            if self._scraper is None:
+                # Imported on first use, it pulls in a large dependency tree
+                import cloudscraper
+
+                self._scraper = cloudscraper.create_scraper(browser=self.browser)
+                self._fresh = True
+                logging.info("Created new cloudscraper session")
+            return self._scraper
+
+    def take_fresh(self, scraper: "cloudscraper.CloudScraper") -> bool:
+        """
+        Tells whether `scraper` is a new session that did not send a request yet,
+        i.e. whether the next request will have to solve the Cloudflare challenge.
+        """
+        with self._lock:
+            fresh = self._fresh and scraper is self._scraper
+            if fresh:
+                self._fresh = False
+            return fresh
+
+    def reset(self, stale: Optional["cloudscraper.CloudScraper"] = None) -> None:
+        """
+        Drops the current session so the next call solves a fresh challenge.
+
+        Args:
+            stale (Optional[cloudscraper.CloudScraper]): The session that failed. When
+                another thread already replaced it, the newer session is kept.
+        """
+        with self._lock:
+            if self._scraper is None or (
+                stale is not None and stale is not self._scraper
+            ):
+                return
+            self._scraper.close()
+            self._scraper = None
+            metrics.inc("cloudflare_session_resets_total")
+
+
+scraper_session = ScraperSession()
+
+# Opens when fresh sessions keep failing the challenge, i.e. Cloudflare blocks us
+cloudflare_breaker = CircuitBreaker("cloudflare")
+
+
+FULL_QUERY = """
             query GetCategories($id: String!, $pageSize: Int!, $currentPage: Int!, $filters: ProductAttributeFilterInput!, $sort: ProductAttributeSortInput) {
               categories(filters: {category_uid: {in: [$id]}}) {
                 items {
@@ -165,9 +248,78 @@ def generate_payload(cities, page_size):
               total_count
               __typename
             }
-        """,
+        """
+
+# Only the fields needed to detect and store a listing; media and the other
+# details are fetched for new listings only, see `fetch_house_details`
+POLL_QUERY = """
+            query GetProducts($pageSize: Int!, $currentPage: Int!, $filters: ProductAttributeFilterInput!, $sort: ProductAttributeSortInput) {
+              products(
+                pageSize: $pageSize
+                currentPage: $currentPage
+                filter: $filters
+                sort: $sort
+              ) {
+                items {
+                  url_key
+                  city
+                  available_startdate
+                  living_area
+                  no_of_rooms
+                  maximum_number_of_persons
+                  type_of_contract
+                  basic_rent
+                  price_range {
+                    maximum_price {
+                      final_price {
+                        value
+                      }
+                    }
+                  }
+                }
+                page_info {
+                  total_pages
+                }
+                total_count
+              }
+            }
+"""
+
+BASE_FILTERS = {
+    "available_to_book": {"in": ["179", "336"]},
+    "category_uid": {"eq": "Nw=="},
+}
+
+
+def build_payload_template(operation_name, query, **variables):
+    # Whitespace is meaningless to GraphQL, so strip it once instead of per request
+    return {
+        "operationName": operation_name,
+        "variables": {"sort": {"available_startdate": "ASC"}, **variables},
+        "query": " ".join(query.split()),
+    }
+
+
+# Payload templates per query profile, built once at import time
+PAYLOAD_TEMPLATES = {
+    "full": build_payload_template("GetCategories", FULL_QUERY, id="Nw=="),
+    "poll": build_payload_template("GetProducts", POLL_QUERY),
+}
+
+
+def generate_payload(cities, page_size, current_page=1, profile="full", filters=None):
+    template = PAYLOAD_TEMPLATES[profile]
+    if filters is None:
+        filters = {**BASE_FILTERS, "city": {"in": cities}}
+    return {
+        **template,
+        "variables": {
+            **template["variables"],
+            "currentPage": current_page,
+            "filters": filters,
+            "pageSize": page_size,
+        },
     }
-    return payload
 
 
 CITY_IDS = {
@@ -237,6 +389,16 @@ def city_id_to_city(city_id):
     return CITY_IDS.get(city_id)
 
 
+def city_to_city_id(city):
+    # Accept a city ID or a city name, ignoring case; None for unknown cities
+    if city in CITY_IDS:
+        return city
+    for city_id, name in CITY_IDS.items():
+        if name.lower() == city.lower():
+            return city_id
+    return None
+
+
 def contract_type_id_to_str(contract_type_id):
     # Use CONTRACT_TYPES dictionary for contract type lookup
     return CONTRACT_TYPES.get(contract_type_id, "Unknown")
@@ -264,107 +426,453 @@ def clean_img(url):
         ci = parts.index("cache")
         return "/".join(parts[:ci] + parts[ci + 2 :])
     except Exception as error:
-        debug_telegram.send_simple_msg(url)
-        debug_telegram.send_simple_msg(str(error))
+        app.debug(f"Error cleaning image URL {url}: {error}")
 
 
-def house_to_msg(house):
+def format_number(value, fmt=","):
+    return "?" if value is None else format(value, fmt)
+
+
+def house_to_msg(house, cheaper_than=None):
+    """
+    Formats a house as notification text.
+
+    `cheaper_than` is the share in percent of comparable listings that were more
+    expensive per m², see `analytics.MarketStats.cheaper_than`.
+    """
+    comparison = ""
+    if cheaper_than is not None:
+        comparison = f"\nCheaper than {cheaper_than:.0f}% of comparable units"
     return f"""
-New house in #{city_id_to_city(house['city'])}!
-{url_key_to_link(house['url_key'])}
+New house in #{city_id_to_city(house.city)}!
+{url_key_to_link(house.url_key)}
 
-Living area: {house['area']}m²
-Price: {float(house['price_inc'].replace(',', '.')):,}€ (excl. {float(house['price_exc'].replace(',', '.')):,}€ basic rent)
-Price per meter: {float(float(house['price_inc']) / float(house['area'])):.2f} €\\m²
+Living area: {format_number(house.area, "g")}m²
+Price: {format_number(house.price_inc)}€ (excl. {format_number(house.price_exc)}€ basic rent)
+Price per meter: {format_number(house.price_per_m2, ".2f")} €\\m²{comparison}
 
-Available from: {house['available_from']}
-Bedrooms: {house['rooms']}
-Max occupancy: {house['max_register']}
-Contract type: {house['contract_type']}
+Available from: {house.available_from}
+Bedrooms: {house.rooms}
+Max occupancy: {house.max_register}
+Contract type: {house.contract_type}
 
 # See details and apply on Holland2Stay website."""
 
 
-# Define the GraphQL query payload
-def scrape(cities=[], page_size=30):
-    payload = generate_payload(cities, page_size)
+def post_graphql(payload, stream=False):
+    """
+    Posts a GraphQL payload through the shared cloudscraper session.
 
+    With `stream`, the body is left on the socket to be read incrementally.
+
+    The session is only refreshed when a challenge fails again, either because
+    cloudscraper gives up or because Cloudflare rejects the stored clearance with
+    a 403/503; the request is then retried once on a fresh session. When that
+    fails too, `cloudflare_breaker` counts it, and once it opens no request is
+    sent at all until it lets a trial through.
+
+    Raises:
+        CloudflareChallengeError: If the fresh session was rejected as well.
+        resilience.CircuitOpenError: While Cloudflare is considered to block us.
+        requests.exceptions.RequestException: If the request failed otherwise.
+    """
+    cloudflare_breaker.before_call()
+    try:
+        response = _post_graphql(payload, stream)
+    except CloudflareChallengeError:
+        cloudflare_breaker.record_failure()
+        raise
+    except BaseException:
+        # Anything else, e.g. a network error or an interrupt, says nothing
+        # about Cloudflare but must not leave a trial call pending forever
+        cloudflare_breaker.release()
+        raise
+    cloudflare_breaker.record_success()
+    return response
+
+
+def _post_graphql(payload, stream):
+    scraper = scraper_session.get()
     try:
-        scraper = cloudscraper.create_scraper(browser="chrome")
-        response = scraper.post(
-            "https://api.holland2stay.com/graphql/", json=payload, headers=headers
+        response = _timed_post(scraper, payload, stream)
+        if response.status_code not in CHALLENGE_STATUS_CODES:
+            return response
+        response.close()
+        logging.warning(
+            "Cloudflare rejected the session (%s), refreshing it", response.status_code
         )
+    except CloudflareChallengeError as cf_err:
+        logging.warning("Cloudflare challenge failed (%s), refreshing session", cf_err)
+
+    scraper_session.reset(stale=scraper)
+    response = _timed_post(scraper_session.get(), payload, stream)
+    if response.status_code in CHALLENGE_STATUS_CODES:
+        response.close()
+        raise CloudflareChallengeError(
+            f"Cloudflare rejected a fresh session ({response.status_code})",
+            response=response,
+        )
+    return response
+
+
+def _timed_post(scraper, payload, stream):
+    # The first request of a session is the one that solves the challenge
+    stage = (
+        "cloudflare_challenge"
+        if scraper_session.take_fresh(scraper)
+        else "graphql_request"
+    )
+    from cloudscraper.exceptions import CloudflareException
+
+    with metrics.span(stage):
+        try:
+            return scraper.post(
+                GRAPHQL_URL,
+                json=payload,
+                headers=headers,
+                stream=stream,
+                timeout=FETCH_TIMEOUT,
+            )
+        except CloudflareException as cf_err:
+            raise CloudflareChallengeError(str(cf_err)) from cf_err
+
+
+class ProductStream:
+    """
+    Iterates over the products of a GraphQL response while it is downloaded.
+
+    Products are decoded one at a time from the `products.items` array, so the
+    whole body and its tree never have to be held in memory at once, however
+    large the page. Once the items are exhausted, `total_pages` and
+    `total_count` are read from the rest of the response.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self.total_pages = None
+        self.total_count = None
+
+    def _read(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += self._text.decode(chunk)
+                return True
+        self._buffer += self._text.decode(b"", final=True)
+        return False
+
+    def _find_items(self):
+        while True:
+            products = PRODUCTS_PATTERN.search(self._buffer)
+            items = products and ITEMS_PATTERN.search(self._buffer, products.end())
+            if items:
+                self._buffer = self._buffer[items.end() :]
+                return
+            if not self._read():
+                break
+
+        # Not a product listing; the body holds errors, if it is JSON at all
+        try:
+            errors = json.loads(self._buffer).get("errors")
+        except (ValueError, AttributeError):
+            raise ValueError("Response is not a GraphQL result") from None
+        raise ValueError(f"No products in response: {errors}")
+
+    def __iter__(self):
+        self._find_items()
+        decoder = json.JSONDecoder()
+        pos = 0
+        while True:
+            while pos < len(self._buffer) and self._buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(self._buffer):
+                if not self._read():
+                    raise ValueError("Truncated GraphQL response")
+                continue
+            if self._buffer[pos] == "]":
+                break
+            try:
+                product, end = decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                # Most likely the product is cut off at the end of the chunk
+                if not self._read():
+                    raise
+                continue
+            self._buffer = self._buffer[end:]
+            pos = 0
+            yield product
+
+        while self._read():
+            pass
+        tail = self._buffer[pos + 1 :]
+        self.total_pages = _tail_int("total_pages", tail)
+        self.total_count = _tail_int("total_count", tail)
+
+
+def _tail_int(key, text):
+    match = re.search(rf'"{key}"\s*:\s*(\d+)', text)
+    return int(match.group(1)) if match else None
+
+
+def fetch_page(
+    cities, page_size, current_page, profile="full", filters=None, transform=None
+):
+    """
+    Fetches a single page of bookable products for the given cities.
+
+    `profile` selects the query from `PAYLOAD_TEMPLATES`; `filters` replaces the
+    default bookable-in-cities filter. The response is parsed while it streams
+    in, and `transform`, if given, is applied to every product as soon as it is
+    decoded, so that only what it keeps of a product stays in memory.
+
+    Returns:
+        dict: The `products` object of the GraphQL response, with `items`,
+            `page_info.total_pages` and `total_count`.
+
+    Transient failures are retried up to `MAX_FETCH_RETRIES` times with
+    jittered exponential backoff.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails for good,
+            including `CloudflareChallengeError` and `CircuitOpenError`.
+        ValueError: If the body is not JSON or holds no products.
+    """
+    payload = generate_payload(cities, page_size, current_page, profile, filters)
+    delays = backoff_delays(MAX_FETCH_RETRIES)
+    while True:
+        try:
+            return _fetch_page(payload, transform)
+        except requests.exceptions.RequestException as err:
+            delay = next(delays, None) if is_transient(err) else None
+            if delay is None:
+                raise
+            metrics.inc("fetch_retries_total")
+            logging.warning("Fetching page %s failed (%s), retrying", current_page, err)
+            time.sleep(delay)
+
+
+def _fetch_page(payload, transform):
+    with post_graphql(payload, stream=True) as response:
         response.raise_for_status()  # Raise an HTTPError for bad responses
-        json_data = response.json()
+        stream = ProductStream(response.iter_content(STREAM_CHUNK_SIZE))
+        try:
+            # Downloading and decoding the body overlap, they are timed together
+            with metrics.span("graphql_body"):
+                items = [transform(item) if transform else item for item in stream]
+        except ValueError:
+            logger.debug(payload)
+            raise
+
+    return {
+        "items": items,
+        "page_info": {"total_pages": stream.total_pages},
+        "total_count": stream.total_count,
+    }
+
+
+def fetch_products(cities, page_size=30, profile="full", filters=None, transform=None):
+    """
+    Fetches every page of bookable products for the given cities.
+
+    The first page tells how many pages there are; the remaining ones are then
+    requested concurrently. A result is only returned once every page arrived
+    and they add up to the `total_count`, so a partial listing is never
+    mistaken for houses having been taken. Otherwise all pages are fetched
+    again, up to `MAX_INCOMPLETE_RETRIES` times. `transform` is passed on to
+    `fetch_page` and must keep the `url_key`.
+
+    Returns:
+        list: The product items of all pages, deduplicated by `url_key`.
+
+    Raises:
+        IncompleteResultError: If the pages keep missing products.
+        Same as `fetch_page`, for whichever page failed.
+    """
+    for attempt in range(MAX_INCOMPLETE_RETRIES + 1):
+        items, total_count, total_pages = _fetch_pages(
+            cities, page_size, profile, filters, transform
+        )
+        if total_count is None or total_count == len(items):
+            return list(items.values())
+        metrics.inc("incomplete_fetches_total")
+        logging.warning(
+            "Expected %s products over %s pages, got %s (attempt %s)",
+            total_count,
+            total_pages,
+            len(items),
+            attempt + 1,
+        )
+    raise IncompleteResultError(
+        f"Expected {total_count} products over {total_pages} pages, got {len(items)}"
+    )
+
+
+def _fetch_pages(cities, page_size, profile, filters, transform):
+    first_page = fetch_page(cities, page_size, 1, profile, filters, transform)
+    pages = [first_page]
+
+    total_pages = (first_page.get("page_info") or {}).get("total_pages") or 1
+    if total_pages > 1:
+        workers = min(MAX_PAGE_WORKERS, total_pages - 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pages.extend(
+                pool.map(
+                    lambda page: fetch_page(
+                        cities, page_size, page, profile, filters, transform
+                    ),
+                    range(2, total_pages + 1),
+                )
+            )
+
+    # Listings can shift between pages while they are fetched, keep the first copy
+    items = {}
+    for page in pages:
+        for house in page.get("items") or []:
+            items.setdefault(house.get("url_key", ""), house)
+    return items, first_page.get("total_count"), total_pages
+
+
+def house_images(house):
+    cleaned_images = [clean_img(img["url"]) for img in house.get("media_gallery") or []]
+
+    # Filter out specific images
+    return list(filter(lambda x: "logo-blue-1.jpg" not in x, cleaned_images))
+
+
+def parse_house(house):
+    return House(
+        url_key=house.get("url_key", ""),
+        city=str(house.get("city", "")),
+        area=to_float(house.get("living_area")),
+        price_exc=to_float(house.get("basic_rent")),
+        price_inc=to_float(
+            house.get("price_range", {})
+            .get("maximum_price", {})
+            .get("final_price", {})
+            .get("value")
+        ),
+        available_from=to_iso_date(house.get("available_startdate")),
+        max_register=max_register_id_to_str(
+            str(house.get("maximum_number_of_persons", ""))
+        ),
+        contract_type=contract_type_id_to_str(str(house.get("type_of_contract", ""))),
+        rooms=room_id_to_room(str(house.get("no_of_rooms", ""))),
+        images=house_images(house),
+    )
+
+
+def fetch_house_details(houses, page_size=30):
+    """
+    Fills in the images of the given houses with a single "full" profile query.
+
+    Meant for the few houses that turned out to be new, so the polling query can
+    leave out the media. Houses are updated in place; on failure they are left
+    without images and the error is logged.
+    """
+    by_url_key = {house.url_key: house for house in houses}
+    if not by_url_key:
+        return houses
+
+    filters = {**BASE_FILTERS, "url_key": {"in": list(by_url_key)}}
+    try:
+        # Keep only the image URLs of the (large) full products as they stream in
+        items = fetch_products(
+            [],
+            page_size,
+            profile="full",
+            filters=filters,
+            transform=lambda item: {
+                "url_key": item.get("url_key"),
+                "images": house_images(item),
+            },
+        )
+    except (requests.exceptions.RequestException, ValueError) as err:
+        logging.error("Fetching house details failed: %s", err)
+        return houses
+
+    for item in items:
+        house = by_url_key.get(item.get("url_key", ""))
+        if house is not None:
+            house.images = item["images"]
+    return houses
+
+
+def fetch_city_products(cities, page_size=30, profile="poll", extra_filters=None):
+    """
+    Fetches the raw products of the given cities, grouped by city.
+
+    Returns:
+        dict: City IDs mapped to their products, or None if the request failed.
+    """
+    filters = {**BASE_FILTERS, "city": {"in": cities}, **(extra_filters or {})}
+    try:
+        with metrics.span("fetch_products"):
+            items = fetch_products(cities, page_size, profile, filters)
     except requests.exceptions.RequestException as req_err:
-        debug_telegram.send_simple_msg("Request failed!")
-        logger.debug(payload)
-        debug_telegram.send_simple_msg(str(req_err))
+        metrics.inc("fetch_failures_total")
+        app.debug(f"Request failed: {req_err}")
         logging.error("Request failed")
         logging.error(str(req_err))
-        return {}  # Return empty dictionary if the request fails
+        return None
+    except IncompleteResultError as err:
+        # Nothing is synced, so missing listings are not marked as occupied
+        metrics.inc("fetch_failures_total")
+        logging.error("Incomplete result, skipping the cycle: %s", err)
+        return None
     except ValueError as val_err:
-        debug_telegram.send_simple_msg("Error decoding JSON!")
-        debug_telegram.send_simple_msg(str(val_err))
+        metrics.inc("fetch_failures_total")
+        app.debug(f"Error decoding JSON: {val_err}")
         logging.error("Error decoding JSON")
         logging.error(str(val_err))
-        return {}  # Return empty dictionary if JSON decoding fails
-
-    # Initialize cities_dict with city keys
-    cities_dict = {c: [] for c in cities}
-
-    try:
-        data = json_data.get("data", {})
-        products = data.get("products", {})
-        items = products.get("items", [])
-
-        for house in items:
-            city_id = str(house.get("city", ""))
+        return None
+
+    # Initialize products_per_city with city keys
+    products_per_city = {c: [] for c in cities}
+    for house in items:
+        city_id = str(house.get("city", ""))
+        if city_id in products_per_city:
+            products_per_city[city_id].append(house)
+        else:
+            logging.warning("Skipping house %s of unrequested city %s", house, city_id)
+    return products_per_city
+
+
+def city_fingerprint(products):
+    """
+    Fingerprints the raw products of a city: its sorted `url_key`s and a hash of
+    their content. Equal fingerprints mean nothing changed since the last poll.
+    """
+    products = sorted(products, key=lambda house: house.get("url_key", ""))
+    digest = hashlib.blake2b(digest_size=16)
+    for house in products:
+        digest.update(str(house.get("url_key", "")).encode())
+        digest.update(b"\0")
+    digest.update(json.dumps(products, sort_keys=True, separators=(",", ":")).encode())
+    return f"{len(products)}:{digest.hexdigest()}"
+
+
+def parse_houses(products):
+    houses = []
+    with metrics.span("parse_houses"):
+        for house in products:
             try:
-                cleaned_images = [
-                    clean_img(img["url"]) for img in house.get("media_gallery", [])
-                ]
-
-                # Filter out specific images
-                cleaned_images = list(
-                    filter(lambda x: "logo-blue-1.jpg" not in x, cleaned_images)
-                )
-
-                cities_dict[city_id].append(
-                    {
-                        "url_key": house.get("url_key", ""),
-                        "city": city_id,
-                        "area": str(house.get("living_area", "")).replace(",", "."),
-                        "price_exc": str(house.get("basic_rent", "")),
-                        "price_inc": str(
-                            house.get("price_range", {})
-                            .get("maximum_price", {})
-                            .get("final_price", {})
-                            .get("value", "")
-                        ),
-                        "available_from": house.get("available_startdate", ""),
-                        "max_register": str(
-                            max_register_id_to_str(
-                                str(house.get("maximum_number_of_persons", ""))
-                            ),
-                        ),
-                        "contract_type": contract_type_id_to_str(
-                            str(house.get("type_of_contract", ""))
-                        ),
-                        "rooms": room_id_to_room(str(house.get("no_of_rooms", ""))),
-                        "images": cleaned_images,
-                    }
-                )
+                houses.append(parse_house(house))
             except Exception as err:
-                debug_telegram.send_simple_msg("Error in parsing house!")
-                debug_telegram.send_simple_msg(str(err))
-                debug_telegram.send_simple_msg(str(house))
+                metrics.inc("parse_errors_total")
+                app.debug(f"Error in parsing house {house.get('url_key')}: {err}")
                 logging.error("Error in parsing house")
                 logging.error(str(err))
-    except KeyError as key_err:
-        debug_telegram.send_simple_msg("Error accessing expected data structure!")
-        debug_telegram.send_simple_msg(str(key_err))
-        logging.error("Error accessing expected data structure")
-        logging.error(str(key_err))
+    return houses
+
 
-    return cities_dict
+# Define the GraphQL query payload
+def scrape(cities=[], page_size=30, profile="poll", extra_filters=None):
+    products_per_city = fetch_city_products(cities, page_size, profile, extra_filters)
+    if products_per_city is None:
+        return {}  # Return empty dictionary if the request fails
+
+    return {
+        city_id: parse_houses(products)
+        for city_id, products in products_per_city.items()
+    }
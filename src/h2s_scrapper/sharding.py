@@ -0,0 +1,111 @@
+"""
+Sharding of the polled cities across worker processes.
+
+Several daemons can share one `houses.db`, e.g. on the same host or a volume
+with working file locks. Each of them is a worker that leases a share of the
+subscribed cities in the `city_leases` table and only polls those. Leases
+expire unless renewed, so the cities of a worker that died are taken over by
+the others, and a worker that joins gets its share once the others give up
+their surplus.
+
+Every lease carries a fencing token that grows whenever it changes hands.
+`main.sync_cycle` checks the tokens in its write transaction and drops the
+cities whose lease was lost meanwhile, so a worker that stalled past its lease
+cannot write over the results of its successor.
+"""
+
+import logging
+import os
+import socket
+from typing import Dict, List, Optional
+
+from h2s_scrapper import metrics
+from h2s_scrapper.db import acquire_leases, fenced_cities, release_leases
+
+# Seconds a lease stays valid without renewal, when not derived from the interval
+DEFAULT_LEASE_TTL = 180.0
+
+
+def default_worker_id() -> str:
+    """
+    Returns an ID unique to this process: the host name and the process ID.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class CityLeases:
+    def __init__(
+        self,
+        cities: List[str],
+        ttl: float = DEFAULT_LEASE_TTL,
+        worker_id: Optional[str] = None,
+    ):
+        """
+        Initializes the leases of this worker; none are held until `renew`.
+
+        Args:
+            cities (List[str]): All cities shared among the workers.
+            ttl (float): Seconds the leases stay valid without renewal, longer
+                than the time between two renewals.
+            worker_id (Optional[str]): The ID of this worker, unique among the
+                workers sharing the database.
+        """
+        self.cities = cities
+        self.ttl = ttl
+        self.worker_id = worker_id or default_worker_id()
+        # City -> fencing token of the leases currently held
+        self.tokens: Dict[str, int] = {}
+
+    def renew(self) -> List[str]:
+        """
+        Renews the leases, taking or giving up cities to keep the shares even.
+
+        Returns:
+            List[str]: The cities this worker may poll now.
+        """
+        tokens = acquire_leases(self.worker_id, self.cities, self.ttl)
+        taken = sorted(set(tokens) - set(self.tokens))
+        lost = sorted(set(self.tokens) - set(tokens))
+        if taken:
+            metrics.inc("leases_taken_total", len(taken))
+            logging.info("Worker %s leased cities %s", self.worker_id, taken)
+        if lost:
+            metrics.inc("leases_lost_total", len(lost))
+            logging.info("Worker %s gave up cities %s", self.worker_id, lost)
+        self.tokens = tokens
+        return sorted(tokens)
+
+    def fenced(self, cities: List[str]) -> List[str]:
+        """
+        Filters cities down to those still leased with the same token.
+
+        Must be called inside the `transaction()` that writes their data.
+
+        Args:
+            cities (List[str]): The cities about to be written.
+
+        Returns:
+            List[str]: The cities that may be written.
+        """
+        held = set(
+            fenced_cities(
+                self.worker_id,
+                {city: self.tokens[city] for city in cities if city in self.tokens},
+            )
+        )
+        fenced = [city for city in cities if city not in held]
+        if fenced:
+            metrics.inc("leases_fenced_total", len(fenced))
+            logging.warning(
+                "Worker %s lost the leases of %s, dropping their results",
+                self.worker_id,
+                fenced,
+            )
+        return [city for city in cities if city in held]
+
+    def release(self) -> None:
+        """
+        Gives up all leases, e.g. on shutdown.
+        """
+        release_leases(self.worker_id)
+        self.tokens = {}
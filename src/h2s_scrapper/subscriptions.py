@@ -0,0 +1,268 @@
+"""
+Self-service subscriptions through bot commands.
+
+Besides the groups in config.json, any chat can subscribe itself to the new
+listings of a city by sending the bot::
+
+    /subscribe Eindhoven
+    /unsubscribe Eindhoven
+    /unsubscribe
+
+(the last one ends all subscriptions of the chat). A `CommandListener`
+long-polls Telegram for these commands and stores the subscriptions in the
+`subscriptions` table of `houses.db`.
+
+Routing uses a `SubscriptionIndex`, an in-memory map of every city to the set
+of its subscribed chats. It reads the table once and then follows the
+`subscription_events` feed, so every `refresh()` only reads what changed since
+the previous one; subscriptions made through another process sharing the
+database are picked up without a restart as well.
+"""
+
+import logging
+import random
+import sqlite3
+import threading
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from h2s_scrapper import app
+from h2s_scrapper.db import (
+    add_subscription,
+    close_connection,
+    remove_subscriptions,
+    subscription_changes_since,
+    subscriptions_snapshot,
+)
+from h2s_scrapper.scrape import CITY_IDS, city_id_to_city, city_to_city_id
+from h2s_scrapper.telegram import TelegramBot
+
+# Upper bound of the wait after getUpdates failed, in seconds
+MAX_POLL_BACKOFF = 60.0
+
+USAGE = (
+    "Send /subscribe <city> to get notified about new listings in a city, "
+    "/unsubscribe <city> to stop, or /unsubscribe to stop all of them.\n"
+    "Cities: " + ", ".join(sorted(CITY_IDS.values()))
+)
+
+
+class SubscriptionIndex:
+    def __init__(self):
+        """
+        Initializes an empty index, loaded by the first `refresh`.
+        """
+        self._chats: Dict[str, Set[str]] = {}
+        self._cursor: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        """Whether the subscriptions were loaded."""
+        return self._cursor is not None
+
+    def refresh(self) -> None:
+        """
+        Loads the subscriptions on the first call, afterwards applies the changes since.
+        """
+        try:
+            if self._cursor is None:
+                self._load()
+            else:
+                self._apply(subscription_changes_since(self._cursor))
+        except sqlite3.Error as e:
+            logging.error(f"Error refreshing subscriptions: {e}")
+
+    def _load(self) -> None:
+        cursor, rows = subscriptions_snapshot()
+        chats: Dict[str, Set[str]] = {}
+        for chat_id, city in rows:
+            chats.setdefault(city, set()).add(chat_id)
+        with self._lock:
+            self._chats = chats
+            self._cursor = cursor
+        logging.info(f"Loaded {len(rows)} subscriptions")
+
+    def _apply(self, changes: List[Tuple[int, str, str, bool]]) -> None:
+        with self._lock:
+            for id_, chat_id, city, subscribed in changes:
+                # Another thread may have applied it meanwhile
+                if id_ <= self._cursor:
+                    continue
+                if subscribed:
+                    self._chats.setdefault(city, set()).add(chat_id)
+                else:
+                    chats = self._chats.get(city)
+                    if chats is not None:
+                        chats.discard(chat_id)
+                        if not chats:
+                            del self._chats[city]
+                self._cursor = id_
+
+    def cities(self) -> List[str]:
+        """
+        Returns the IDs of the cities with at least one subscriber.
+        """
+        with self._lock:
+            return sorted(self._chats)
+
+    def chats(self, city: str) -> FrozenSet[str]:
+        """
+        Returns the chats subscribed to a city.
+
+        Args:
+            city (str): The city ID.
+
+        Returns:
+            FrozenSet[str]: The chat IDs, possibly none.
+        """
+        with self._lock:
+            return frozenset(self._chats.get(city, ()))
+
+
+def parse_command(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Splits a message into a bot command and its argument.
+
+    Args:
+        text (str): The message text, e.g. "/subscribe@H2SBot Den Haag".
+
+    Returns:
+        Optional[Tuple[str, str]]: The command without the slash and the bot
+        name, and the rest of the text; None if the text is no command.
+    """
+    if not text.startswith("/"):
+        return None
+    command, _, argument = text[1:].partition(" ")
+    # In groups, commands may be addressed to a bot as /command@bot
+    return command.split("@", 1)[0].lower(), argument.strip()
+
+
+def handle_command(chat_id: str, command: str, argument: str) -> Optional[str]:
+    """
+    Carries out a subscription command.
+
+    Args:
+        chat_id (str): The chat the command was sent in.
+        command (str): The command, see `parse_command`.
+        argument (str): The argument of the command, a city ID or name.
+
+    Returns:
+        Optional[str]: The reply to send, None for commands of other bots.
+
+    Raises:
+        sqlite3.Error: If the subscriptions could not be changed.
+    """
+    if command in ("start", "help"):
+        return USAGE
+    if command == "subscribe":
+        if not argument:
+            return USAGE
+        city_id = city_to_city_id(argument)
+        if city_id is None:
+            return f"Unknown city {argument}.\n{USAGE}"
+        city = city_id_to_city(city_id)
+        if add_subscription(chat_id, city_id):
+            return f"Subscribed to new listings in {city}."
+        return f"Already subscribed to {city}."
+    if command == "unsubscribe":
+        city_id = None
+        if argument:
+            city_id = city_to_city_id(argument)
+            if city_id is None:
+                return f"Unknown city {argument}.\n{USAGE}"
+        removed = remove_subscriptions(chat_id, city_id)
+        if not removed:
+            return "No subscriptions to end."
+        return "Unsubscribed from " + ", ".join(map(city_id_to_city, removed)) + "."
+    return None
+
+
+class CommandListener:
+    def __init__(self, bot: TelegramBot, index: SubscriptionIndex):
+        """
+        Initializes a listener that handles subscription commands on a
+        background thread.
+
+        Telegram hands the updates of a bot to one consumer only, so run a
+        single listener per bot, e.g. on one of the workers sharing a database.
+
+        Args:
+            bot (TelegramBot): Any bot of the API key; updates are per bot,
+                replies go to the chat of the command.
+            index (SubscriptionIndex): The index refreshed after every change.
+        """
+        self.bot = bot
+        self.index = index
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="command-listener", daemon=True
+        )
+
+    def start(self) -> "CommandListener":
+        """
+        Starts the background thread.
+        """
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stops the listener once the long poll in progress returns.
+
+        Args:
+            timeout (Optional[float]): Seconds to wait for the thread to end.
+        """
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def handle_update(self, update: Dict[str, Any]) -> None:
+        """
+        Handles a single update of getUpdates, ignoring everything but commands.
+        """
+        message = update.get("message") or {}
+        text = message.get("text")
+        chat_id = message.get("chat", {}).get("id")
+        if not text or chat_id is None:
+            return
+        parsed = parse_command(text)
+        if parsed is None:
+            return
+
+        chat_id = str(chat_id)
+        try:
+            reply = handle_command(chat_id, *parsed)
+        except sqlite3.Error as e:
+            logging.error(f"Error handling {text!r} in chat {chat_id}: {e}")
+            app.debug(f"Error handling {text!r} in chat {chat_id}: {e}")
+            reply = "Something went wrong, please try again later."
+        if reply is None:
+            return
+        logging.info(f"Handled {text!r} in chat {chat_id}")
+        # Applied right away, so the next cycle routes with it
+        self.index.refresh()
+        TelegramBot(apikey=self.bot.apikey, chat_id=chat_id).send_simple_msg(reply)
+
+    def _run(self) -> None:
+        offset = None
+        failures = 0
+        try:
+            while not self._stopped.is_set():
+                updates = self.bot.get_updates(offset)
+                if updates is None:
+                    # E.g. a network error, or a webhook or another listener
+                    # taking the updates (409)
+                    failures = min(failures + 1, 10)
+                    delay = min(MAX_POLL_BACKOFF, 2.0**failures)
+                    self._stopped.wait(random.uniform(delay / 2, delay))
+                    continue
+                failures = 0
+                for update in updates:
+                    try:
+                        self.handle_update(update)
+                    except Exception as error:  # pylint: disable=broad-exception-caught
+                        logging.exception("Handling an update failed: %s", error)
+                    # Confirmed with the next call, even if it failed, so that a
+                    # broken update cannot block the ones after it
+                    offset = update["update_id"] + 1
+        finally:
+            close_connection()
@@ -1,12 +1,37 @@
+import asyncio
 import json
 import logging
-import os
-from io import BytesIO
-from typing import List, Optional
+import time
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 from urllib.parse import quote
 
 import requests
-from PIL import Image
+
+from h2s_scrapper import metrics
+from h2s_scrapper.db import forget_file_ids, get_file_ids, save_file_ids
+from h2s_scrapper.images import fetch_images
+
+if TYPE_CHECKING:
+    import httpx
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Telegram's documented limits: ~30 messages per second overall, one per second
+# per chat and 20 per minute per group
+GLOBAL_RATE = 30.0
+PRIVATE_CHAT_RATE = 1.0
+GROUP_CHAT_RATE = 20 / 60
+
+MAX_MEDIA_GROUP_SIZE = 10
+
+# Seconds to connect and to wait for an answer; uploads of photos can take a while
+REQUEST_TIMEOUT = (5, 60)
+# Seconds Telegram holds a getUpdates request open while there are no updates
+LONG_POLL_TIMEOUT = 30
+
+# Shared by all bots so consecutive messages reuse the same keep-alive connection
+session = requests.Session()
 
 
 class TelegramBot:
@@ -26,64 +51,56 @@ class TelegramBot:
         images: List[str],
         caption: Optional[str],
         reply_to_message_id: Optional[int] = None,
+        reuse_file_ids: bool = True,
     ) -> Optional[requests.Response]:
         """
         Sends a group of images as a media group to the Telegram chat.
 
+        Photos uploaded before, to any chat, are referenced by the `file_id`
+        Telegram returned for them instead of being downloaded and uploaded again.
+
         Args:
-            images (List[str]): A list of image URLs to be sent.
+            images (List[str]): A list of cleaned image URLs to be sent, see `images.fetch_images`.
             caption (Optional[str], optional): Caption to include with the first image. Defaults to None.
             reply_to_message_id (Optional[int], optional): ID of the message to reply to. Defaults to None.
+            reuse_file_ids (bool, optional): Whether to reference known file_ids. Defaults to True.
 
         Returns:
             Optional[requests.Response]: The response object from the Telegram API if successful, None otherwise.
         """
-        send_media_group_url = (
-            f"https://api.telegram.org/bot{self.apikey}/sendMediaGroup"
+        send_media_group_url = f"{TELEGRAM_API_URL}/bot{self.apikey}/sendMediaGroup"
+        media, files, uploaded_urls, file_ids = _media_group(
+            images, caption, reuse_file_ids
         )
-        files = {}
-        media = []
-
-        for i, img_url in enumerate(images):
-            with BytesIO() as output:
-                try:
-                    response = requests.get(img_url, stream=True)
-                    response.raise_for_status()
-                    img = Image.open(response.raw)
-                    img.save(output, format="PNG")
-                    output.seek(0)
-                    name = f"photo-{i}.png"
-                    files[name] = output.read()
-                    media.append({"type": "photo", "media": f"attach://{name}"})
-                except Exception as e:
-                    logging.error(f"Error processing image: {img_url}, Error: {e}")
-                    continue
 
         if media:
-            media[0]["caption"] = (
-                caption if caption is not None else ""
-            )  # Ensure caption is a string
             try:
-                resp = requests.post(
-                    send_media_group_url,
-                    data={
-                        "media": json.dumps(media),
-                        "chat_id": self.chat_id,
-                        "reply_to_message_id": reply_to_message_id,
-                    },
-                    files=files,
-                )
+                with metrics.span("telegram_media_group"):
+                    resp = session.post(
+                        send_media_group_url,
+                        data={
+                            "media": json.dumps(media),
+                            "chat_id": self.chat_id,
+                            "reply_to_message_id": reply_to_message_id,
+                        },
+                        files=files,
+                        timeout=REQUEST_TIMEOUT,
+                    )
+                if resp.status_code == 429:
+                    metrics.inc("telegram_rate_limited_total")
+                if resp.status_code == 400 and file_ids and _rejects_file_id(resp):
+                    # A stored file_id was rejected, e.g. after a bot token change
+                    logging.warning(f"Reused file ids rejected: {resp.text}")
+                    forget_file_ids(list(file_ids))
+                    return self.send_media_group(
+                        images, caption, reply_to_message_id, reuse_file_ids=False
+                    )
                 resp.raise_for_status()
             except requests.RequestException as e:
                 logging.error(f"Error sending media group: {e}")
-                resp = None
-            finally:
-                # Clean up temporary image files
-                for img_name in files.keys():
-                    try:
-                        os.remove(img_name)
-                    except OSError as remove_error:
-                        logging.error(f"Error removing file {img_name}: {remove_error}")
+                return None
+
+            _remember_file_ids(uploaded_urls, resp)
             return resp
         else:
             logging.warning("No valid images to send in media group.")
@@ -100,11 +117,337 @@ class TelegramBot:
             Optional[requests.Response]: The response object from the Telegram API if successful, None otherwise.
         """
         room_desc_encoded = quote(msg.encode("utf8"))
-        url = f"https://api.telegram.org/bot{self.apikey}/sendMessage?chat_id={self.chat_id}&text={room_desc_encoded}"
+        url = f"{TELEGRAM_API_URL}/bot{self.apikey}/sendMessage?chat_id={self.chat_id}&text={room_desc_encoded}"
         try:
-            response = requests.get(url)
+            with metrics.span("telegram_simple_msg"):
+                response = session.get(url, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
             return response
         except requests.RequestException as e:
             logging.error(f"Error sending simple message: {e}")
             return None
+
+    def get_updates(
+        self, offset: Optional[int] = None, timeout: int = LONG_POLL_TIMEOUT
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Long-polls the messages sent to the bot, in any chat.
+
+        Args:
+            offset (Optional[int]): The `update_id` after the last update handled,
+                which confirms all earlier ones. Defaults to None.
+            timeout (int, optional): Seconds to wait for an update. Defaults to
+                `LONG_POLL_TIMEOUT`.
+
+        Returns:
+            Optional[List[Dict[str, Any]]]: The updates, possibly none, or None if
+            they could not be fetched.
+        """
+        url = f"{TELEGRAM_API_URL}/bot{self.apikey}/getUpdates"
+        params = {
+            "offset": offset,
+            "timeout": timeout,
+            "allowed_updates": json.dumps(["message"]),
+        }
+        try:
+            response = session.get(
+                url,
+                params=params,
+                # The answer takes up to `timeout` seconds by design
+                timeout=(REQUEST_TIMEOUT[0], timeout + REQUEST_TIMEOUT[0]),
+            )
+            response.raise_for_status()
+            return response.json()["result"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"Error getting updates: {e}")
+            return None
+
+
+def _media_group(
+    images: List[str], caption: Optional[str], reuse_file_ids: bool
+) -> Tuple[List[Dict[str, str]], Dict[str, bytes], List[Optional[str]], Dict[str, str]]:
+    """
+    Builds the `media` and the files of a sendMediaGroup request.
+
+    Args:
+        images (List[str]): The cleaned image URLs, see `images.fetch_images`.
+        caption (Optional[str]): Caption of the first photo.
+        reuse_file_ids (bool): Whether to reference known file_ids.
+
+    Returns:
+        Tuple: The media entries, none if no photo could be fetched; the photos
+        to upload by attachment name; the URL of every uploaded media entry,
+        None for reused file_ids; and the file_ids referenced.
+    """
+    files = {}
+    media = []
+    uploaded_urls: List[Optional[str]] = []
+
+    # A media group holds at most 10 photos
+    images = images[:MAX_MEDIA_GROUP_SIZE]
+    file_ids = get_file_ids(images) if reuse_file_ids else {}
+    to_upload = [url for url in images if url not in file_ids]
+    photos = dict(zip(to_upload, fetch_images(to_upload)))
+    for i, url in enumerate(images):
+        if url in file_ids:
+            media.append({"type": "photo", "media": file_ids[url]})
+            uploaded_urls.append(None)
+        elif photos.get(url) is not None:
+            name = f"photo-{i}.jpg"
+            files[name] = photos[url]
+            media.append({"type": "photo", "media": f"attach://{name}"})
+            uploaded_urls.append(url)
+    if media:
+        # Ensure caption is a string
+        media[0]["caption"] = caption if caption is not None else ""
+    return media, files, uploaded_urls, file_ids
+
+
+def _remember_file_ids(uploaded_urls: List[Optional[str]], resp: Any) -> None:
+    # sendMediaGroup returns one message per photo, in the order they were sent
+    new_file_ids = {}
+    try:
+        for url, message in zip(uploaded_urls, resp.json()["result"]):
+            if url is not None and message.get("photo"):
+                # Photo sizes are sorted ascending, the last one is the original
+                new_file_ids[url] = message["photo"][-1]["file_id"]
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Unexpected sendMediaGroup response: {e}")
+    save_file_ids(new_file_ids)
+
+
+def _rejects_file_id(resp: Any) -> bool:
+    # E.g. "Bad Request: wrong file identifier/HTTP URL specified"; other 400s,
+    # such as a too long caption, say nothing about the stored file_ids
+    try:
+        description = str(resp.json().get("description", ""))
+    except (ValueError, AttributeError):
+        return False
+    return "file identifier" in description.lower() or "file_id" in description
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        """
+        Initializes a token bucket refilled at `rate` tokens per second.
+
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): Maximum number of tokens stored, i.e. the allowed burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Waits until a token is available and takes it.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TelegramDispatcher:
+    def __init__(
+        self,
+        apikey: str,
+        max_retries: int = 3,
+        max_connections: int = 20,
+        timeout: float = 10.0,
+    ):
+        """
+        Initializes the dispatcher used to fan messages out to many chats at once.
+
+        Chats are served concurrently over one pooled HTTP client, while token
+        buckets keep every chat and the bot as a whole within Telegram's limits.
+        The dispatcher owns its event loop, so the pooled connections survive
+        between calls of a long-running process.
+
+        Args:
+            apikey (str): The API key for accessing the Telegram bot.
+            max_retries (int): Retries per message after a 429 or a network error.
+            max_connections (int): Size of the HTTP connection pool.
+            timeout (float): Timeout in seconds of a single API call.
+        """
+        self.apikey = apikey
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._client: Optional["httpx.AsyncClient"] = None
+        self._global_bucket = TokenBucket(GLOBAL_RATE, capacity=GLOBAL_RATE)
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        if chat_id not in self._chat_buckets:
+            # Group and channel IDs are negative, private chats are positive
+            rate = (
+                GROUP_CHAT_RATE if str(chat_id).startswith("-") else PRIVATE_CHAT_RATE
+            )
+            self._chat_buckets[chat_id] = TokenBucket(rate)
+        return self._chat_buckets[chat_id]
+
+    def _get_client(self) -> "httpx.AsyncClient":
+        if self._client is None:
+            # Imported on first use, only the dispatcher needs it
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                base_url=f"{TELEGRAM_API_URL}/bot{self.apikey}",
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    async def _post(
+        self,
+        chat_id: str,
+        method: str,
+        data: Dict[str, Any],
+        files: Optional[Dict[str, bytes]] = None,
+    ) -> Optional["httpx.Response"]:
+        import httpx
+
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = await self._get_client().post(
+                    f"/{method}", data={"chat_id": chat_id, **data}, files=files
+                )
+            except httpx.HTTPError as e:
+                logging.error(f"Error calling {method} in chat {chat_id}: {e}")
+                await asyncio.sleep(2**attempt)
+                continue
+
+            # Timed without the waits for a token, which are the rate limit's doing
+            metrics.observe(
+                "telegram_send" if method == "sendMessage" else "telegram_media_group",
+                time.perf_counter() - started,
+            )
+            if response.status_code != 429:
+                return response
+
+            metrics.inc("telegram_rate_limited_total")
+            try:
+                retry_after = (
+                    response.json().get("parameters", {}).get("retry_after", 2**attempt)
+                )
+            except (ValueError, AttributeError):
+                # E.g. an HTML error page of a proxy
+                retry_after = 2**attempt
+            logging.warning(
+                f"Rate limited in chat {chat_id}, retrying in {retry_after}s"
+            )
+            await asyncio.sleep(retry_after)
+        return None
+
+    async def _send(self, chat_id: str, text: str) -> Optional["httpx.Response"]:
+        return await self._post(chat_id, "sendMessage", {"text": text})
+
+    async def _send_chat(
+        self, chat_id: str, items: List[Tuple[int, str]]
+    ) -> List[Tuple[int, Optional["httpx.Response"]]]:
+        # Messages of one chat go out in order, other chats are served meanwhile
+        return [(index, await self._send(chat_id, text)) for index, text in items]
+
+    async def _send_all(
+        self, messages: List[Tuple[str, str]]
+    ) -> List[Optional["httpx.Response"]]:
+        per_chat: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+        for index, (chat_id, text) in enumerate(messages):
+            per_chat[chat_id].append((index, text))
+
+        results: List[Optional["httpx.Response"]] = [None] * len(messages)
+        for chat_results in await asyncio.gather(
+            *(self._send_chat(chat_id, items) for chat_id, items in per_chat.items())
+        ):
+            for index, response in chat_results:
+                results[index] = response
+        return results
+
+    def send_messages(
+        self, messages: List[Tuple[str, str]]
+    ) -> List[Optional["httpx.Response"]]:
+        """
+        Sends text messages to their chats concurrently, within the rate limits.
+
+        Args:
+            messages (List[Tuple[str, str]]): `(chat_id, text)` pairs to send.
+
+        Returns:
+            List[Optional["httpx.Response"]]: The final API response of every message,
+            in input order, or None when it could not be delivered.
+        """
+        if not messages:
+            return []
+        return self._loop.run_until_complete(self._send_all(messages))
+
+    def send_media_group(
+        self,
+        chat_id: str,
+        images: List[str],
+        caption: Optional[str],
+        reuse_file_ids: bool = True,
+    ) -> Optional["httpx.Response"]:
+        """
+        Sends photos as a media group, within the same rate limits as the messages.
+
+        Photos uploaded before, to any chat, are referenced by the `file_id`
+        Telegram returned for them instead of being downloaded and uploaded again.
+
+        Args:
+            chat_id (str): The chat to send the photos to.
+            images (List[str]): The cleaned image URLs, see `images.fetch_images`.
+            caption (Optional[str]): Caption of the first photo.
+            reuse_file_ids (bool): Whether to reference known file_ids.
+
+        Returns:
+            Optional["httpx.Response"]: The final API response, or None when no
+            photo could be fetched or the photos could not be delivered.
+        """
+        media, files, uploaded_urls, file_ids = _media_group(
+            images, caption, reuse_file_ids
+        )
+        if not media:
+            logging.warning("No valid images to send in media group.")
+            return None
+
+        response = self._loop.run_until_complete(
+            self._post(chat_id, "sendMediaGroup", {"media": json.dumps(media)}, files)
+        )
+        if response is None:
+            return None
+        if response.status_code == 400 and file_ids and _rejects_file_id(response):
+            # A stored file_id was rejected, e.g. after a bot token change
+            logging.warning(f"Reused file ids rejected: {response.text}")
+            forget_file_ids(list(file_ids))
+            return self.send_media_group(chat_id, images, caption, reuse_file_ids=False)
+        if response.status_code == 200:
+            _remember_file_ids(uploaded_urls, response)
+        return response
+
+    def close(self) -> None:
+        """
+        Closes the pooled HTTP client and the event loop.
+        """
+        if self._client is not None:
+            self._loop.run_until_complete(self._client.aclose())
+            self._client = None
+        self._loop.close()
@@ -0,0 +1,289 @@
+"""
+Benchmarks of the scrape, sync and notify path against local stand-ins of the
+Holland2Stay and Telegram APIs, see `fake_graphql` and `fake_telegram`.
+
+Run from the repository root::
+
+    poetry run python tests/benchmarks/bench.py
+    poetry run python tests/benchmarks/bench.py --sizes 10 1000 --save-baseline
+
+Measured for every size (number of listings):
+
+- `scrape`: listings per second fetched and parsed by `scrape.scrape`
+- `house_to_msg`: listings per second formatted as notifications
+- `sync_insert` / `sync_unchanged`: listings per second written by
+  `db.sync_houses` into an empty database, and synced again unchanged
+- `cycle_new` / `cycle_unchanged`: seconds taken by `main.run_cycle`, the body
+  of `main()`, when a few listings were added (and get announced in a digest)
+  and when nothing changed
+
+Every run is stored as JSON under `.benchmarks/`. Once a baseline was saved on
+the machine, runs are compared against it and the script exits with status 1 if
+any measurement got worse by more than `--tolerance`.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from fake_graphql import FakeGraphQLServer
+from fake_telegram import FakeTelegramServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+# pylint: disable=wrong-import-position
+from h2s_scrapper import app, db, main, scrape, telegram  # noqa: E402
+from h2s_scrapper.filters import FilterIndex  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, ".benchmarks")
+BASELINE_FILE = "baseline.json"
+
+DEFAULT_SIZES = [10, 1000, 100000]
+CITIES = ["24", "25", "26", "29"]
+CHAT_ID = "1000"
+# Listings added before the measured cycle, all announced to CHAT_ID
+NEW_LISTINGS = 3
+
+Results = Dict[str, Dict[str, Any]]
+
+
+def best_of(repeat: int, func: Callable[[], Any]) -> float:
+    """
+    Runs `func` `repeat` times and returns the fastest run, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def reset_database() -> None:
+    """
+    Starts over with an empty database in the working directory.
+    """
+    db.close_connection()
+    for path in glob.glob(f"{db.DB_PATH}*"):
+        os.remove(path)
+    db.create_table()
+
+
+def bench_size(
+    size: int,
+    graphql: FakeGraphQLServer,
+    telegram_api: FakeTelegramServer,
+    repeat: int,
+) -> Results:
+    """
+    Runs all benchmarks for one number of listings.
+
+    Args:
+        size (int): Number of listings served by the fake API.
+        graphql (FakeGraphQLServer): The running GraphQL stand-in.
+        telegram_api (FakeTelegramServer): The running Bot API stand-in.
+        repeat (int): Runs per measurement, the fastest one counts.
+
+    Returns:
+        Results: The measurements, keyed by "<name>/<size>".
+    """
+    results: Results = {}
+
+    def record(name: str, value: float, unit: str, higher_is_better: bool) -> None:
+        results[f"{name}/{size}"] = {
+            "value": value,
+            "unit": unit,
+            "higher_is_better": higher_is_better,
+        }
+        print(f"  {name:<16} {value:>14.3f} {unit}", flush=True)
+
+    print(f"{size} listings", flush=True)
+    # A single run of the big sizes is both slow and steady enough
+    repeat = repeat if size <= 1000 else 1
+
+    graphql.listings = size
+    houses_per_city: Dict[str, List[Any]] = {}
+
+    def run_scrape() -> None:
+        houses_per_city.update(scrape.scrape(cities=CITIES, page_size=100))
+
+    seconds = best_of(repeat, run_scrape)
+    houses = [house for houses in houses_per_city.values() for house in houses]
+    assert len(houses) == size, f"scraped {len(houses)} of {size} listings"
+    record("scrape", size / seconds, "listings/s", True)
+
+    seconds = best_of(repeat, lambda: [scrape.house_to_msg(h) for h in houses])
+    record("house_to_msg", size / seconds, "listings/s", True)
+
+    def sync_all() -> None:
+        for city_id, city_houses in houses_per_city.items():
+            db.sync_houses(city_id, city_houses)
+
+    insert_timings = []
+    unchanged_timings = []
+    for _ in range(repeat):
+        reset_database()
+        insert_timings.append(best_of(1, sync_all))
+        unchanged_timings.append(best_of(1, sync_all))
+    record("sync_insert", size / min(insert_timings), "listings/s", True)
+    record("sync_unchanged", size / min(unchanged_timings), "listings/s", True)
+
+    # Fill the database without announcing anything, then add a few listings
+    reset_database()
+    config = {"telegram": {"groups": [{"chat_id": CHAT_ID, "cities": CITIES}]}}
+    filter_index = FilterIndex.from_groups(config["telegram"]["groups"])
+    silent_index = FilterIndex([])
+    fingerprints: Dict[str, str] = {}
+    main.run_cycle(config, silent_index, fingerprints)
+
+    graphql.listings = size + NEW_LISTINGS
+    sent_before = len(telegram_api.sent)
+    seconds = best_of(1, lambda: main.run_cycle(config, filter_index, fingerprints))
+    # New listings of a cycle are coalesced into digests, count the listings
+    sent = sum(
+        text.count("holland2stay.com/residences/")
+        for _, text in telegram_api.sent[sent_before:]
+    )
+    assert sent == NEW_LISTINGS, f"announced {sent} of {NEW_LISTINGS} new listings"
+    record("cycle_new", seconds, "s", False)
+
+    seconds = best_of(
+        repeat, lambda: main.run_cycle(config, filter_index, fingerprints)
+    )
+    record("cycle_unchanged", seconds, "s", False)
+    return results
+
+
+def compare(results: Results, baseline: Results, tolerance: float) -> List[str]:
+    """
+    Lists the measurements that got worse than the baseline by more than `tolerance`.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        value = result["value"]
+        expected = baseline[key]["value"]
+        if result["higher_is_better"]:
+            worse = value < expected * (1 - tolerance)
+        else:
+            worse = value > expected * (1 + tolerance)
+        if worse:
+            regressions.append(
+                f"{key}: {value:.3f} {result['unit']} (baseline {expected:.3f})"
+            )
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="listing counts"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per measurement, fastest counts"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds every fake API call is delayed by",
+    )
+    parser.add_argument(
+        "--recorded", help="GraphQL response of the live API to replay listings from"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown against the baseline that counts as a regression",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store this run as the baseline of later ones",
+    )
+    return parser.parse_args()
+
+
+def main_bench() -> int:
+    args = parse_args()
+    graphql = FakeGraphQLServer(latency=args.latency, recorded=args.recorded).start()
+    telegram_api = FakeTelegramServer(latency=args.latency).start()
+    scrape.GRAPHQL_URL = graphql.url
+    telegram.TELEGRAM_API_URL = telegram_api.url
+    app.set_context(app.AppContext(apikey="benchmark", debug_chat_id="1"))
+
+    results: Results = {}
+    try:
+        for size in args.sizes:
+            results.update(bench_size(size, graphql, telegram_api, args.repeat))
+    finally:
+        app.get_context().close()
+        db.close_connection()
+        graphql.stop()
+        telegram_api.stop()
+    print(f"Rate limited by the fake Bot API {telegram_api.rate_limited} times")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    run = {
+        "created_at": now.isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "latency": args.latency,
+        "results": results,
+    }
+    run_file = os.path.join(RESULTS_DIR, f"{now:%Y%m%dT%H%M%SZ}.json")
+    with open(run_file, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+    print(f"Results stored in {run_file}")
+
+    baseline_file = os.path.join(RESULTS_DIR, BASELINE_FILE)
+    if args.save_baseline:
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+        print(f"Saved as baseline in {baseline_file}")
+        return 0
+    if not os.path.exists(baseline_file):
+        print("No baseline to compare with, save one with --save-baseline")
+        return 0
+
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions against the baseline of {baseline['created_at']}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    # The database is created in the working directory, keep it away from the real one
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        sys.exit(main_bench())
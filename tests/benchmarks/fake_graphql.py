@@ -0,0 +1,244 @@
+"""
+A local stand-in for the Holland2Stay GraphQL API.
+
+Serves synthetic listings, or listings replayed from a recorded response, with
+the pagination and filters `scrape` relies on and a configurable latency.
+"""
+
+import copy
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+# Fields returned for the polling query, see `scrape.POLL_QUERY`
+POLL_FIELDS = (
+    "url_key",
+    "city",
+    "available_startdate",
+    "living_area",
+    "no_of_rooms",
+    "maximum_number_of_persons",
+    "type_of_contract",
+    "basic_rent",
+)
+
+ROOM_IDS = ("104", "105", "106", "108")
+CONTRACT_TYPE_IDS = ("21", "6125", "6126", "6127")
+MAX_REGISTER_IDS = ("22", "23", "24")
+
+
+def synthetic_product(index: int, city: str) -> Dict[str, Any]:
+    """
+    Builds a listing shaped like the ones of the full query.
+
+    Args:
+        index (int): Number of the listing, which makes it unique.
+        city (str): The city ID of the listing.
+
+    Returns:
+        Dict[str, Any]: The product.
+    """
+    rent = 600 + index % 900
+    image = {
+        "url": f"https://api.holland2stay.com/media/catalog/product/cache/0f1e/h/{index}.jpg",
+        "label": None,
+        "position": 1,
+        "disabled": False,
+        "__typename": "ProductImage",
+    }
+    price = {
+        "value": rent + 150.0,
+        "currency": "EUR",
+        "__typename": "Money",
+    }
+    price_block = {
+        "regular_price": price,
+        "final_price": price,
+        "discount": {
+            "amount_off": 0,
+            "percent_off": 0,
+            "__typename": "ProductDiscount",
+        },
+        "__typename": "ProductPrice",
+    }
+    return {
+        "name": f"Benchmark street {index}",
+        "sku": f"BENCH-{index}",
+        "city": int(city),
+        "url_key": f"benchmark-street-{index}",
+        "available_to_book": 179,
+        "available_startdate": f"2024-{index % 12 + 1:02d}-01 00:00:00",
+        "building_name": 9000 + index % 50,
+        "finishing": 5140,
+        "living_area": f"{18 + index % 60},5",
+        "no_of_rooms": int(ROOM_IDS[index % len(ROOM_IDS)]),
+        "resident_type": 4520,
+        "offer_text_two": None,
+        "offer_text": None,
+        "maximum_number_of_persons": int(
+            MAX_REGISTER_IDS[index % len(MAX_REGISTER_IDS)]
+        ),
+        "type_of_contract": int(CONTRACT_TYPE_IDS[index % len(CONTRACT_TYPE_IDS)]),
+        "price_analysis_text": None,
+        "allowance_price": 480.0,
+        "floor": index % 12,
+        "basic_rent": float(rent),
+        "lumpsum_service_charge": 60.0,
+        "inventory": 55.0,
+        "caretaker_costs": 10.0,
+        "cleaning_common_areas": 15.0,
+        "energy_common_areas": 10.0,
+        "small_image": image,
+        "thumbnail": image,
+        "image": image,
+        "media_gallery": [
+            {**image, "url": image["url"].replace(".jpg", f"-{n}.jpg"), "position": n}
+            for n in range(8)
+        ],
+        "price_range": {
+            "minimum_price": price_block,
+            "maximum_price": price_block,
+            "__typename": "PriceRange",
+        },
+        "__typename": "SimpleProduct",
+    }
+
+
+def poll_product(product: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Keeps only the fields the polling query asks for.
+    """
+    trimmed = {field: product.get(field) for field in POLL_FIELDS}
+    final_price = product["price_range"]["maximum_price"]["final_price"]["value"]
+    trimmed["price_range"] = {"maximum_price": {"final_price": {"value": final_price}}}
+    return trimmed
+
+
+class FakeGraphQLServer:
+    def __init__(
+        self,
+        listings: int = 10,
+        cities: Optional[List[str]] = None,
+        latency: float = 0.0,
+        recorded: Optional[str] = None,
+    ):
+        """
+        Initializes the fake API, started with `start()`.
+
+        Args:
+            listings (int): Number of bookable listings, can be changed later.
+            cities (Optional[List[str]]): City IDs the listings are spread over,
+                the cities of the request when not given.
+            latency (float): Seconds every request is delayed by.
+            recorded (Optional[str]): A GraphQL response saved from the live API;
+                its products are replayed, with numbered `url_key`s once they
+                run out, instead of synthetic ones.
+        """
+        self.listings = listings
+        self.cities = cities
+        self.latency = latency
+        self.requests = 0
+        self._templates: List[Dict[str, Any]] = []
+        if recorded:
+            with open(recorded, encoding="utf-8") as f:
+                self._templates = json.load(f)["data"]["products"]["items"]
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        """The GraphQL endpoint, to be set as `scrape.GRAPHQL_URL`."""
+        return f"http://127.0.0.1:{self._server.server_port}/graphql/"
+
+    def url_key(self, index: int) -> str:
+        """
+        Returns the `url_key` of listing number `index`.
+        """
+        if not self._templates:
+            return f"benchmark-street-{index}"
+        url_key = self._templates[index % len(self._templates)]["url_key"]
+        return url_key if index < len(self._templates) else f"{url_key}-{index}"
+
+    def product(self, index: int, city: str) -> Dict[str, Any]:
+        """
+        Returns listing number `index`, always the same one for the same number.
+        """
+        if not self._templates:
+            return synthetic_product(index, city)
+        product = copy.deepcopy(self._templates[index % len(self._templates)])
+        product["url_key"] = self.url_key(index)
+        product["city"] = int(city)
+        return product
+
+    def respond(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Answers a GraphQL payload as `scrape.generate_payload` builds them.
+        """
+        variables = payload["variables"]
+        filters = variables["filters"]
+        page_size = variables["pageSize"]
+        current_page = variables["currentPage"]
+
+        cities = self.cities or (filters.get("city") or {}).get("in") or ["24"]
+        url_keys = (filters.get("url_key") or {}).get("in")
+        if url_keys is not None:
+            # Detail queries ask for a few listings by url_key
+            wanted = set(url_keys)
+            indexes = [i for i in range(self.listings) if self.url_key(i) in wanted]
+        else:
+            indexes = list(range(self.listings))
+
+        full = "media_gallery" in payload["query"]
+        page = []
+        for i in indexes[(current_page - 1) * page_size : current_page * page_size]:
+            product = self.product(i, cities[i % len(cities)])
+            page.append(product if full else poll_product(product))
+
+        products = {
+            "items": page,
+            "page_info": {"total_pages": max(1, math.ceil(len(indexes) / page_size))},
+            "total_count": len(indexes),
+        }
+        data: Dict[str, Any] = {"products": products}
+        if full:
+            data = {"categories": {"items": [{"uid": "Nw=="}]}, **data}
+        return {"data": data}
+
+    def start(self) -> "FakeGraphQLServer":
+        """
+        Starts serving from a background thread.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:  # pylint: disable=invalid-name
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+                fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                body = json.dumps(fake.respond(payload)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the server.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
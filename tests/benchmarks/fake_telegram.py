@@ -0,0 +1,180 @@
+"""
+A local stand-in for the Telegram Bot API.
+
+Accepts `sendMessage` and `sendMediaGroup` and enforces Telegram's flood limits:
+at most 30 messages per second overall, one per second in a private chat and 20
+per minute in a group. Anything beyond is answered with a 429 and `retry_after`,
+as the real API does.
+"""
+
+import json
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# (messages, seconds) allowed in a sliding window
+GLOBAL_LIMIT = (30, 1.0)
+PRIVATE_CHAT_LIMIT = (1, 1.0)
+GROUP_CHAT_LIMIT = (20, 60.0)
+
+
+class FakeTelegramServer:
+    def __init__(self, latency: float = 0.0):
+        """
+        Initializes the fake API, started with `start()`.
+
+        Args:
+            latency (float): Seconds every API call is delayed by.
+        """
+        self.latency = latency
+        self.sent: List[Tuple[str, str]] = []
+        self.rate_limited = 0
+        self._windows: Dict[str, Deque[float]] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        """The API root, to be set as `telegram.TELEGRAM_API_URL`."""
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def _retry_after(self, key: str, limit: int, window: float, now: float) -> float:
+        sent = self._windows[key]
+        while sent and now - sent[0] >= window:
+            sent.popleft()
+        if len(sent) < limit:
+            return 0.0
+        return window - (now - sent[0])
+
+    def accept(self, chat_id: str) -> float:
+        """
+        Counts a message against the limits.
+
+        Args:
+            chat_id (str): The chat the message is sent to.
+
+        Returns:
+            float: 0 if the message is accepted, else the seconds to retry after.
+        """
+        chat_limit = GROUP_CHAT_LIMIT if chat_id.startswith("-") else PRIVATE_CHAT_LIMIT
+        now = time.monotonic()
+        with self._lock:
+            retry_after = max(
+                self._retry_after("*", *GLOBAL_LIMIT, now),
+                self._retry_after(chat_id, *chat_limit, now),
+            )
+            if retry_after:
+                self.rate_limited += 1
+                return retry_after
+            self._windows["*"].append(now)
+            self._windows[chat_id].append(now)
+            return 0.0
+
+    def respond(
+        self, method: str, fields: Dict[str, str]
+    ) -> Tuple[int, Dict[str, Any]]:
+        """
+        Answers an API call.
+
+        Args:
+            method (str): The Bot API method, e.g. "sendMessage".
+            fields (Dict[str, str]): The form or query fields of the call.
+
+        Returns:
+            Tuple[int, Dict[str, Any]]: The status code and the JSON body.
+        """
+        chat_id = fields.get("chat_id", "")
+        if method not in ("sendMessage", "sendMediaGroup") or not chat_id:
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request"}
+
+        retry_after = self.accept(chat_id)
+        if retry_after:
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests",
+                "parameters": {"retry_after": math.ceil(retry_after)},
+            }
+
+        with self._lock:
+            self.sent.append((chat_id, fields.get("text") or fields.get("media", "")))
+            message_id = len(self.sent)
+        if method == "sendMessage":
+            return 200, {"ok": True, "result": {"message_id": message_id}}
+
+        media = json.loads(fields.get("media") or "[]")
+        result = [
+            {
+                "message_id": message_id + n,
+                "photo": [{"file_id": f"file-{message_id}-{n}"}],
+            }
+            for n in range(len(media))
+        ]
+        return 200, {"ok": True, "result": result}
+
+    def start(self) -> "FakeTelegramServer":
+        """
+        Starts serving from a background thread.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self, body: bytes) -> None:
+                url = urlparse(self.path)
+                fields = {k: v[0] for k, v in parse_qs(url.query).items()}
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/x-www-form-urlencoded"):
+                    fields.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+                elif content_type.startswith("multipart/form-data"):
+                    fields.update(_multipart_fields(body, content_type))
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, answer = fake.respond(url.path.rsplit("/", 1)[-1], fields)
+                out = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def do_GET(self) -> None:  # pylint: disable=invalid-name
+                self._handle(b"")
+
+            def do_POST(self) -> None:  # pylint: disable=invalid-name
+                length = int(self.headers.get("Content-Length", 0))
+                self._handle(self.rfile.read(length))
+
+            def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the server.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _multipart_fields(body: bytes, content_type: str) -> Dict[str, str]:
+    # Only the text fields are of interest, uploaded photos are skipped
+    boundary = content_type.split("boundary=", 1)[-1].strip('"').encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        head, _, value = part.partition(b"\r\n\r\n")
+        if b"filename=" in head or b'name="' not in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        fields[name] = value.rstrip(b"\r\n").decode(errors="replace")
+    return fields
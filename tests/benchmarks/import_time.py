@@ -0,0 +1,102 @@
+"""
+Checks the import cost of the package with `python -X importtime`.
+
+Importing `h2s_scrapper.main` is paid on every cron run, so it has to stay
+within `IMPORT_BUDGET_MS` and must not pull in the heavy dependencies, which are
+only imported once their code path is used. Run from the repository root::
+
+    poetry run python tests/benchmarks/import_time.py
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+MODULE = "h2s_scrapper.main"
+# Cumulative import time of MODULE, in milliseconds
+IMPORT_BUDGET_MS = 250.0
+# Imported lazily, importing MODULE must not load them
+LAZY_IMPORTS = ("cloudscraper", "PIL", "httpx", "http.server")
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    Imports `module` in a fresh interpreter, without any credentials set.
+
+    Returns:
+        Dict[str, int]: Every imported module mapped to its cumulative import
+            time in microseconds.
+    """
+    env = {
+        k: v
+        for k, v in os.environ.items()
+        if k not in ("TELEGRAM_API_KEY", "DEBUGGING_CHAT_ID")
+    }
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [os.path.join(ROOT, "src"), env.get("PYTHONPATH")])
+    )
+    # Run elsewhere, so that nothing can be written next to the real database
+    with tempfile.TemporaryDirectory() as workdir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def check(runs: int, budget_ms: float) -> Tuple[float, List[str]]:
+    """
+    Measures the import time of `MODULE`, the fastest of `runs` imports.
+
+    Returns:
+        Tuple[float, List[str]]: The import time in milliseconds and the lazy
+            imports that were loaded anyway.
+    """
+    best = None
+    loaded: List[str] = []
+    for _ in range(runs):
+        times = import_times(MODULE)
+        elapsed = times[MODULE] / 1000
+        best = elapsed if best is None else min(best, elapsed)
+        loaded = [name for name in LAZY_IMPORTS if name in times]
+    print(f"import {MODULE}: {best:.1f} ms (budget {budget_ms:.0f} ms)")
+    return best, loaded
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="imports, fastest counts")
+    parser.add_argument(
+        "--budget", type=float, default=IMPORT_BUDGET_MS, help="budget in ms"
+    )
+    args = parser.parse_args()
+
+    elapsed, loaded = check(args.runs, args.budget)
+    failed = False
+    if elapsed > args.budget:
+        print(f"Import time over budget by {elapsed - args.budget:.1f} ms")
+        failed = True
+    for name in loaded:
+        print(f"{name} is imported eagerly, it should only be imported on use")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+import pytest
+
+from h2s_scrapper import db
+from h2s_scrapper.models import House
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh, migrated houses.db in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    db.close_connection()
+    db.create_table()
+    yield tmp_path / db.DB_PATH
+    db.close_connection()
+
+
+def make_house(url_key, city="25", price_inc=900.0, area=25.0, **fields):
+    """A parsed listing with plausible defaults."""
+    values = {
+        "url_key": url_key,
+        "city": city,
+        "area": area,
+        "price_exc": price_inc - 100 if price_inc is not None else None,
+        "price_inc": price_inc,
+        "available_from": "2024-10-01",
+        "max_register": "One",
+        "contract_type": "Indefinite",
+        "rooms": "Studio",
+    }
+    values.update(fields)
+    return House(**values)
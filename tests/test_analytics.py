@@ -0,0 +1,84 @@
+from conftest import make_house
+
+from h2s_scrapper import db
+from h2s_scrapper.analytics import MIN_COMPARABLES, MarketStats
+
+
+def prices(market, city="25", rooms=None):
+    """All prices per m² the statistics count, sorted."""
+    return sorted(
+        price
+        for (c, r, _), columns in market._columns.items()
+        if c == city and (rooms is None or r == rooms)
+        for price in columns.prices
+    )
+
+
+def comparables(count=MIN_COMPARABLES):
+    """Listings at 30, 31, ... €/m²."""
+    return [
+        make_house(f"unit-{i}", price_inc=25.0 * (30 + i), area=25.0)
+        for i in range(count)
+    ]
+
+
+def loaded():
+    market = MarketStats()
+    market.refresh()
+    return market
+
+
+def test_change_of_area_replaces_the_counted_price(database):
+    houses = comparables()
+    db.sync_houses("25", houses + [make_house("a", price_inc=1000.0, area=25.0)])
+    market = loaded()
+    assert 40.0 in prices(market)
+
+    # Same rent for a larger unit, then a price change on top
+    db.sync_houses("25", houses + [make_house("a", price_inc=1000.0, area=50.0)])
+    market.refresh()
+    db.sync_houses("25", houses + [make_house("a", price_inc=1100.0, area=50.0)])
+    market.refresh()
+
+    assert 40.0 not in prices(market)
+    assert 22.0 in prices(market)
+    # The same as when loaded from scratch
+    assert prices(market) == prices(loaded())
+
+
+def test_change_of_rooms_moves_the_price(database):
+    db.sync_houses("25", [make_house("a", price_inc=1000.0, rooms="Studio")])
+    market = loaded()
+
+    db.sync_houses("25", [make_house("a", price_inc=1000.0, rooms="2")])
+    market.refresh()
+
+    assert prices(market, rooms="Studio") == []
+    assert prices(market, rooms="2") == [40.0]
+
+
+def test_occupied_price_stays_when_relisted(database):
+    db.sync_houses("25", [make_house("a", price_inc=1000.0)])
+    market = loaded()
+    db.sync_houses("25", [])
+    db.sync_houses("25", [make_house("a", price_inc=1250.0)])
+    db.sync_houses("25", [make_house("a", price_inc=1500.0)])
+    market.refresh()
+
+    assert prices(market) == [40.0, 60.0] == prices(loaded())
+
+
+def test_cheaper_than_excludes_the_house_itself(database):
+    houses = comparables()
+    db.sync_houses("25", houses)
+    market = loaded()
+
+    # Not stored yet, priced like unit-5: all ten are comparables
+    house = make_house("new", price_inc=25.0 * 35, area=25.0)
+    assert market.cheaper_than(house) == 40.0
+
+    # Stored, it is only compared with the others
+    db.sync_houses("25", houses + [house])
+    market.refresh()
+    assert market.cheaper_than(house) == 40.0
+    assert market.cheaper_than(houses[0]) == 100.0
@@ -0,0 +1,87 @@
+import asyncio
+
+import httpx
+
+from h2s_scrapper import telegram
+
+
+def dispatcher_with(handler, monkeypatch):
+    sleeps = []
+
+    async def no_sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(asyncio, "sleep", no_sleep)
+    dispatcher = telegram.TelegramDispatcher(apikey="key", max_retries=2)
+    dispatcher._client = httpx.AsyncClient(
+        base_url="https://telegram.test/botkey", transport=httpx.MockTransport(handler)
+    )
+    return dispatcher, sleeps
+
+
+def test_non_json_429_is_retried_with_backoff(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(429, text="<html>Too Many Requests</html>")
+        return httpx.Response(200, json={"ok": True, "result": {}})
+
+    dispatcher, sleeps = dispatcher_with(handler, monkeypatch)
+    try:
+        responses = dispatcher.send_messages([("1", "a"), ("2", "b")])
+    finally:
+        dispatcher.close()
+
+    assert [r.status_code for r in responses] == [200, 200]
+    assert len(calls) == 3
+    assert 1 in sleeps
+
+
+def test_429_honours_retry_after(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(
+                429, json={"ok": False, "parameters": {"retry_after": 7}}
+            )
+        return httpx.Response(200, json={"ok": True, "result": {}})
+
+    dispatcher, sleeps = dispatcher_with(handler, monkeypatch)
+    try:
+        responses = dispatcher.send_messages([("1", "a")])
+    finally:
+        dispatcher.close()
+
+    assert responses[0].status_code == 200
+    assert 7 in sleeps
+
+
+def test_media_group_is_rate_limited_and_reuses_file_ids(database, monkeypatch):
+    monkeypatch.setattr(telegram, "fetch_images", lambda urls: [b"jpeg"] * len(urls))
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(429, json={"parameters": {"retry_after": 3}})
+        result = [{"photo": [{"file_id": f"id-{i}"}]} for i in range(2)]
+        return httpx.Response(200, json={"ok": True, "result": result})
+
+    dispatcher, sleeps = dispatcher_with(handler, monkeypatch)
+    try:
+        first = dispatcher.send_media_group("1", ["a.jpg", "b.jpg"], "caption")
+        second = dispatcher.send_media_group("2", ["a.jpg", "b.jpg"], "caption")
+    finally:
+        dispatcher.close()
+
+    assert first.status_code == second.status_code == 200
+    assert 3 in sleeps
+    assert len(calls) == 3
+    # The second chat references the photos the first one uploaded
+    assert b"attach://" in calls[1].content
+    assert b"attach://" not in calls[2].content
+    assert b"id-0" in calls[2].content
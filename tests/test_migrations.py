@@ -0,0 +1,148 @@
+import sqlite3
+import time
+
+import pytest
+
+from conftest import make_house
+
+from h2s_scrapper import db
+
+
+def baseline_database(path, rows):
+    """A houses.db as the first release created it, holding `rows`."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """CREATE TABLE houses
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  url_key TEXT,
+                  area TEXT,
+                  city TEXT,
+                  price_exc TEXT,
+                  price_inc TEXT,
+                  available_from TEXT,
+                  max_register TEXT,
+                  contract_type TEXT,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  occupied_at TEXT DEFAULT NULL,
+                  rooms TEXT)"""
+    )
+    conn.execute("CREATE INDEX idx_url_key ON houses (url_key)")
+    conn.execute("CREATE INDEX idx_occupied_at ON houses (occupied_at)")
+    for row in rows:
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" * len(row))
+        conn.execute(
+            f"INSERT INTO houses ({columns}) VALUES ({placeholders})",
+            tuple(row.values()),
+        )
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def legacy(tmp_path, monkeypatch):
+    """Migrates a baseline houses.db with the given rows, in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    db.close_connection()
+
+    def migrate(rows):
+        baseline_database(tmp_path / db.DB_PATH, rows)
+        db.create_table()
+        return db.get_connection()
+
+    yield migrate
+    db.close_connection()
+
+
+def test_occupied_at_is_converted_to_utc(legacy, monkeypatch):
+    # The old scraper stored datetime.now().isoformat(), in local time
+    monkeypatch.setenv("TZ", "Europe/Amsterdam")
+    time.tzset()
+    try:
+        conn = legacy(
+            [
+                {
+                    "url_key": "a",
+                    "city": "25",
+                    "created_at": "2024-07-01 08:00:00",
+                    "occupied_at": "2024-07-01T12:30:00.123456",
+                },
+                {"url_key": "b", "city": "25", "occupied_at": "not a date"},
+            ]
+        )
+    finally:
+        monkeypatch.delenv("TZ")
+        time.tzset()
+
+    rows = conn.execute(
+        "SELECT url_key, created_at, occupied_at FROM houses ORDER BY url_key"
+    ).fetchall()
+    assert rows[0] == ("a", "2024-07-01 08:00:00", "2024-07-01 10:30:00")
+    # What cannot be parsed is kept as it was
+    assert rows[1][2] == "not a date"
+
+
+def listing(url_key, city="25", **fields):
+    """A row as the first release stored it: everything TEXT, decimal commas."""
+    row = {
+        "url_key": url_key,
+        "city": city,
+        "area": "30,5",
+        "price_exc": "800,5",
+        "price_inc": "900,5",
+        "available_from": "2024-10-01",
+        "max_register": "One",
+        "contract_type": "Indefinite",
+        "rooms": "Studio",
+    }
+    row.update(fields)
+    return row
+
+
+def test_baseline_database_is_cleaned_and_synced(legacy):
+    conn = legacy(
+        [
+            listing("a", occupied_at="2024-01-01T10:00:00"),
+            listing("a"),
+            # Inserted again by an overlapping run
+            listing("a", price_inc="950"),
+            listing("b", area="25", price_inc="1000", price_exc=""),
+            listing("c"),
+            listing("d", city="24"),
+        ]
+    )
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    rows = conn.execute(
+        """SELECT id, url_key, area, price_exc, price_inc, occupied_at IS NULL,
+                  content_hash
+           FROM houses ORDER BY id"""
+    ).fetchall()
+    assert rows == [
+        (1, "a", 30.5, 800.5, 900.5, 0, None),
+        (2, "a", 30.5, 800.5, 900.5, 1, None),
+        (4, "b", 25.0, None, 1000.0, 1, None),
+        (5, "c", 30.5, 800.5, 900.5, 1, None),
+        (6, "d", 30.5, 800.5, 900.5, 1, None),
+    ]
+
+    unchanged = make_house("a", price_inc=900.5, area=30.5, price_exc=800.5)
+    changed = make_house("b", price_inc=1100.0, area=25.0)
+    new = make_house("e")
+    assert db.sync_houses("25", [unchanged, changed, new]) == [new]
+
+    # Legacy rows get their first hash without being reported as changed
+    events = conn.execute(
+        "SELECT url_key, event FROM house_events ORDER BY id"
+    ).fetchall()
+    assert events == [("c", db.EVENT_OCCUPIED), ("e", db.EVENT_LISTED)]
+    assert conn.execute(
+        "SELECT COUNT(*) FROM houses WHERE occupied_at IS NULL AND content_hash IS NULL"
+    ).fetchone() == (1,)  # "d", of a city that was not synced
+
+    changed = make_house("b", price_inc=1200.0, area=25.0)
+    assert db.sync_houses("25", [unchanged, changed, new]) == []
+    events = conn.execute(
+        "SELECT url_key, event, prev_price_inc, price_inc FROM house_events WHERE id > 2"
+    ).fetchall()
+    assert events == [("b", db.EVENT_CHANGED, 1100.0, 1200.0)]
@@ -0,0 +1,52 @@
+import pytest
+from conftest import make_house
+
+from h2s_scrapper import db, outbox
+
+
+def queue(url_keys, chat_id="42"):
+    new_houses = db.sync_houses("25", [make_house(url_key) for url_key in url_keys])
+    with db.transaction():
+        db.enqueue_notifications([(h.url_key, chat_id) for h in new_houses])
+
+
+def outbox_rows():
+    return (
+        db.get_connection()
+        .execute(
+            """SELECT status, attempts, last_error IS NOT NULL,
+                  next_attempt_at > CURRENT_TIMESTAMP, claimed_until
+           FROM notification_outbox ORDER BY id"""
+        )
+        .fetchall()
+    )
+
+
+@pytest.fixture
+def broken_send(monkeypatch):
+    def process_house_notifications(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(
+        outbox, "process_house_notifications", process_house_notifications
+    )
+
+
+def test_failing_batch_counts_as_attempt(database, broken_send):
+    queue(["a", "b"])
+
+    assert outbox.drain_outbox(None) == 0
+
+    # Released with a backoff instead of staying claimed until the lease expires
+    assert outbox_rows() == [(db.OUTBOX_PENDING, 1, 1, 1, None)] * 2
+
+
+def test_failing_batch_is_given_up_after_max_attempts(database, broken_send):
+    queue(["a"])
+    db.get_connection().execute(
+        "UPDATE notification_outbox SET attempts = ?", (outbox.MAX_ATTEMPTS - 1,)
+    )
+
+    outbox.drain_outbox(None)
+
+    assert outbox_rows() == [(db.OUTBOX_FAILED, outbox.MAX_ATTEMPTS, 1, 0, None)]
@@ -0,0 +1,47 @@
+from conftest import make_house
+
+from h2s_scrapper import db, main
+from h2s_scrapper.filters import FilterIndex
+
+# Numbers in config.json, as Telegram shows them
+GROUPS = [
+    {
+        "chat_id": -100123,
+        "cities": ["25"],
+        "send_images": True,
+        "digest_window": 600,
+        "digest_order": "available_from",
+    },
+    {"chat_id": "42", "cities": [25]},
+]
+
+
+def test_numeric_chat_ids_are_normalised():
+    assert main.image_chats(GROUPS) == frozenset({"-100123"})
+    assert main.digest_windows(GROUPS) == {"-100123": 600.0}
+    assert main.digest_orders(GROUPS) == {"-100123": "available_from"}
+    assert main.plan_subscriptions(GROUPS) == {"25": ["-100123", "42"]}
+    assert FilterIndex.from_groups(GROUPS).match(make_house("a")) == ["-100123", "42"]
+
+
+def test_numeric_chat_id_keeps_its_settings_through_the_outbox(database):
+    new_houses = db.sync_houses("25", [make_house("a")])
+    index = FilterIndex.from_groups(GROUPS)
+    with db.transaction():
+        db.enqueue_notifications(
+            [(h.url_key, chat_id) for h in new_houses for chat_id in index.match(h)],
+            main.digest_windows(GROUPS),
+        )
+
+    # Only the chat without a window is due, the other one waits for its digest
+    claimed = db.claim_notifications(10, 60)
+    assert [n.chat_id for n in claimed] == ["42"]
+    windowed = db.get_connection().execute(
+        """SELECT chat_id FROM notification_outbox
+           WHERE next_attempt_at > CURRENT_TIMESTAMP"""
+    )
+    chat_ids = [chat_id for (chat_id,) in windowed]
+    assert chat_ids == ["-100123"]
+    # What the outbox reads back matches what the config helpers key on
+    assert set(chat_ids) <= main.image_chats(GROUPS)
+    assert set(chat_ids) <= set(main.digest_orders(GROUPS))
@@ -0,0 +1,81 @@
+from h2s_scrapper.scheduler import SLOTS_PER_DAY, PollScheduler
+
+HISTORY_DAYS = 28
+
+
+def run(scheduler, start, seconds, step=0.5):
+    """Asks the scheduler every `step` seconds and polls what it returns."""
+    polls = []
+    now = start
+    while now < start + seconds:
+        cities, _ = scheduler.due(now)
+        if cities:
+            scheduler.polled(cities, now)
+            polls.extend((now, city) for city in cities)
+        now += step
+    return polls
+
+
+def busy_scheduler(cities, min_interval=5.0, requests_per_day=1_000_000):
+    """A scheduler that learned a release in every slot of every day."""
+    scheduler = PollScheduler(
+        {city: ["chat"] for city in cities},
+        requests_per_day=requests_per_day,
+        min_interval=min_interval,
+        max_interval=300.0,
+    )
+    scheduler.learn(
+        {city: dict.fromkeys(range(SLOTS_PER_DAY), HISTORY_DAYS) for city in cities},
+        HISTORY_DAYS,
+    )
+    return scheduler
+
+
+def test_polls_at_min_interval_not_back_to_back():
+    scheduler = busy_scheduler(["25"])
+    assert scheduler.intervals["25"][0] == 5.0
+
+    polls = run(scheduler, start=0.0, seconds=600)
+
+    assert len(polls) == 120
+    times = [now for now, _ in polls]
+    assert min(b - a for a, b in zip(times, times[1:])) >= 5.0
+
+
+def test_city_is_never_polled_before_its_interval():
+    scheduler = PollScheduler({"24": ["a"], "25": ["b"]}, requests_per_day=1_000_000)
+    scheduler.intervals = {
+        "24": [10.0] * SLOTS_PER_DAY,
+        "25": [12.0] * SLOTS_PER_DAY,
+    }
+
+    polls = run(scheduler, start=0.0, seconds=600)
+
+    for city, interval in (("24", 10.0), ("25", 12.0)):
+        times = [now for now, polled in polls if polled == city]
+        assert min(b - a for a, b in zip(times, times[1:])) >= interval
+
+
+def test_due_cities_share_a_request():
+    scheduler = busy_scheduler(["24", "25"])
+
+    cities, wait = scheduler.due(0.0)
+    assert sorted(cities) == ["24", "25"]
+    assert wait == 0.0
+    scheduler.polled(cities, 0.0)
+
+    cities, wait = scheduler.due(1.0)
+    assert cities == []
+    assert wait == 4.0
+
+
+def test_stays_within_budget():
+    scheduler = PollScheduler({"25": ["a"]}, requests_per_day=50)
+    scheduler.intervals = {"25": [5.0] * SLOTS_PER_DAY}
+
+    polls = run(scheduler, start=0.0, seconds=600)
+
+    assert len(polls) == 50
+    cities, wait = scheduler.due(600.0)
+    assert cities == []
+    assert wait > 0
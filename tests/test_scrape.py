@@ -0,0 +1,139 @@
+import json
+
+import pytest
+
+from h2s_scrapper import scrape
+from h2s_scrapper.resilience import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    """A breaker that opens after one failure and lets a trial through right away."""
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.0)
+    monkeypatch.setattr(scrape, "cloudflare_breaker", breaker)
+    return breaker
+
+
+def post_raising(monkeypatch, error):
+    def _post_graphql(payload, stream):
+        raise error
+
+    monkeypatch.setattr(scrape, "_post_graphql", _post_graphql)
+
+
+@pytest.mark.parametrize(
+    "error", [ValueError("bad body"), KeyboardInterrupt(), OSError("reset")]
+)
+def test_failed_trial_does_not_keep_breaker_open(breaker, monkeypatch, error):
+    post_raising(monkeypatch, scrape.CloudflareChallengeError("blocked"))
+    with pytest.raises(scrape.CloudflareChallengeError):
+        scrape.post_graphql({})
+    assert breaker.is_open
+
+    # The trial call fails for a reason unrelated to Cloudflare
+    post_raising(monkeypatch, error)
+    with pytest.raises(type(error)):
+        scrape.post_graphql({})
+
+    # So the next call is let through as a trial again and closes the breaker
+    monkeypatch.setattr(scrape, "_post_graphql", lambda payload, stream: "response")
+    assert scrape.post_graphql({}) == "response"
+    assert not breaker.is_open
+
+
+def test_open_breaker_rejects_calls_during_trial(breaker, monkeypatch):
+    post_raising(monkeypatch, scrape.CloudflareChallengeError("blocked"))
+    with pytest.raises(scrape.CloudflareChallengeError):
+        scrape.post_graphql({})
+
+    breaker.before_call()  # a trial in progress
+    with pytest.raises(CircuitOpenError):
+        scrape.post_graphql({})
+
+
+PRODUCTS = [
+    {"url_key": "a", "name": "Studio in Köln-straße 12 — ünit ✓"},
+    {"url_key": "b", "name": 'brackets ] in [ a "quoted" string ]'},
+    {"url_key": "c", "nested": {"list": [1, [2, 3]], "empty": []}},
+]
+BODY = json.dumps(
+    {
+        "data": {
+            "products": {
+                "items": PRODUCTS,
+                "page_info": {"total_pages": 3},
+                "total_count": 61,
+            }
+        }
+    },
+    ensure_ascii=False,
+).encode()
+
+
+def chunked(body, size):
+    return [body[i : i + size] for i in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(BODY)])
+def test_product_stream_decodes_any_chunking(size):
+    stream = scrape.ProductStream(chunked(BODY, size))
+
+    assert list(stream) == PRODUCTS
+    assert (stream.total_pages, stream.total_count) == (3, 61)
+
+
+def test_product_stream_splits_multibyte_characters():
+    # Both chunk boundaries fall inside the three bytes of "✓"
+    check = BODY.index("✓".encode())
+    chunks = [BODY[: check + 1], BODY[check + 1 : check + 2], BODY[check + 2 :]]
+
+    assert list(scrape.ProductStream(chunks)) == PRODUCTS
+
+
+def test_product_stream_skips_empty_chunks():
+    chunks = [b""] + [chunk for part in chunked(BODY, 5) for chunk in (part, b"")]
+
+    assert list(scrape.ProductStream(chunks)) == PRODUCTS
+
+
+def test_product_stream_empty_listing():
+    body = b'{"data": {"products": {"items": [], "page_info": {"total_pages": 0}, "total_count": 0}}}'
+    stream = scrape.ProductStream(chunked(body, 4))
+
+    assert list(stream) == []
+    assert (stream.total_pages, stream.total_count) == (0, 0)
+
+
+@pytest.mark.parametrize(
+    "cut",
+    [
+        BODY.index(b'"items"') + 3,  # before the array
+        BODY.index(b'"url_key": "b"'),  # inside a product
+        BODY.index(b'{"url_key": "c"') - 2,  # between two products
+    ],
+)
+def test_product_stream_rejects_truncated_body(cut):
+    with pytest.raises(ValueError):
+        list(scrape.ProductStream(chunked(BODY[:cut], 5)))
+
+
+def test_product_stream_truncated_tail_has_no_totals():
+    cut = BODY.index(b'"page_info"')
+    stream = scrape.ProductStream(chunked(BODY[:cut], 5))
+
+    assert list(stream) == PRODUCTS
+    assert (stream.total_pages, stream.total_count) == (None, None)
+
+
+def test_product_stream_reports_graphql_errors():
+    body = json.dumps(
+        {"errors": [{"message": "Internal server error"}], "data": {"products": None}}
+    ).encode()
+
+    with pytest.raises(ValueError, match="Internal server error"):
+        list(scrape.ProductStream(chunked(body, 3)))
+
+
+def test_product_stream_rejects_non_json():
+    with pytest.raises(ValueError, match="not a GraphQL result"):
+        list(scrape.ProductStream([b"<html>Just a moment...</html>"]))
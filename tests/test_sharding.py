@@ -0,0 +1,58 @@
+from h2s_scrapper import db
+from h2s_scrapper.sharding import CityLeases
+
+CITIES = ["24", "25", "26", "27"]
+
+
+def expire_leases(worker_id):
+    """Lets the leases of a worker run out, as if it stalled past its TTL."""
+    for table in ("city_leases", "lease_workers"):
+        db.get_connection().execute(
+            f"""UPDATE {table} SET expires_at = datetime('now', '-1 second')
+                WHERE worker = ?""",
+            (worker_id,),
+        )
+
+
+def test_joining_worker_gets_its_share(database):
+    first = CityLeases(CITIES, worker_id="first")
+    assert first.renew() == CITIES
+
+    second = CityLeases(CITIES, worker_id="second")
+    # Nothing is free until the first worker gives up its surplus
+    assert second.renew() == []
+    assert first.renew() == ["24", "25"]
+    assert second.renew() == ["26", "27"]
+
+    assert first.fenced(CITIES) == ["24", "25"]
+    assert second.fenced(CITIES) == ["26", "27"]
+
+
+def test_remaining_worker_takes_over_released_cities(database):
+    first = CityLeases(CITIES, worker_id="first")
+    second = CityLeases(CITIES, worker_id="second")
+    first.renew()
+    second.renew()
+    first.renew()
+    second.renew()
+
+    second.release()
+
+    assert first.renew() == CITIES
+    assert first.fenced(CITIES) == CITIES
+    assert second.fenced(CITIES) == []
+
+
+def test_expired_lease_is_fenced(database):
+    stalled = CityLeases(CITIES, worker_id="stalled")
+    stalled.renew()
+    expire_leases("stalled")
+
+    # Even before anyone else took the cities over
+    assert stalled.fenced(CITIES) == []
+
+    successor = CityLeases(CITIES, worker_id="successor")
+    assert successor.renew() == CITIES
+    assert all(token == 2 for token in successor.tokens.values())
+    assert stalled.fenced(CITIES) == []
+    assert successor.fenced(CITIES) == CITIES